@@ -24,11 +24,30 @@ Asana's REST API to generate a plaintext and HTML email using Jinja2 templates.
 '''
 
 import argparse
+import base64
 import codecs
+import collections
+import contextlib
+import cProfile
 import datetime
 import json
+import functools
+import gzip
+import hashlib
+import io
 import logging
+import operator
+import random
+import re
 import smtplib
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
 
 import dateutil.parser
 import dateutil.tz
@@ -36,8 +55,17 @@ import premailer
 import requests
 
 from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
 from email.mime.text import MIMEText
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import (
+    Environment, FileSystemBytecodeCache, FileSystemLoader, meta, nodes)
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from multiprocessing.pool import ThreadPool
+from premailer.premailer import FILTER_PSEUDOSELECTORS, merge_styles
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.exceptions import HTTPError
+from requests.structures import CaseInsensitiveDict
 
 
 def init_logging():
@@ -59,21 +87,291 @@ def init_logging():
 log = init_logging()
 
 
+class Metrics(object):
+    '''Records where a run spends its time, and the API calls it makes.
+
+    Phases (such as create_project or a template render) record how many
+    times they ran, and their total wall and CPU time. The CPU time is the
+    whole process's, so phases overlapping on other threads are counted in
+    it too. API calls record their count, the bytes received and their
+    latencies, per endpoint, with the ids in URLs replaced by {id}. Stages
+    that shrink messages record the bytes going in and out.
+
+    The process-wide Metrics, which the mailer records into, is returned by
+    shared(). Its summary can be written as JSON with summary() or sent to
+    statsd with statsd_lines().
+    '''
+
+    percentiles = (50, 90, 99)
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    _url_ids = re.compile(r'/-?\d+(?=/|$)')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._calls = {}
+        self._sizes = {}
+
+    @classmethod
+    def shared(cls):
+        '''Returns the Metrics that the whole process records into.'''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''A context manager that records its body as a run of a phase.'''
+        start_wall = time.time()
+        start_cpu = time.clock()
+        try:
+            yield
+        finally:
+            wall = time.time() - start_wall
+            cpu = time.clock() - start_cpu
+            with self._lock:
+                totals = self._phases.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+
+    def record_call(self, url, latency, num_bytes):
+        '''Records an API call.
+
+        :param url: The URL called, relative to the API's base URL
+        :param latency: The seconds the call took
+        :param num_bytes: The size of the response body
+        '''
+        endpoint = self._url_ids.sub('/{id}', '/' + url.split('?', 1)[0])
+        with self._lock:
+            totals = self._calls.setdefault(endpoint, [0, []])
+            totals[0] += num_bytes
+            totals[1].append(latency)
+
+    def record_size(self, stage, before, after):
+        '''Records a stage that shrinks a message, such as minify_html.
+
+        :param stage: The name of the stage
+        :param before: The message's size in bytes going in
+        :param after: Its size in bytes coming out
+        '''
+        with self._lock:
+            totals = self._sizes.setdefault(stage, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += before
+            totals[2] += after
+
+    def summary(self):
+        '''Returns a dict of the recorded phases, API calls and sizes.'''
+        with self._lock:
+            phases = dict(
+                (name, {
+                    'count': count,
+                    'wall_ms': round(wall * 1000, 3),
+                    'cpu_ms': round(cpu * 1000, 3),
+                })
+                for name, (count, wall, cpu) in self._phases.iteritems())
+            api_calls = {}
+            for endpoint, (num_bytes, latencies) in self._calls.iteritems():
+                latencies = sorted(latencies)
+                latency_ms = dict(
+                    ('p{0}'.format(percentile), round(
+                        _percentile(latencies, percentile) * 1000, 3))
+                    for percentile in type(self).percentiles)
+                latency_ms['max'] = round(latencies[-1] * 1000, 3)
+                api_calls[endpoint] = {
+                    'count': len(latencies),
+                    'bytes': num_bytes,
+                    'latency_ms': latency_ms,
+                }
+            sizes = dict(
+                (stage, {
+                    'count': count,
+                    'bytes_before': before,
+                    'bytes_after': after,
+                    'bytes_saved': before - after,
+                })
+                for stage, (count, before, after) in self._sizes.iteritems())
+        return {'phases': phases, 'api_calls': api_calls, 'sizes': sizes}
+
+    def statsd_lines(self, prefix='asana_mailer'):
+        '''Returns the summary as statsd lines.
+
+        Phase times are sent as timers, call and byte counts as counters and
+        latency percentiles as gauges. Endpoints are named by their path, with
+        slashes as dots and {id} as "id".
+        '''
+        summary = self.summary()
+        lines = []
+        for name, phase in sorted(summary['phases'].iteritems()):
+            name = _statsd_name(name)
+            lines.append('{0}.phase.{1}.wall:{2}|ms'.format(
+                prefix, name, phase['wall_ms']))
+            lines.append('{0}.phase.{1}.cpu:{2}|ms'.format(
+                prefix, name, phase['cpu_ms']))
+        for endpoint, calls in sorted(summary['api_calls'].iteritems()):
+            name = _statsd_name(endpoint)
+            lines.append('{0}.api.{1}.calls:{2}|c'.format(
+                prefix, name, calls['count']))
+            lines.append('{0}.api.{1}.bytes:{2}|c'.format(
+                prefix, name, calls['bytes']))
+            for stat, value in sorted(calls['latency_ms'].iteritems()):
+                lines.append('{0}.api.{1}.latency.{2}:{3}|g'.format(
+                    prefix, name, stat, value))
+        for stage, size in sorted(summary['sizes'].iteritems()):
+            lines.append('{0}.size.{1}.saved:{2}|c'.format(
+                prefix, _statsd_name(stage), size['bytes_saved']))
+        return lines
+
+
+def _percentile(sorted_values, percentile):
+    '''The nearest-rank percentile of a sorted, non-empty list.'''
+    rank = int(-(-len(sorted_values) * percentile // 100))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def _statsd_name(name):
+    return re.sub(r'[^\w.-]+', '_', name.strip('/').replace('/', '.').replace(
+        '{id}', 'id'))
+
+
+def instrumented(phase):
+    '''Decorates a function so its calls are recorded as a phase in the
+    shared Metrics.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Metrics.shared().phase(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def send_statsd(address, lines, max_packet_size=512):
+    '''Sends statsd lines over UDP, packing several lines per packet.
+
+    :param address: The statsd server, as "host" or "host:port"
+    :param lines: The statsd lines to send
+    :param max_packet_size: The largest packet to send, in bytes
+    '''
+    host, _, port = address.partition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packet = []
+        packet_size = 0
+        for line in lines:
+            if packet and packet_size + len(line) + 1 > max_packet_size:
+                sock.sendto('\n'.join(packet), (host, int(port or 8125)))
+                packet = []
+                packet_size = 0
+            packet.append(line)
+            packet_size += len(line) + 1
+        if packet:
+            sock.sendto('\n'.join(packet), (host, int(port or 8125)))
+    finally:
+        sock.close()
+
+
 class AsanaAPI(object):
     '''The class for making calls to Asana's REST API.
 
     The Asana class represents the infrastructure for storing a user's API key
     and making calls to Asana's API. It is utilized for generating the Project
     and its contained objects (Section, Task, etc.).
+
+    Calls are made over a persistent session, so connections to Asana are
+    kept alive and reused rather than paying for a new TCP and TLS handshake
+    on every call. The session should be released with close(), or by using
+    the AsanaAPI as a context manager.
+
+    An optional ResponseCache lets responses be reused between runs, with
+    stale entries revalidated through conditional requests.
+
+    Every call is paced by a RequestScheduler, and calls that are rate limited
+    by Asana are retried after the delay Asana asks for.
     '''
 
     asana_api_url = 'https://app.asana.com/api/1.0/'
     project_endpoint = 'projects/{project_id}'
     project_tasks_endpoint = 'projects/{project_id}/tasks'
     task_stories_endpoint = 'tasks/{task_id}/stories'
+    batch_endpoint = 'batch'
+
+    batch_limit = 10
+    # Batched actions take only plain query parameters in their data, and
+    # these pagination and output parameters in their options instead
+    batch_options = {
+        'opt_fields': 'fields',
+        'opt_expand': 'expand',
+        'limit': 'limit',
+        'offset': 'offset',
+    }
+    max_retries = 5
+    default_page_size = 100
+    default_pool_size = 10
+    default_connect_timeout = 10
+    default_read_timeout = 60
 
-    def __init__(self, api_key):
+    def __init__(
+            self, api_key, pool_size=None, connect_timeout=None,
+            read_timeout=None, cache=None, api_url=None, scheduler=None,
+            adapter=None):
+        '''Creates the API client and its connection pool.
+
+        :param api_key: The Asana API key to authenticate with
+        :param pool_size: The maximum number of connections to keep alive
+        :param connect_timeout: Seconds to wait for a connection to Asana
+        :param read_timeout: Seconds to wait for Asana to send a response
+        :param cache: An optional ResponseCache to serve responses from
+        :param api_url: The base URL of the API, if not Asana's own
+        :param scheduler: The RequestScheduler pacing this client's calls,
+        which defaults to one shared by the whole process
+        :param adapter: The requests transport adapter to make calls through,
+        such as a CassetteRecorder or CassetteReplayer (default: one keeping
+        up to pool_size connections alive)
+        '''
         self.api_key = api_key
+        self.cache = cache
+        self.scheduler = scheduler
+        if self.scheduler is None:
+            self.scheduler = RequestScheduler.shared()
+        if api_url is not None:
+            self.asana_api_url = api_url
+        if pool_size is None:
+            pool_size = type(self).default_pool_size
+        if connect_timeout is None:
+            connect_timeout = type(self).default_connect_timeout
+        if read_timeout is None:
+            read_timeout = type(self).default_read_timeout
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        self.session.auth = (api_key, '')
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        if adapter is None:
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Closes the session and any connections it is keeping alive.'''
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
 
     def get(self, endpoint_name, path_vars=None, expand=None, params=None):
         '''Makes a call to Asana's API.
@@ -82,29 +380,914 @@ class AsanaAPI(object):
         :param **kwargs: The keyword arguments necessary for retrieving data
         from a particular endpoint
         '''
+        url = self.endpoint_url(endpoint_name, path_vars)
+        params = self._with_expand(params, expand)
+        response_json = self._request(url, params)
+        if response_json is not None:
+            return response_json[u'data']
+
+    def iter_pages(
+            self, endpoint_name, path_vars=None, expand=None, params=None,
+            page_size=None):
+        '''Yields each page of a paginated collection from Asana's API.
+
+        Asana's next_page offsets are followed until the collection is
+        exhausted. As soon as a page arrives, the request for the following
+        page is started in the background, so fetching the next page overlaps
+        with the caller's processing of the current one, and at most two
+        pages are held at once.
+
+        :param endpoint_name: The endpoint attribute to connect to
+        :param page_size: The number of items to request per page
+        :return: A generator of lists of items
+        '''
+        url = self.endpoint_url(endpoint_name, path_vars)
+        params = dict(self._with_expand(params, expand) or {})
+        if page_size is None:
+            page_size = type(self).default_page_size
+        params['limit'] = page_size
+
+        response_json = self._request(url, params)
+        while True:
+            next_page = response_json.get(u'next_page')
+            if next_page:
+                next_params = dict(params, offset=next_page[u'offset'])
+                pending = BackgroundCall(self._request, url, next_params)
+            else:
+                pending = None
+            yield response_json[u'data']
+            if pending is None:
+                return
+            response_json = pending.get()
+
+    def iter_items(
+            self, endpoint_name, path_vars=None, expand=None, params=None,
+            page_size=None):
+        '''Yields each item of a paginated collection from Asana's API.
+
+        See iter_pages, which this flattens.
+
+        :return: A generator of items
+        '''
+        for page in self.iter_pages(
+                endpoint_name, path_vars, expand=expand, params=params,
+                page_size=page_size):
+            for item in page:
+                yield item
+
+    def endpoint_url(self, endpoint_name, path_vars=None):
+        '''Builds the full URL for an endpoint.
+
+        :param endpoint_name: The endpoint attribute to connect to
+        :param path_vars: The variables to substitute into the endpoint path
+        '''
         endpoint = getattr(type(self), '{0}_endpoint'.format(endpoint_name))
         if path_vars is not None:
             endpoint = endpoint.format(**path_vars)
-        url = '{0}{1}'.format(type(self).asana_api_url, endpoint)
-        log.info('Making API Call to {0}'.format(url))
+        return '{0}{1}'.format(self.asana_api_url, endpoint)
+
+    def get_batch(self, actions):
+        '''Makes several calls to Asana's API in a single round trip.
+
+        The calls are sent through Asana's batch endpoint. Each action
+        succeeds or fails on its own, so a failed action is returned as the
+        HTTPError it would have raised rather than failing the whole batch.
+
+        :param actions: A list of up to batch_limit (endpoint_name, path_vars)
+        or (endpoint_name, path_vars, params) tuples
+        :return: A list with, for each action, either its data or an HTTPError
+        '''
+        if len(actions) > type(self).batch_limit:
+            raise ValueError('At most {0} actions can be batched'.format(
+                type(self).batch_limit))
+        batch_actions = []
+        for action in actions:
+            endpoint_name, path_vars = action[:2]
+            params = action[2] if len(action) > 2 else None
+            endpoint = getattr(
+                type(self), '{0}_endpoint'.format(endpoint_name))
+            if path_vars is not None:
+                endpoint = endpoint.format(**path_vars)
+            data = {}
+            options = {}
+            for name, value in (params or {}).iteritems():
+                option = type(self).batch_options.get(name)
+                if option is None:
+                    data[name] = value
+                elif option in ('fields', 'expand'):
+                    options[option] = value.split(',')
+                else:
+                    options[option] = value
+            batch_action = {
+                'relative_path': '/{0}'.format(endpoint),
+                'method': 'get',
+                'data': data,
+            }
+            if options:
+                batch_action['options'] = options
+            batch_actions.append(batch_action)
+
+        url = self.endpoint_url('batch')
+        log.info('Making Batch API Call with {0} actions'.format(
+            len(batch_actions)))
+        response = self._send(
+            'post', url,
+            data=json.dumps({'data': {'actions': batch_actions}}),
+            headers={'Content-Type': 'application/json'},
+            timeout=self.timeout)
+        if response.status_code != requests.codes.ok:
+            return self._handle_error(response)
+
+        results = []
+        for action, result in zip(batch_actions, response.json()[u'data']):
+            body = result.get(u'body') or {}
+            if result[u'status_code'] == requests.codes.ok:
+                results.append(body[u'data'])
+            else:
+                errors = body.get(u'errors') or [{}]
+                results.append(HTTPError(
+                    '{0} Error for batched {1}: {2}'.format(
+                        result[u'status_code'], action['relative_path'],
+                        errors[0].get(u'message'))))
+        return results
+
+    @staticmethod
+    def _with_expand(params, expand):
         if expand:
             if params is None:
                 params = {}
             if 'opt_expand' not in params:  # Don't overwrite parameters
                 params['opt_expand'] = expand
-        response = requests.get(url, params=params, auth=(self.api_key, ''))
-        if response.status_code == requests.codes.ok:
-            return response.json()[u'data']
-        else:
-            log.error('Asana API Returned Non-OK (200) Response')
-            if response.content:
-                try:
-                    log.error('Response Content:\n{0}'.format(
-                        json.dumps(json.loads(response.content), indent=2)))
-                except (TypeError, ValueError):
-                    # If the error content isn't JSON, don't log it.
-                    pass
-            response.raise_for_status()
+        return params
+
+    def _request(self, url, params):
+        if self.cache is None:
+            log.info('Making API Call to {0}'.format(url))
+            response = self._send(
+                'get', url, params=params, timeout=self.timeout)
+            if response.status_code == requests.codes.ok:
+                return response.json()
+            return self._handle_error(response)
+
+        cache_key = ResponseCache.key(url, params, self.api_key)
+        entry = self.cache.lookup(cache_key)
+        if entry is not None and self.cache.is_fresh(entry):
+            log.info('Serving API Call to {0} from cache'.format(url))
+            self.cache.record_hit(entry)
+            return json.loads(entry.body)
+        log.info('Making API Call to {0}'.format(url))
+        headers = entry.validators() if entry is not None else {}
+        response = self._send(
+            'get', url, params=params, timeout=self.timeout, headers=headers)
+        if (entry is not None and
+                response.status_code == requests.codes.not_modified):
+            self.cache.revalidate(cache_key, entry)
+            return json.loads(entry.body)
+        elif response.status_code == requests.codes.ok:
+            self.cache.record_miss()
+            self.cache.store(
+                cache_key, response.content, response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+            return response.json()
+        return self._handle_error(response)
+
+    def _send(self, method, url, **kwargs):
+        '''Sends a request once the scheduler allows it, retrying on 429s.'''
+        for attempt in xrange(type(self).max_retries + 1):
+            self.scheduler.acquire()
+            try:
+                start = time.time()
+                response = getattr(self.session, method)(url, **kwargs)
+                latency = time.time() - start
+            finally:
+                self.scheduler.release()
+            Metrics.shared().record_call(
+                url[len(self.asana_api_url):] if url.startswith(
+                    self.asana_api_url) else url,
+                latency, len(response.content or ''))
+            if response.status_code != requests.codes.too_many_requests:
+                self.scheduler.record_response(latency)
+                return response
+            retry_after = self._retry_after(response, attempt)
+            self.scheduler.record_throttle(retry_after)
+            if attempt < type(self).max_retries:
+                log.warning('Rate limited, retrying {0} in {1}s'.format(
+                    url, retry_after))
+        return response
+
+    @staticmethod
+    def _retry_after(response, attempt):
+        try:
+            return float(response.headers['Retry-After'])
+        except (KeyError, TypeError, ValueError):
+            return float(2 ** attempt)
+
+    @staticmethod
+    def _handle_error(response):
+        log.error('Asana API Returned Non-OK (200) Response')
+        if response.content:
+            try:
+                log.error('Response Content:\n{0}'.format(
+                    json.dumps(json.loads(response.content), indent=2)))
+            except (TypeError, ValueError):
+                # If the error content isn't JSON, don't log it.
+                pass
+        response.raise_for_status()
+
+
+class RequestScheduler(object):
+    '''Paces calls to Asana's API to stay within its rate limits.
+
+    Calls draw from a token bucket that refills at the allowed rate, so short
+    bursts are allowed but the sustained rate never exceeds the quota. The
+    number of calls in flight is limited by a concurrency level that adapts
+    AIMD-style: it grows additively as calls succeed, and is halved when Asana
+    responds with a 429 or a call takes longer than the latency target. A 429
+    also pauses every call until its Retry-After has passed.
+    '''
+
+    # Asana's documented limit for premium organizations
+    default_rate = 1500 / 60.0
+    default_max_concurrency = 10
+    default_latency_target = 10.0
+    decrease_interval = 1.0
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+            self, rate=None, burst=None, max_concurrency=None,
+            latency_target=None):
+        '''Creates a scheduler.
+
+        :param rate: The sustained number of calls allowed per second, or 0
+        for no limit
+        :param burst: The number of calls that may be made at once after a
+        lull (default: one second's worth)
+        :param max_concurrency: The highest concurrency level to grow to
+        :param latency_target: Seconds above which a call's latency is treated
+        as a sign of congestion
+        '''
+        self.rate = rate
+        if self.rate is None:
+            self.rate = type(self).default_rate
+        self.burst = burst
+        if self.burst is None:
+            self.burst = max(1.0, self.rate)
+        self.max_concurrency = max_concurrency
+        if self.max_concurrency is None:
+            self.max_concurrency = type(self).default_max_concurrency
+        self.latency_target = latency_target
+        if self.latency_target is None:
+            self.latency_target = type(self).default_latency_target
+        self.concurrency = float(self.max_concurrency)
+        self.throttles = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.time()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def shared(cls):
+        '''The scheduler shared by every AsanaAPI that isn't given one.'''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def acquire(self):
+        '''Blocks until a call may be made, then counts it as in flight.'''
+        with self._condition:
+            while True:
+                now = time.time()
+                wait = self._paused_until - now
+                if wait <= 0 and self._in_flight < int(self.concurrency):
+                    wait = self._take_token(now)
+                    if wait <= 0:
+                        self._in_flight += 1
+                        return
+                self._condition.wait(wait if wait > 0 else None)
+
+    def _take_token(self, now):
+        if not self.rate:
+            return 0
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def release(self):
+        '''Marks a call as no longer in flight.'''
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def record_response(self, latency):
+        '''Adjusts the concurrency level after a call that wasn't throttled.
+
+        :param latency: The number of seconds the call took
+        '''
+        with self._condition:
+            if latency > self.latency_target:
+                self._decrease(time.time())
+            else:
+                self.concurrency = min(
+                    self.max_concurrency,
+                    self.concurrency + 1.0 / self.concurrency)
+            self._condition.notify_all()
+
+    def record_throttle(self, retry_after):
+        '''Backs off after Asana rate limited a call.
+
+        :param retry_after: The number of seconds Asana asked to wait
+        '''
+        with self._condition:
+            now = time.time()
+            self.throttles += 1
+            self._paused_until = max(self._paused_until, now + retry_after)
+            # Calls made before the pause will drain the bucket anyway
+            self._tokens = 0.0
+            self._refilled_at = now + retry_after
+            self._decrease(now)
+
+    def _decrease(self, now):
+        # Calls already in flight report the same congestion, so only back off
+        # once per interval
+        if now - self._decreased_at < type(self).decrease_interval:
+            return
+        self._decreased_at = now
+        self.concurrency = max(1.0, self.concurrency / 2)
+        log.info('Reduced API concurrency to {0}'.format(
+            int(self.concurrency)))
+
+
+class BackgroundCall(object):
+    '''Runs a function on a separate thread, holding on to its outcome.
+
+    The interface mirrors the AsyncResult objects returned by a ThreadPool, so
+    either can be waited on with get().
+    '''
+
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(
+            target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def get(self):
+        '''Waits for the call to finish, returning or raising its outcome.'''
+        self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class DeferredCall(object):
+    '''Runs a function on the calling thread the first time it is needed.
+
+    This is the serial counterpart of BackgroundCall, sharing its get()
+    interface.
+    '''
+
+    def __init__(self, func, *args, **kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._done = False
+        self._result = None
+
+    def get(self):
+        '''Runs the call if it has not been run yet, returning its result.'''
+        if not self._done:
+            self._result = self._func(*self._args, **self._kwargs)
+            self._done = True
+        return self._result
+
+
+class BatchedResult(object):
+    '''The outcome of one action within a batch of calls.
+
+    :param batch_result: The result of the whole batch, with a get() method
+    :param index: The position of this action within the batch
+    '''
+
+    def __init__(self, batch_result, index):
+        self._batch_result = batch_result
+        self._index = index
+
+    def get(self):
+        '''Waits for the batch, returning or raising this action's outcome.'''
+        result = self._batch_result.get()[self._index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class CacheEntry(object):
+    '''A response stored in a ResponseCache, along with its validators.'''
+
+    def __init__(self, body, etag, last_modified, stored_at):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    def validators(self):
+        '''The headers that make a request conditional on this entry.'''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    '''A persistent, size-bounded cache of Asana API responses.
+
+    Responses are kept in a SQLite database keyed by URL, query parameters
+    and a digest of the API key they were fetched with, along with the ETag
+    and Last-Modified validators Asana sent for them. Keying by the API key
+    means one account's responses are never served to another sharing the
+    cache. Entries younger than the TTL are served without contacting Asana
+    at all; older entries are revalidated with a conditional request, so an
+    unchanged response costs a round trip but not its payload. Once the
+    stored bodies exceed max_bytes, the least recently used entries are
+    evicted.
+    '''
+
+    default_max_bytes = 256 * 1024 * 1024
+
+    def __init__(self, path, ttl=0, max_bytes=None):
+        '''Opens (or creates) a response cache.
+
+        :param path: The filename of the SQLite database to store responses in
+        :param ttl: Seconds a response may be served without revalidation
+        :param max_bytes: The maximum total size of stored response bodies
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if self.max_bytes is None:
+            self.max_bytes = type(self).default_max_bytes
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, body BLOB, etag TEXT, '
+                'last_modified TEXT, size INTEGER, stored_at REAL, '
+                'last_used REAL)')
+
+    @staticmethod
+    def key(url, params, api_key=None):
+        '''Builds the cache key for a request.
+
+        :param url: The full URL of the request
+        :param params: The query parameters of the request
+        :param api_key: The API key the request is made with
+        '''
+        credentials = hashlib.sha256(
+            (api_key or '').encode('utf-8')).hexdigest()
+        return json.dumps([credentials, url, sorted((params or {}).items())])
+
+    def lookup(self, key):
+        '''Retrieves the stored entry for a key, marking it as recently used.
+
+        :param key: The cache key of the request
+        :return: The CacheEntry, or None if nothing is stored for the key
+        '''
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT body, etag, last_modified, stored_at FROM responses '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE responses SET last_used = ? WHERE key = ?',
+                (time.time(), key))
+        body, etag, last_modified, stored_at = row
+        return CacheEntry(str(body), etag, last_modified, stored_at)
+
+    def is_fresh(self, entry):
+        '''Determines if an entry can be served without revalidation.'''
+        return time.time() - entry.stored_at < self.ttl
+
+    def store(self, key, body, etag=None, last_modified=None):
+        '''Stores a response, evicting old entries to stay within max_bytes.
+
+        :param key: The cache key of the request
+        :param body: The raw response body
+        :param etag: The ETag header of the response
+        :param last_modified: The Last-Modified header of the response
+        '''
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(body), etag, last_modified, len(body),
+                 now, now))
+            self._evict()
+
+    def _evict(self):
+        total_size = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            'SELECT key, size FROM responses ORDER BY last_used ASC')
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        log.info('Evicted {0} responses from the cache'.format(len(evicted)))
+
+    def revalidate(self, key, entry):
+        '''Records that Asana confirmed an entry is still current.
+
+        :param key: The cache key of the request
+        :param entry: The CacheEntry that was revalidated
+        '''
+        entry.stored_at = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE responses SET stored_at = ? WHERE key = ?',
+                (entry.stored_at, key))
+            self.revalidations += 1
+            self.bytes_saved += len(entry.body)
+
+    def record_hit(self, entry):
+        '''Records that an entry was served without contacting Asana.'''
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += len(entry.body)
+
+    def record_miss(self):
+        '''Records that a response had to be downloaded in full.'''
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        '''Summarizes how much the cache has saved.
+
+        :return: A dict of hit, revalidation and miss counts, and the number
+        of response bytes that did not need to be downloaded
+        '''
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'round_trips_saved': self.hits,
+            'bytes_saved': self.bytes_saved,
+        }
+
+    def close(self):
+        '''Logs the cache statistics and closes the database.'''
+        log.info('Response cache stats: {0}'.format(
+            json.dumps(self.stats(), sort_keys=True)))
+        self._conn.close()
+
+
+class TaskStateStore(object):
+    '''A local record of each task's comments as of its last modification.
+
+    The store remembers the modified_at timestamp Asana reported for each
+    task along with the comments fetched for it, so later runs only need to
+    fetch comments for tasks that have since been modified. Since Asana does
+    not count every new story as a modification, entries older than max_age
+    are refetched regardless.
+
+    Each entry also records the story fields its comments were fetched with,
+    and is only reused by runs whose templates need no other fields.
+    '''
+
+    def __init__(self, path, max_age=None):
+        '''Opens (or creates) a task state store.
+
+        :param path: The filename of the SQLite database to store state in
+        :param max_age: Seconds after which stored comments are refetched,
+        even for unmodified tasks
+        '''
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            columns = [row[1] for row in self._conn.execute(
+                'PRAGMA table_info(tasks)')]
+            if columns and 'story_fields' not in columns:
+                # Stored before fields were recorded, so they can't be trusted
+                self._conn.execute('DROP TABLE tasks')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'task_id TEXT PRIMARY KEY, modified_at TEXT, comments TEXT, '
+                'fetched_at REAL, story_fields TEXT)')
+
+    def get_comments(self, task_id, modified_at, story_fields=None):
+        '''Retrieves the stored comments for a task, if they are current.
+
+        :param task_id: The id of the task
+        :param modified_at: The task's modified_at timestamp from Asana
+        :param story_fields: The story fields the comments need, or None if
+        they need every field
+        :return: The list of stored comments, or None if the task's comments
+        need to be fetched
+        '''
+        if not modified_at:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT modified_at, comments, fetched_at, story_fields '
+                'FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None or row[0] != modified_at:
+            return None
+        if self.max_age is not None and time.time() - row[2] > self.max_age:
+            return None
+        # Comments fetched with every field (stored as NULL) cover any run
+        if row[3] is not None and (
+                story_fields is None or
+                not frozenset(row[3].split(',')) >= frozenset(story_fields)):
+            return None
+        return json.loads(row[1])
+
+    def save_comments(self, task_comments, story_fields=None):
+        '''Records the comments fetched for tasks.
+
+        :param task_comments: An iterable of (task_id, modified_at, comments)
+        :param story_fields: The story fields the comments were fetched with,
+        or None if they were fetched with every field
+        '''
+        now = time.time()
+        if story_fields is not None:
+            story_fields = ','.join(sorted(story_fields))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)',
+                ((task_id, modified_at, json.dumps(comments), now,
+                  story_fields)
+                 for task_id, modified_at, comments in task_comments
+                 if modified_at))
+
+    def close(self):
+        '''Closes the database.'''
+        self._conn.close()
+
+
+class Cassette(object):
+    '''A recording of Asana API calls and their responses.
+
+    Calls are keyed by their method, their path relative to the API's base
+    URL, their sorted query parameters and (for batch calls) their JSON
+    body, so a recording can be replayed against any base URL. A call made
+    several times is replayed with its responses in the order they were
+    recorded, repeating the last one.
+
+    Cassettes are saved as gzipped JSON lines, one call per line.
+    '''
+
+    # Parameters that change from run to run, such as completed_since with
+    # a lookback, which calls are also matched without
+    volatile_params = frozenset(['completed_since'])
+    kept_headers = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+
+    def __init__(self, path=None):
+        '''Creates an empty cassette.
+
+        :param path: The filename that save() writes to
+        '''
+        self.path = path
+        self.entries = []
+        self._responses = {}
+        self._loose_responses = {}
+        self._replayed = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        '''Loads a cassette saved with save().'''
+        cassette = cls(path)
+        with gzip.open(path, 'rb') as cassette_file:
+            for line in cassette_file:
+                entry = json.loads(line)
+                cassette._add(
+                    entry['key'], entry['status'], entry['headers'],
+                    entry['body'].encode('utf-8'))
+        return cassette
+
+    @classmethod
+    def key(cls, method, relative_url, body=None, loose=False):
+        '''Builds the key of a call.
+
+        :param method: The HTTP method
+        :param relative_url: The URL relative to the API's base URL, with its
+        query string
+        :param body: The request body, for batch calls
+        :param loose: Whether to leave out the volatile parameters
+        '''
+        path, _, query = relative_url.partition('?')
+        params = sorted(
+            (name, value) for name, value in urlparse.parse_qsl(
+                query, keep_blank_values=True)
+            if not (loose and name in cls.volatile_params))
+        key = '{0} {1}?{2}'.format(
+            method.upper(), path.strip('/'), urllib.urlencode(params))
+        if body:
+            key += ' ' + json.dumps(json.loads(body), sort_keys=True)
+        return key
+
+    def record(self, key, status, headers, body):
+        '''Records the response to a call.'''
+        headers = dict(
+            (name, headers[name]) for name in type(self).kept_headers
+            if name in headers)
+        with self._lock:
+            self._add(key, status, headers, body)
+
+    def _add(self, key, status, headers, body):
+        response = (status, headers, body)
+        self.entries.append((key, response))
+        self._responses.setdefault(key, []).append(response)
+        self._loose_responses.setdefault(
+            self._loosen(key), []).append(response)
+
+    def _loosen(self, key):
+        method, _, rest = key.partition(' ')
+        relative_url, _, body = rest.partition(' ')
+        return type(self).key(method, relative_url, body or None, loose=True)
+
+    def lookup(self, key):
+        '''Returns the next recorded (status, headers, body) of a call.
+
+        :return: The response, or None if the call was never recorded
+        '''
+        with self._lock:
+            responses = self._responses.get(key)
+            if responses is None:
+                key = self._loosen(key)
+                responses = self._loose_responses.get(key)
+                if responses is None:
+                    return None
+            index = self._replayed.get(key, 0)
+            self._replayed[key] = index + 1
+            return responses[min(index, len(responses) - 1)]
+
+    def save(self):
+        '''Writes the recorded calls to the cassette's path.'''
+        with self._lock:
+            entries = list(self.entries)
+        with gzip.open(self.path, 'wb') as cassette_file:
+            for key, (status, headers, body) in entries:
+                cassette_file.write(json.dumps({
+                    'key': key, 'status': status, 'headers': headers,
+                    'body': body.decode('utf-8'),
+                }, sort_keys=True) + '\n')
+        log.info('Saved {0} API calls to {1}'.format(len(entries), self.path))
+
+
+def _relative_url(url, api_url):
+    if url.startswith(api_url):
+        return url[len(api_url):]
+    split_url = urlparse.urlsplit(url)
+    return '{0}?{1}'.format(split_url.path, split_url.query)
+
+
+class CassetteRecorder(HTTPAdapter):
+    '''A transport adapter that records the calls it sends in a Cassette.
+
+    The cassette is saved when the adapter is closed, as it is when the
+    AsanaAPI is.
+    '''
+
+    def __init__(self, cassette, api_url, **kwargs):
+        '''Creates the adapter.
+
+        :param cassette: The Cassette to record into
+        :param api_url: The base URL of the API, which recorded URLs are made
+        relative to
+        :param **kwargs: The arguments to HTTPAdapter
+        '''
+        self.cassette = cassette
+        self.api_url = api_url
+        self._closed = False
+        super(CassetteRecorder, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        response = super(CassetteRecorder, self).send(request, **kwargs)
+        self.cassette.record(
+            Cassette.key(
+                request.method, _relative_url(request.url, self.api_url),
+                request.body),
+            response.status_code, response.headers, response.content)
+        return response
+
+    def close(self):
+        super(CassetteRecorder, self).close()
+        # The adapter is mounted for both http and https, so is closed twice
+        if not self._closed:
+            self._closed = True
+            self.cassette.save()
+
+
+class CassetteReplayer(BaseAdapter):
+    '''A transport adapter that answers calls from a Cassette.
+
+    No network is used, so runs are offline and reproducible. Latency,
+    jitter and errors can be injected to see how the mailer's concurrency
+    and retries behave: each call is delayed by latency plus or minus a
+    random amount of up to jitter, and fails with error_status (a rate
+    limit error, which AsanaAPI retries, by default) at error_rate.
+    Calls that were never recorded fail with a 404.
+    '''
+
+    def __init__(
+            self, cassette, api_url, latency=0, jitter=0, error_rate=0,
+            error_status=429, seed=None):
+        '''Creates the adapter.
+
+        :param cassette: The Cassette to replay
+        :param api_url: The base URL of the API that calls are made to
+        :param latency: The seconds to delay each call by
+        :param jitter: The most seconds to randomly vary the latency by
+        :param error_rate: The fraction of calls to fail
+        :param error_status: The HTTP status to fail calls with
+        :param seed: The random seed, so runs are comparable
+        '''
+        super(CassetteReplayer, self).__init__()
+        self.cassette = cassette
+        self.api_url = api_url
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def respond(self, method, relative_url, body=None):
+        '''Waits out the injected latency and returns a call's response.
+
+        :return: A tuple of the status, a dict of headers and the body
+        '''
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self._random.uniform(
+                -self.jitter, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            return self.error_status, {'Retry-After': '0'}, json.dumps({
+                'errors': [{'message': 'Injected error'}]})
+        response = self.cassette.lookup(
+            Cassette.key(method, relative_url, body))
+        if response is None:
+            log.warning('No recorded response for {0} {1}'.format(
+                method, relative_url))
+            return 404, {'Content-Type': 'application/json'}, json.dumps({
+                'errors': [{'message': 'Not in the cassette'}]})
+        return response
+
+    def send(self, request, **kwargs):
+        status, headers, body = self.respond(
+            request.method, _relative_url(request.url, self.api_url),
+            request.body)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
 
 
 class Project(object):
@@ -116,6 +1299,8 @@ class Project(object):
     sections.
     '''
 
+    __slots__ = ('id', 'name', 'description', 'sections')
+
     def __init__(self, id, name, description, sections=None):
         self.id = id
         self.name = name
@@ -125,74 +1310,230 @@ class Project(object):
             self.sections = []
 
     @staticmethod
+    @instrumented('create_project')
     def create_project(
             asana, project_id, current_time_utc, task_filters=None,
-            section_filters=None, completed_lookback_hours=None):
+            section_filters=None, completed_lookback_hours=None,
+            concurrency=1, state_store=None, batch=False, fields=None):
         '''Creates a Project utilizing data from Asana.
 
         Using filters, a project attempts to optimize the calls it makes to
-        Asana's API. After the JSON data has been collected, it is then parsed
-        into Task and Section objects, and then filtered again in order to
-        perform filtering that is only possible post-parsing.
+        Asana's API. Tasks are streamed from Asana a page at a time through a
+        single pass that splits them into sections, filters them, makes Task
+        objects of the tasks that are kept and schedules their comment calls,
+        so no task is looked at twice and no sections are left to filter out
+        afterwards.
+
+        When concurrency is greater than one, the project metadata call is
+        overlapped with the task list calls, and task comments are fetched by
+        a bounded pool of worker threads while later pages of tasks are still
+        being retrieved. The resulting project is identical to the one built
+        serially.
+
+        With a TaskStateStore, comments are only fetched for tasks that were
+        modified since they were last recorded; the stored comments are used
+        for the rest.
+
+        With batch, comments are fetched through Asana's batch endpoint, for
+        up to AsanaAPI.batch_limit tasks per call.
+
+        With TemplateFields, only the task and story fields the templates use
+        are requested, and comments aren't fetched at all if the templates
+        never use them. Otherwise, every field of every task is requested.
 
         :param asana: The initialized Asana object that makes API calls
         :param project_id: The Asana Project ID
-        :param task_filters: A list of tag filters for filtering out tasks
+        :param task_filters: A set of tags that tasks must all have, or a
+        TagExpression that they must match
         :param section_filters: A list of sections to filter out tasks
         :param completed_lookback_hours: An amount in hours to look back for
         completed tasks
+        :param concurrency: The maximum number of API calls to make at once
+        :param state_store: An optional TaskStateStore of previously fetched
+        comments
+        :param batch: Whether to fetch comments through batched calls
+        :param fields: The TemplateFields of the templates to be rendered
         :return: The newly created Project instance
         '''
         log.info('Creating project object from Asana Project {0}'.format(
             project_id))
 
-        project_json = asana.get('project', {'project_id': project_id})
-
-        tasks_params = {}
-        if completed_lookback_hours:
-            completed_since = (current_time_utc - datetime.timedelta(
-                hours=completed_lookback_hours)).replace(
-                    microsecond=0).isoformat()
-            log.info(
-                'Retaining tasks completed since {0}'.format(completed_since))
+        if fields is not None:
+            story_fields = fields.story_fields
+            fetch_comments = fields.comments
         else:
-            completed_since = 'now'
-        tasks_params['completed_since'] = completed_since
-        project_tasks_json = asana.get(
-            'project_tasks', {'project_id': project_id}, expand='.',
-            params=tasks_params)
-        task_comments = {}
-
-        current_section = None
-        log.info('Starting API Calls for Task Comments')
-        for task in project_tasks_json:
-            if task[u'name'].endswith(':'):
-                current_section = task[u'name']
-            # Optimize calls to API
-            if section_filters and current_section not in section_filters:
-                continue
-            tag_names = frozenset((tag[u'name'] for tag in task[u'tags']))
-            if task_filters and not tag_names >= task_filters:
-                continue
-            task_id = unicode(task[u'id'])
-            log.info('Getting task comments for task: {0}'.format(task_id))
-            task_stories = asana.get('task_stories', {'task_id': task_id})
-            current_task_comments = [
-                story for story in task_stories if
-                story[u'type'] == u'comment']
-            if current_task_comments:
-                task_comments[task_id] = current_task_comments
+            story_fields = None
+            fetch_comments = True
+        tag_filter = TagExpression.coerce(task_filters)
+        pool = ThreadPool(concurrency) if concurrency > 1 else None
+        get_comments = functools.partial(
+            get_task_comments, asana, fields=story_fields)
+        scheduled_comments = []
+        batched_tasks = []
+        stored = [0]
+
+        def submit(func, *args):
+            if pool is not None:
+                return pool.apply_async(func, args)
+            return DeferredCall(func, *args)
+
+        def submit_batch():
+            batch_result = submit(
+                get_batch_task_comments, asana,
+                [task.id for task, _ in batched_tasks], story_fields)
+            scheduled_comments.extend(
+                (task, modified_at, BatchedResult(batch_result, index))
+                for index, (task, modified_at) in enumerate(batched_tasks))
+            del batched_tasks[:]
+
+        def schedule_comments(task, task_json):
+            '''Schedules the comment fetch of a task that was kept.'''
+            modified_at = task_json.get(u'modified_at')
+            if state_store is not None:
+                current_task_comments = state_store.get_comments(
+                    task.id, modified_at, story_fields)
+                if current_task_comments is not None:
+                    if current_task_comments:
+                        task.comments = Comment.from_stories(
+                            current_task_comments)
+                    stored[0] += 1
+                    return
+            if batch:
+                batched_tasks.append((task, modified_at))
+                if len(batched_tasks) == asana.batch_limit:
+                    submit_batch()
+            else:
+                scheduled_comments.append(
+                    (task, modified_at, submit(get_comments, task.id)))
+
+        try:
+            if pool is not None:
+                project_result = pool.apply_async(
+                    asana.get, ('project', {'project_id': project_id}))
+            else:
+                project_json = asana.get(
+                    'project', {'project_id': project_id})
+
+            tasks_params = {}
+            if completed_lookback_hours:
+                completed_since = (current_time_utc - datetime.timedelta(
+                    hours=completed_lookback_hours)).replace(
+                        microsecond=0).isoformat()
+                log.info('Retaining tasks completed since {0}'.format(
+                    completed_since))
+            else:
+                completed_since = 'now'
+            tasks_params['completed_since'] = completed_since
+            if fields is not None:
+                task_fields = set(fields.task_fields)
+                task_fields.add('name')
+                if tag_filter is not None:
+                    task_fields.add('tags.name')
+                if state_store is not None and fetch_comments:
+                    task_fields.add('modified_at')
+                tasks_params['opt_fields'] = ','.join(sorted(task_fields))
+                expand = None
+            else:
+                expand = '.'
+            project_tasks_json = asana.iter_items(
+                'project_tasks', {'project_id': project_id}, expand=expand,
+                params=tasks_params)
+
+            log.info('Separating Tasks into Sections')
+            sections = Section.create_sections(
+                project_tasks_json, {}, section_filters=section_filters,
+                task_filters=tag_filter,
+                on_task=schedule_comments if fetch_comments else None)
+            if batched_tasks:
+                submit_batch()
+
+            if fetch_comments:
+                log.info('Starting API Calls for Task Comments')
+            else:
+                log.info('Templates never use comments, skipping them')
+            if pool is not None:
+                project_json = project_result.get()
+            if state_store is not None and fetch_comments:
+                log.info('Reusing stored comments for {0} tasks'.format(
+                    stored[0]))
+            fetched_comments = []
+            for task, modified_at, result in scheduled_comments:
+                current_task_comments = result.get()
+                fetched_comments.append(
+                    (task.id, modified_at, current_task_comments))
+                if current_task_comments:
+                    task.comments = Comment.from_stories(
+                        current_task_comments)
+            if state_store is not None and fetch_comments:
+                state_store.save_comments(fetched_comments, story_fields)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         project = Project(
             project_id, project_json[u'name'], project_json[u'notes'])
-        log.info('Separating Tasks into Sections')
-        project.add_sections(
-            Section.create_sections(project_tasks_json, task_comments))
-        log.info('Starting task filtering')
-        project.filter_tasks(
-            current_time_utc, section_filters=section_filters,
-            task_filters=task_filters)
+        project.add_sections(sections)
+
+        return project
+
+    snapshot_version = 1
+
+    def save_snapshot(self, path):
+        '''Saves the project, with its sections, tasks and comments.
+
+        Snapshots are gzipped JSON lines: the project, then each section
+        followed by its tasks, in the form of Asana's task JSON with their
+        comments' stories. A snapshot lets a project be rendered again, with
+        other templates or for other recipients, without calling Asana.
+
+        :param path: The filename to save the snapshot to
+        '''
+        log.info('Saving project snapshot to {0}'.format(path))
+        dumps = json.JSONEncoder(
+            ensure_ascii=False, separators=(',', ':')).encode
+        with gzip.open(path, 'wb', 6) as snapshot_file:
+            write = snapshot_file.write
+            write(dumps({
+                u'snapshot': type(self).snapshot_version, u'id': self.id,
+                u'name': self.name, u'description': self.description,
+            }).encode('utf-8') + '\n')
+            for section in self.sections:
+                write(dumps({u'section': section.name}).encode('utf-8') + '\n')
+                for task in section.tasks:
+                    write(dumps(
+                        {u'task': task.to_json()}).encode('utf-8') + '\n')
+
+    @staticmethod
+    def load_snapshot(path):
+        '''Loads a project saved with save_snapshot.
+
+        The snapshot is streamed a line at a time, so only the project being
+        built is held in memory.
 
+        :param path: The filename of the snapshot
+        :return: The Project
+        :raises ValueError: If the file isn't a snapshot this version reads
+        '''
+        log.info('Loading project snapshot from {0}'.format(path))
+        with io.BufferedReader(gzip.open(path, 'rb')) as snapshot_file:
+            header = json.loads(snapshot_file.readline() or 'null')
+            if not isinstance(header, dict) or header.get(
+                    u'snapshot') != Project.snapshot_version:
+                raise ValueError('{0} is not a version {1} snapshot'.format(
+                    path, Project.snapshot_version))
+            project = Project(
+                header[u'id'], header[u'name'], header[u'description'])
+            section = None
+            for line in snapshot_file:
+                entry = json.loads(line)
+                if u'task' in entry:
+                    task_json = entry[u'task']
+                    section.add_task(
+                        Task.from_json(task_json, task_json[u'comments']))
+                else:
+                    section = Section(intern_string(entry[u'section']))
+                    project.add_section(section)
         return project
 
     def add_section(self, section):
@@ -211,12 +1552,18 @@ class Project(object):
         self.sections.extend(
             (section for section in sections if isinstance(section, Section)))
 
+    @instrumented('filter_tasks')
     def filter_tasks(
             self, current_time_utc, section_filters=None, task_filters=None):
         '''Filter out tasks based on filters based on filter criteria.
 
+        Tag filters are evaluated against the project's TagIndex, so each tag
+        in the filter costs one set operation rather than a pass over every
+        task.
+
         :param sections_filters: A list of sections to filter the Project on
-        :param task_filters: A list of tags to filter the Project's tasks on
+        :param task_filters: A set of tags that kept tasks must all have, or a
+        TagExpression that they must match
         :param current_time_utc: The current time in UTC
         '''
         # Section Filters
@@ -226,21 +1573,62 @@ class Project(object):
             self.sections[:] = [
                 s for s in self.sections if s.name in section_filters]
         # Task (Tag) Filters
-        if task_filters:
-            log.info('Filtering tasks by tag filters: {0}'.format(
-                task_filters))
+        tag_filter = TagExpression.coerce(task_filters)
+        if tag_filter is not None:
+            log.info('Filtering tasks by tag filters: {0}'.format(tag_filter))
+            selected = tag_filter.select(self.tag_index())
+            position = 0
             for section in self.sections:
-                section.tasks[:] = [
-                    task for task in section.tasks
-                    if task.tags_in(task_filters)]
+                tasks = section.tasks
+                section.tasks = [
+                    task for index, task in enumerate(tasks, position)
+                    if index in selected]
+                position += len(tasks)
         # Remove Empty Sections
         log.info('Removing empty sections')
         self.sections[:] = [s for s in self.sections if s.tasks]
 
+    def filtered_view(
+            self, section_filters=None, task_filters=None, tag_index=None):
+        '''Returns a filtered copy of the project, leaving it as it is.
+
+        The copy has its own sections but shares their Task objects, so
+        several differently filtered views of one fetched project are cheap.
+
+        :param section_filters: A list of sections to keep
+        :param task_filters: A set of tags that kept tasks must all have, or a
+        TagExpression that they must match
+        :param tag_index: The project's TagIndex, to share between views
+        :return: The filtered Project
+        '''
+        tag_filter = TagExpression.coerce(task_filters)
+        if tag_filter is not None:
+            selected = tag_filter.select(tag_index or self.tag_index())
+        view = Project(self.id, self.name, self.description)
+        position = 0
+        for section in self.sections:
+            tasks = section.tasks
+            if not section_filters or section.name in section_filters:
+                if tag_filter is not None:
+                    tasks = [
+                        task for index, task in enumerate(tasks, position)
+                        if index in selected]
+                if tasks:
+                    view.add_section(Section(section.name, list(tasks)))
+            position += len(section.tasks)
+        return view
+
+    def tag_index(self):
+        '''Returns a TagIndex of the project's tasks, in section order.'''
+        return TagIndex(
+            task for section in self.sections for task in section.tasks)
+
 
 class Section(object):
     '''A class representing a section of tasks within an Asana Project.'''
 
+    __slots__ = ('name', 'tasks')
+
     def __init__(self, name, tasks=None):
         self.name = name
         self.tasks = tasks
@@ -248,43 +1636,51 @@ class Section(object):
             self.tasks = []
 
     @staticmethod
-    def create_sections(project_tasks_json, task_comments):
+    @instrumented('create_sections')
+    def create_sections(
+            project_tasks_json, task_comments, section_filters=None,
+            task_filters=None, on_task=None):
         '''Creates sections from task and story JSON from Asana's API.
 
-        :param project_tasks_json: The JSON object for a Project's tasks in
-        Asana
+        Tasks outside the section filters, or that don't match the tag
+        filters, are skipped before a Task is ever made of them, and sections
+        left without tasks are never returned, so the sections need no
+        further filtering.
+
+        :param project_tasks_json: The JSON objects for a Project's tasks in
+        Asana, as any iterable (such as a stream of tasks from AsanaAPI)
         :param task_last_comments: The last comments (stories) for all of the
         tasks in the tasks JSON
+        :param section_filters: A set of the sections to keep tasks from
+        :param task_filters: A set of tags that kept tasks must all have, or a
+        TagExpression that they must match
+        :param on_task: An optional function called with each kept Task and
+        its JSON, as soon as the Task is made
         '''
+        tag_filter = TagExpression.coerce(task_filters)
         sections = []
         misc_section = Section(u'Misc:')
         current_section = misc_section
+        keep_section = (
+            not section_filters or current_section.name in section_filters)
         for task in project_tasks_json:
             if task[u'name'].endswith(':'):
                 if current_section.tasks and current_section.name != u'Misc:':
                     sections.append(current_section)
-                current_section = Section(task[u'name'])
-            else:
-                name = task[u'name']
-                if task[u'assignee']:
-                    assignee = task[u'assignee'][u'name']
-                else:
-                    assignee = None
-                task_id = unicode(task[u'id'])
-                completed = task[u'completed']
-                if completed:
-                    completion_time = dateutil.parser.parse(
-                        task[u'completed_at'])
-                else:
-                    completion_time = None
-                description = task[u'notes'] if task[u'notes'] else None
-                due_date = task[u'due_on']
-                tags = [tag[u'name'] for tag in task[u'tags']]
-                current_task_comments = task_comments.get(task_id)
-                current_task = Task(
-                    name, assignee, completed, completion_time, description,
-                    due_date, tags, current_task_comments)
-                current_section.add_task(current_task)
+                current_section = Section(intern_string(task[u'name']))
+                keep_section = (
+                    not section_filters or
+                    current_section.name in section_filters)
+            elif keep_section:
+                if tag_filter is not None and not tag_filter.matches(
+                        frozenset(
+                            tag[u'name'] for tag in task.get(u'tags', ()))):
+                    continue
+                task_object = Task.from_json(
+                    task, task_comments.get(unicode(task[u'id'])))
+                current_section.add_task(task_object)
+                if on_task is not None:
+                    on_task(task_object, task)
         if current_section.tasks:
             sections.append(current_section)
         if misc_section.tasks and current_section != misc_section:
@@ -311,9 +1707,14 @@ class Section(object):
 class Task(object):
     '''A class representing an Asana Task.'''
 
+    __slots__ = (
+        'id', 'name', 'assignee', 'completed', '_completion_time',
+        '_completed_at', 'description', 'due_date', 'tags', 'comments')
+
     def __init__(
             self, name, assignee, completed, completion_time, description,
-            due_date, tags, comments):
+            due_date, tags, comments, id=None):
+        self.id = id
         self.name = name
         self.assignee = assignee
         self.completed = completed
@@ -323,10 +1724,599 @@ class Task(object):
         self.tags = tags
         self.comments = comments
 
-    def tags_in(self, tag_filter_set):
-        '''Determines if a Tasks's tags are within a set of tag filters'''
-        task_tag_set = frozenset(self.tags)
-        return task_tag_set >= tag_filter_set
+    @classmethod
+    def from_json(cls, task_json, comments=None):
+        '''Creates a Task from its JSON from Asana's API.
+
+        The completion time is only parsed if it's used. Assignee names, tag
+        names and due dates repeat across a project, so they're interned.
+
+        :param task_json: The task's JSON object, where fields that weren't
+        requested from Asana are missing
+        :param comments: The task's comments, as story JSON or Comments
+        :return: The new Task
+        '''
+        if task_json.get(u'assignee'):
+            assignee = intern_string(task_json[u'assignee'][u'name'])
+        else:
+            assignee = None
+        completed = task_json.get(u'completed', False)
+        if comments:
+            comments = Comment.from_stories(comments)
+        task = cls(
+            task_json[u'name'], assignee, completed, None,
+            task_json.get(u'notes') or None,
+            intern_string(task_json.get(u'due_on')),
+            [intern_string(tag[u'name'])
+             for tag in task_json.get(u'tags', ())],
+            comments, id=None if task_json[u'id'] is None else unicode(
+                task_json[u'id']))
+        if completed:
+            task._completed_at = task_json.get(u'completed_at')
+        return task
+
+    def to_json(self):
+        '''Returns the task as JSON in the form from_json takes.
+
+        Comments are included as their stories, under "comments".
+        '''
+        if self._completed_at:
+            completed_at = self._completed_at
+        elif self._completion_time is not None:
+            completed_at = self._completion_time.isoformat()
+        else:
+            completed_at = None
+        return {
+            u'id': self.id,
+            u'name': self.name,
+            u'assignee': {u'name': self.assignee} if self.assignee else None,
+            u'completed': self.completed,
+            u'completed_at': completed_at,
+            u'notes': self.description,
+            u'due_on': self.due_date,
+            u'tags': [{u'name': tag} for tag in self.tags],
+            u'comments': [
+                comment.to_story() for comment in self.comments
+            ] if self.comments else None,
+        }
+
+    @property
+    def completion_time(self):
+        '''When the task was completed, or None.'''
+        if self._completed_at:
+            self._completion_time = parse_datetime(self._completed_at)
+            self._completed_at = None
+        return self._completion_time
+
+    @completion_time.setter
+    def completion_time(self, completion_time):
+        self._completion_time = completion_time
+        self._completed_at = None
+
+
+class Comment(object):
+    '''A comment on an Asana Task.
+
+    The comment's time is parsed once, when it's made from its story, so
+    that filters can compare comment times without parsing them again. The
+    author is shared between every comment by the same user.
+    '''
+
+    __slots__ = ('text', 'created_at', 'created_by', 'created_time')
+
+    def __init__(self, text, created_at, created_by):
+        self.text = text
+        self.created_at = created_at
+        self.created_by = created_by
+        if created_at:
+            self.created_time = parse_datetime(created_at)
+        else:
+            self.created_time = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Comment):
+            return NotImplemented
+        return (self.text, self.created_at, self.created_by) == (
+            other.text, other.created_at, other.created_by)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'Comment({0!r}, {1!r}, {2!r})'.format(
+            self.text, self.created_at, self.created_by)
+
+    def to_story(self):
+        '''Returns the comment as the story JSON it's made from.'''
+        return {
+            u'type': u'comment',
+            u'text': self.text,
+            u'created_at': self.created_at,
+            u'created_by': self.created_by,
+        }
+
+    @classmethod
+    def from_stories(cls, stories):
+        '''Makes Comments from story JSON from Asana's API.
+
+        Fields that weren't requested from Asana are None. Stories that are
+        already Comments are kept as they are.
+
+        :param stories: The stories of a task that are comments, in the
+        chronological order Asana returns them
+        :return: A list of Comments
+        '''
+        return [
+            story if isinstance(story, cls) else cls(
+                story.get(u'text'), story.get(u'created_at'),
+                intern_user(story.get(u'created_by')))
+            for story in stories]
+
+
+_interned_strings = {}
+_interned_users = {}
+
+
+def intern_string(value):
+    '''Returns the one shared copy of a string.
+
+    Unlike the intern builtin, this works for unicode strings. Interned
+    strings are kept for the life of the process.
+
+    :param value: The string to intern, or None
+    :return: An equal string, shared with every other caller
+    '''
+    if value is None:
+        return None
+    return _interned_strings.setdefault(value, value)
+
+
+def intern_user(user_json):
+    '''Returns the one shared copy of a user's JSON from Asana's API.
+
+    The returned dict is shared, so it must not be modified.
+
+    :param user_json: A user JSON object (such as a story's created_by), or
+    None
+    :return: An equal dict, shared with every other caller
+    '''
+    if not user_json:
+        return user_json
+    try:
+        key = frozenset(user_json.iteritems())
+    except TypeError:
+        # Users with nested fields aren't shared
+        return user_json
+    user = _interned_users.get(key)
+    if user is None:
+        user = _interned_users.setdefault(key, dict(
+            (intern_string(field), intern_string(value)
+             if isinstance(value, basestring) else value)
+            for field, value in user_json.iteritems()))
+    return user
+
+
+class TagExpression(object):
+    '''A boolean expression of tags that tasks are filtered on.
+
+    Expressions combine tags with AND, OR and NOT and parentheses, where NOT
+    binds tightest and OR loosest, such as "urgent AND NOT (blocked OR
+    later)". Tags with spaces, parentheses or quotes in them, or that are
+    one of the operators, can be quoted with double or single quotes.
+
+    An expression can be matched against one task's tags, or evaluated
+    against a TagIndex of many tasks at once.
+    '''
+
+    __slots__ = ('op', 'operands')
+
+    _token = re.compile(
+        r'\s*(?:(\()|(\))|"([^"]*)"|\'([^\']*)\'|([^\s()"\']+))')
+    _operators = ('AND', 'OR', 'NOT')
+
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = tuple(operands)
+
+    @classmethod
+    def tag(cls, tag):
+        '''An expression matching tasks with a tag.'''
+        return cls('tag', (tag,))
+
+    @classmethod
+    def all_of(cls, tags):
+        '''An expression matching tasks with every one of a set of tags.
+
+        :param tags: The tags, as any iterable
+        :return: The TagExpression, or None if there are no tags
+        '''
+        expression = None
+        for tag in sorted(set(tags)):
+            expression = cls.tag(tag) if expression is None else cls(
+                'and', (expression, cls.tag(tag)))
+        return expression
+
+    @classmethod
+    def coerce(cls, task_filters):
+        '''Returns task_filters as a TagExpression (or None for no filter).
+
+        A collection of tags, as given to -f, means tasks with all of them.
+        '''
+        if not task_filters or isinstance(task_filters, cls):
+            return task_filters or None
+        return cls.all_of(task_filters)
+
+    @classmethod
+    def parse(cls, text):
+        '''Parses an expression, as given to --filter-expr.
+
+        :param text: The expression's text
+        :return: The TagExpression
+        :raises ValueError: If the expression isn't valid
+        '''
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = cls._token.match(text, position)
+            if match is None:
+                raise ValueError(
+                    'Unterminated quote in tag expression: {0}'.format(text))
+            position = match.end()
+            opening, closing, double, single, word = match.groups()
+            if opening or closing:
+                tokens.append((opening or closing, None))
+            elif word is not None and word in cls._operators:
+                tokens.append((word, None))
+            else:
+                tag = word if word is not None else (
+                    double if double is not None else single)
+                tokens.append(('tag', unicode(tag)))
+        tokens.reverse()
+        expression = cls._parse_or(tokens)
+        if tokens:
+            raise ValueError('Unexpected {0} in tag expression: {1}'.format(
+                tokens[-1][1] or tokens[-1][0], text))
+        return expression
+
+    @classmethod
+    def _parse_or(cls, tokens):
+        expression = cls._parse_and(tokens)
+        while tokens and tokens[-1][0] == 'OR':
+            tokens.pop()
+            expression = cls('or', (expression, cls._parse_and(tokens)))
+        return expression
+
+    @classmethod
+    def _parse_and(cls, tokens):
+        expression = cls._parse_not(tokens)
+        while tokens and tokens[-1][0] == 'AND':
+            tokens.pop()
+            expression = cls('and', (expression, cls._parse_not(tokens)))
+        return expression
+
+    @classmethod
+    def _parse_not(cls, tokens):
+        if not tokens:
+            raise ValueError('Tag expression ends early')
+        kind, value = tokens.pop()
+        if kind == 'NOT':
+            return cls('not', (cls._parse_not(tokens),))
+        elif kind == 'tag':
+            return cls.tag(value)
+        elif kind == '(':
+            expression = cls._parse_or(tokens)
+            if not tokens or tokens.pop()[0] != ')':
+                raise ValueError('Unclosed parenthesis in tag expression')
+            return expression
+        raise ValueError('Unexpected {0} in tag expression'.format(kind))
+
+    def matches(self, tag_names):
+        '''Whether a task with the given set of tags matches.'''
+        if self.op == 'tag':
+            return self.operands[0] in tag_names
+        elif self.op == 'and':
+            return all(
+                operand.matches(tag_names) for operand in self.operands)
+        elif self.op == 'or':
+            return any(
+                operand.matches(tag_names) for operand in self.operands)
+        return not self.operands[0].matches(tag_names)
+
+    def select(self, index):
+        '''Returns the positions of the tasks in a TagIndex that match.'''
+        if self.op == 'tag':
+            return index.positions(self.operands[0])
+        selected = [operand.select(index) for operand in self.operands]
+        if self.op == 'and':
+            return frozenset.intersection(*selected)
+        elif self.op == 'or':
+            return frozenset.union(*selected)
+        return index.all_positions - selected[0]
+
+    @classmethod
+    def any_of(cls, task_filters):
+        '''A filter matching tasks that match any one of several filters.
+
+        :param task_filters: The filters, each as coerce takes them
+        :return: The TagExpression, or None if any of the filters keeps every
+        task
+        '''
+        expression = None
+        for task_filter in task_filters:
+            task_filter = cls.coerce(task_filter)
+            if task_filter is None:
+                return None
+            expression = task_filter if expression is None else cls(
+                'or', (expression, task_filter))
+        return expression
+
+    def tags(self):
+        '''The set of tags the expression refers to.'''
+        if self.op == 'tag':
+            return frozenset(self.operands)
+        return frozenset.union(
+            *[operand.tags() for operand in self.operands])
+
+    def __eq__(self, other):
+        if not isinstance(other, TagExpression):
+            return NotImplemented
+        return (self.op, self.operands) == (other.op, other.operands)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.op, self.operands))
+
+    def __unicode__(self):
+        if self.op == 'tag':
+            tag = self.operands[0]
+            match = self._token.match(tag)
+            if (tag in self._operators or match is None or
+                    match.group(5) != tag):
+                return u"'{0}'".format(tag) if u'"' in tag else (
+                    u'"{0}"'.format(tag))
+            return tag
+        elif self.op == 'not':
+            return u'NOT {0}'.format(self._operand_text(self.operands[0]))
+        return u' {0} '.format(self.op.upper()).join(
+            self._operand_text(operand) for operand in self.operands)
+
+    def _operand_text(self, operand):
+        if operand.op in ('tag', 'not') or operand.op == self.op:
+            return unicode(operand)
+        return u'({0})'.format(operand)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __repr__(self):
+        return 'TagExpression.parse({0!r})'.format(unicode(self))
+
+
+class TagIndex(object):
+    '''An inverted index from tags to the tasks that have them.
+
+    Tasks are numbered by their position, and each tag maps to the set of
+    positions of its tasks, so a TagExpression is evaluated with set
+    operations rather than by checking every task.
+
+    :param tasks: The tasks to index, as any iterable
+    '''
+
+    def __init__(self, tasks):
+        positions = {}
+        count = 0
+        for count, task in enumerate(tasks, 1):
+            for tag in task.tags:
+                positions.setdefault(tag, set()).add(count - 1)
+        self._positions = dict(
+            (tag, frozenset(tag_positions))
+            for tag, tag_positions in positions.iteritems())
+        self.all_positions = frozenset(xrange(count))
+
+    def positions(self, tag):
+        '''The positions of the tasks with a tag.'''
+        return self._positions.get(tag, frozenset())
+
+
+def story_params(fields):
+    '''The query parameters that request only some fields of stories.
+
+    :param fields: The story fields to request, or None for all of them
+    '''
+    if fields is None:
+        return None
+    return {'opt_fields': ','.join(sorted(set(fields) | set(['type'])))}
+
+
+@instrumented('fetch_comments')
+def get_task_comments(asana, task_id, fields=None):
+    '''Retrieves the comments for a task, in the order Asana returns them.
+
+    :param asana: The initialized Asana object that makes API calls
+    :param task_id: The id of the task to retrieve comments for
+    :param fields: The story fields to request, or None for all of them
+    :return: A list of the task's stories that are comments
+    '''
+    log.info('Getting task comments for task: {0}'.format(task_id))
+    params = story_params(fields)
+    if params is not None:
+        task_stories = asana.get(
+            'task_stories', {'task_id': task_id}, params=params)
+    else:
+        task_stories = asana.get('task_stories', {'task_id': task_id})
+    return [story for story in task_stories if story[u'type'] == u'comment']
+
+
+@instrumented('fetch_comments')
+def get_batch_task_comments(asana, task_ids, fields=None):
+    '''Retrieves the comments for several tasks through one batched call.
+
+    Tasks whose batched action failed are retried on their own, so that a
+    single failure doesn't fail the rest of the batch.
+
+    :param asana: The initialized Asana object that makes API calls
+    :param task_ids: The ids of up to AsanaAPI.batch_limit tasks
+    :param fields: The story fields to request, or None for all of them
+    :return: A list of the comments of each task, in the order of task_ids
+    '''
+    log.info('Getting task comments for tasks: {0}'.format(
+        ', '.join(task_ids)))
+    params = story_params(fields)
+    all_task_stories = asana.get_batch([
+        ('task_stories', {'task_id': task_id}, params)
+        for task_id in task_ids])
+    all_task_comments = []
+    for task_id, task_stories in zip(task_ids, all_task_stories):
+        if isinstance(task_stories, Exception):
+            log.warning('Batched call failed ({0}), retrying alone'.format(
+                task_stories))
+            all_task_comments.append(
+                get_task_comments(asana, task_id, fields))
+        else:
+            all_task_comments.append([
+                story for story in task_stories
+                if story[u'type'] == u'comment'])
+    return all_task_comments
+
+
+class TemplateFields(object):
+    '''The Asana fields that a set of templates make use of.
+
+    Templates are analyzed (along with the templates they extend or include)
+    for the attributes they access on tasks and comments, which are mapped to
+    the Asana fields that populate them. Any fields not in the analysis can be
+    left out of requests to Asana.
+
+    :param task_fields: The set of task fields to request
+    :param story_fields: The set of story fields to request for comments, or
+    None if the templates never use comments
+    '''
+
+    # The Asana fields behind each Task attribute
+    task_attribute_fields = {
+        'id': (),
+        'name': ('name',),
+        'assignee': ('assignee.name',),
+        'completed': ('completed',),
+        'completion_time': ('completed', 'completed_at'),
+        'description': ('notes',),
+        'due_date': ('due_on',),
+        'tags': ('tags.name',),
+        'comments': (),
+    }
+    # Filters that read comment fields themselves
+    comment_filter_fields = {
+        'comments_within_lookback': ('created_at',),
+    }
+
+    def __init__(self, task_fields, story_fields):
+        self.task_fields = frozenset(task_fields)
+        if story_fields is not None:
+            story_fields = frozenset(story_fields)
+        self.story_fields = story_fields
+
+    @property
+    def comments(self):
+        '''Whether the templates use task comments at all.'''
+        return self.story_fields is not None
+
+    @classmethod
+    def from_templates(cls, template_names, env=None):
+        '''Analyzes templates for the Asana fields they use.
+
+        A template that uses a task or comment in a way the analysis can't
+        follow (such as passing it whole to a macro) could use any field.
+
+        :param template_names: The filenames of the templates to analyze
+        :param env: The Jinja2 Environment to load templates from
+        :return: The TemplateFields, or None if any field could be used
+        '''
+        if env is None:
+            env = Environment(loader=FileSystemLoader('templates'))
+        template_asts = []
+        pending = list(template_names)
+        seen = set()
+        while pending:
+            template_name = pending.pop()
+            if template_name in seen:
+                continue
+            seen.add(template_name)
+            source = env.loader.get_source(env, template_name)[0]
+            template_ast = env.parse(source)
+            template_asts.append(template_ast)
+            for referenced in meta.find_referenced_templates(template_ast):
+                if referenced is None:
+                    # Dynamically chosen templates can't be analyzed
+                    return None
+                pending.append(referenced)
+
+        task_names = set(['task'])
+        comment_names = set(['comment'])
+        for template_ast in template_asts:
+            for loop in template_ast.find_all(nodes.For):
+                targets = set(_node_names(loop.target))
+                loop_attrs = set(
+                    node.attr for node in _find_all(loop.iter, nodes.Getattr))
+                if 'tasks' in loop_attrs:
+                    task_names.update(targets)
+                elif 'comments' in loop_attrs:
+                    comment_names.update(targets)
+
+        task_attrs = set()
+        comment_attrs = set()
+        uses_comments = False
+        for template_ast in template_asts:
+            getattrs = list(template_ast.find_all(nodes.Getattr))
+            inner = set(id(node.node) for node in getattrs)
+            for name in template_ast.find_all(nodes.Name):
+                if (name.ctx == 'load' and id(name) not in inner and
+                        name.name in (task_names | comment_names)):
+                    return None
+            for node in getattrs:
+                if id(node) in inner:
+                    continue
+                root, path = _attribute_path(node)
+                if root in task_names:
+                    if path[0] not in cls.task_attribute_fields:
+                        return None
+                    task_attrs.add(path[0])
+                    uses_comments = uses_comments or path[0] == 'comments'
+                elif root in comment_names:
+                    comment_attrs.add('.'.join(path))
+            for node in template_ast.find_all(nodes.Filter):
+                comment_attrs.update(
+                    cls.comment_filter_fields.get(node.name, ()))
+
+        task_fields = set()
+        for attr in task_attrs:
+            task_fields.update(cls.task_attribute_fields[attr])
+        return cls(task_fields, comment_attrs if uses_comments else None)
+
+
+def _find_all(node, node_type):
+    if isinstance(node, node_type):
+        yield node
+    for child in node.find_all(node_type):
+        yield child
+
+
+def _node_names(node):
+    return [name.name for name in _find_all(node, nodes.Name)]
+
+
+def _attribute_path(node):
+    path = []
+    while isinstance(node, nodes.Getattr):
+        path.insert(0, node.attr)
+        node = node.node
+    if isinstance(node, nodes.Name):
+        return node.name, path
+    return None, path
 
 
 # Filters
@@ -350,28 +2340,461 @@ def most_recent_comments(task_comments, num_comments):
 
 
 def comments_within_lookback(task_comments, current_time_utc, hours):
-    filtered_comments = []
-    for comment in task_comments:
-        comment_time = dateutil.parser.parse(comment[u'created_at'])
-        delta = current_time_utc - comment_time
-        if delta < datetime.timedelta(hours=hours):
-            filtered_comments.append(comment)
-    if not filtered_comments and task_comments:
-        filtered_comments.append(task_comments[-1])
-    return filtered_comments
+    '''Filters comments to those made in the past hours, or else the last.
+
+    Comments are in chronological order, so the first comment in the
+    lookback is found by binary search, and comments before it are never
+    looked at.
+    '''
+    since = current_time_utc - datetime.timedelta(hours=hours)
+    low, high = 0, len(task_comments)
+    while low < high:
+        middle = (low + high) // 2
+        if _comment_time(task_comments[middle]) > since:
+            high = middle
+        else:
+            low = middle + 1
+    return task_comments[low:] or task_comments[-1:]
+
+
+def _comment_time(comment):
+    if isinstance(comment, Comment):
+        return comment.created_time
+    return parse_datetime(comment[u'created_at'])
 
 
 def as_date(datetime_str):
     try:
-        parsed_date = dateutil.parser.parse(datetime_str).date().isoformat()
+        parsed_date = parse_datetime(datetime_str).date().isoformat()
     except:
         return datetime_str
     else:
         return parsed_date
 
 
+_iso_datetime = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6})\d*)?)?'
+    r'(Z|[+-]\d{2}(?::?\d{2})?)?)?$')
+_utc = dateutil.tz.tzutc()
+_parsed_datetimes = {}
+# The number of parsed timestamps to remember before starting over
+max_parsed_datetimes = 100000
+
+
+def parse_datetime(datetime_str):
+    '''Parses a timestamp from Asana, which are always ISO-8601.
+
+    Strict ISO-8601 is parsed directly, and anything else is left to
+    dateutil. Results are memoized, as the same timestamps are parsed on
+    every render.
+
+    :param datetime_str: The timestamp to parse
+    :return: The parsed datetime, which is naive if the timestamp has no
+    timezone
+    '''
+    parsed = _parsed_datetimes.get(datetime_str)
+    if parsed is None:
+        parsed = _parse_iso_datetime(datetime_str)
+        if parsed is None:
+            parsed = dateutil.parser.parse(datetime_str)
+        if len(_parsed_datetimes) >= max_parsed_datetimes:
+            _parsed_datetimes.clear()
+        _parsed_datetimes[datetime_str] = parsed
+    return parsed
+
+
+def _parse_iso_datetime(datetime_str):
+    match = _iso_datetime.match(datetime_str)
+    if match is None:
+        return None
+    (year, month, day, hour, minute, second, fraction,
+     offset) = match.groups()
+    if offset is None:
+        tzinfo = None
+    elif offset == 'Z':
+        tzinfo = _utc
+    else:
+        offset_seconds = int(offset[1:3]) * 3600
+        if len(offset) > 3:
+            offset_seconds += int(offset[-2:]) * 60
+        if offset[0] == '-':
+            offset_seconds = -offset_seconds
+        if offset_seconds:
+            tzinfo = dateutil.tz.tzoffset(None, offset_seconds)
+        else:
+            tzinfo = _utc
+    try:
+        return datetime.datetime(
+            int(year), int(month), int(day), int(hour or 0),
+            int(minute or 0), int(second or 0),
+            int(fraction.ljust(6, '0')) if fraction else 0, tzinfo)
+    except ValueError:
+        return None
+
+
+class CSSInliner(object):
+    '''Inlines the CSS in rendered HTML, as premailer.transform does.
+
+    premailer parses the stylesheet, compiles every selector and parses every
+    style it merges on each call, though a template's stylesheet is the same
+    every time it's rendered. Here the parsed rules are cached by the hash of
+    their stylesheet, and compiled selectors and merged styles are cached
+    too, so only matching selectors against the document is left to do for
+    each render. The output is the same as premailer.transform's.
+    '''
+
+    # The number of merged styles to cache before starting over
+    max_merged_styles = 10000
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    _important = re.compile(r'\s*!important')
+
+    def __init__(self):
+        self._premailer = premailer.Premailer(None)
+        self._stylesheets = {}
+        self._merged_styles = {}
+        self._lock = threading.Lock()
+        # lxml's compiled selectors aren't safe to share between threads
+        self._local = threading.local()
+
+    @classmethod
+    def shared(cls):
+        '''The inliner shared by every render in the process.'''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @instrumented('inline_css')
+    def transform(self, html):
+        '''Moves the CSS in an HTML document's stylesheets to style attributes.
+
+        :param html: The HTML document
+        :return: The HTML document with its CSS inlined
+        '''
+        stripped = html.strip()
+        tree = etree.fromstring(stripped, etree.HTMLParser()).getroottree()
+        page = tree.getroot()
+        # lxml inserts a doctype if there isn't one, so only keep it if the
+        # document had one to begin with
+        root = tree if stripped.startswith(tree.docinfo.doctype) else page
+
+        rules = []
+        index = 0
+        for element in self._selector('style,link[rel~=stylesheet]')(page):
+            media = element.attrib.get('media')
+            if media and media != 'screen':
+                continue
+            if element.tag != 'style':
+                # Loading external stylesheets is left to premailer
+                return premailer.transform(html)
+            stylesheet_rules, leftover_css = self._stylesheet(
+                element.text, index)
+            index += 1
+            rules.extend(stylesheet_rules)
+            if leftover_css is not None:
+                element.text = leftover_css
+            else:
+                element.getparent().remove(element)
+        rules.sort(key=operator.itemgetter(0))
+
+        styled = set()
+        original_styles = []
+        class_ = ''
+        for _, selector, class_, style in rules:
+            for element in self._selector(selector)(page):
+                old_style = element.attrib.get('style', '')
+                if element not in styled:
+                    styled.add(element)
+                    original_styles.append((element, old_style))
+                self._set_style(
+                    element, self._merge_styles(old_style, style, class_))
+
+        # Styles that were already inline take precedence. Like premailer,
+        # this merges them under the pseudo-class of the last rule applied.
+        for element, inline_style in original_styles:
+            if inline_style:
+                self._set_style(element, self._merge_styles(
+                    element.attrib.get('style', ''), inline_style, class_))
+
+        for attribute in page.xpath('//@class'):
+            del attribute.getparent().attrib['class']
+
+        out = etree.tostring(
+            root, method='html', pretty_print=True, encoding='utf-8')
+        return type(self)._important.sub('', out.decode('utf-8'))
+
+    def _stylesheet(self, css_body, index):
+        '''Returns the parsed rules of a stylesheet, and the CSS to leave.'''
+        key = (hashlib.sha1((css_body or u'').encode('utf-8')).hexdigest(),
+               index)
+        with self._lock:
+            if key not in self._stylesheets:
+                # cssutils isn't thread safe, so this shares premailer's lock
+                with merge_styles._lock:
+                    parsed_rules, leftover = (
+                        self._premailer._parse_style_rules(css_body, index))
+                    if leftover:
+                        leftover_css = self._premailer._css_rules_to_string(
+                            leftover)
+                    else:
+                        leftover_css = None
+                rules = []
+                for specificity, selector, style in parsed_rules:
+                    class_ = ''
+                    if ':' in selector:
+                        element_selector, class_ = selector.split(':', 1)
+                        class_ = ':' + class_
+                        if class_ in FILTER_PSEUDOSELECTORS:
+                            # Keep filter-type selectors as they are
+                            class_ = ''
+                        else:
+                            selector = element_selector
+                    rules.append((specificity, selector, class_, style))
+                self._stylesheets[key] = (rules, leftover_css)
+            return self._stylesheets[key]
+
+    def _selector(self, selector):
+        selectors = getattr(self._local, 'selectors', None)
+        if selectors is None:
+            selectors = self._local.selectors = {}
+        if selector not in selectors:
+            selectors[selector] = CSSSelector(selector)
+        return selectors[selector]
+
+    def _merge_styles(self, old, new, class_):
+        key = (old, new, class_)
+        merged = self._merged_styles.get(key)
+        if merged is None:
+            merged = merge_styles(old, new, class_)
+            if len(self._merged_styles) >= type(self).max_merged_styles:
+                self._merged_styles.clear()
+            self._merged_styles[key] = merged
+        return merged
+
+    def _set_style(self, element, style):
+        element.attrib['style'] = style
+        self._premailer._style_to_basic_html_attributes(
+            element, style, force=True)
+
+
+class HTMLMinifier(object):
+    '''Shrinks rendered HTML before it's sent.
+
+    Whitespace that doesn't render is removed: runs of whitespace become one
+    space, and whitespace at the edges of block-level elements is dropped.
+    Text in pre, textarea, script and style elements, or in an element styled
+    white-space: pre (or pre-wrap, or pre-line), is left as it is. When the
+    CSS wasn't inlined, a stylesheet could do that to any element with a
+    class, so their text is left as it is too. Comments are removed, except
+    for conditional comments.
+
+    With dedupe_styles, style attributes repeated on many elements are moved
+    to classes in a stylesheet in the head. Mail clients that drop style
+    elements won't show those styles, so it's off by default. It's skipped
+    for documents that already have a stylesheet, whose rules could
+    otherwise override the moved styles.
+
+    :param dedupe_styles: Whether to move repeated styles to classes
+    '''
+
+    block_tags = frozenset((
+        'address', 'article', 'aside', 'base', 'blockquote', 'body',
+        'caption', 'dd', 'div', 'dl', 'dt', 'footer', 'form', 'h1', 'h2',
+        'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hr', 'html', 'li', 'link',
+        'meta', 'nav', 'ol', 'p', 'pre', 'script', 'section', 'style',
+        'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'title', 'tr', 'ul'))
+    preformatted_tags = frozenset(('pre', 'textarea', 'script', 'style'))
+
+    # Only ASCII whitespace collapses, not non-breaking spaces
+    _whitespace = re.compile(r'[ \t\n\r\f]+')
+    _preformatted_style = re.compile(r'white-space\s*:\s*pre', re.I)
+
+    def __init__(self, dedupe_styles=False):
+        self.dedupe_styles = dedupe_styles
+
+    @instrumented('minify_html')
+    def minify(self, html, styles_inlined=True):
+        '''Minifies an HTML document, logging and recording the bytes saved.
+
+        :param html: The HTML document
+        :param styles_inlined: Whether the document's CSS has been inlined
+        :return: The minified HTML document
+        '''
+        stripped = html.strip()
+        tree = etree.fromstring(stripped, etree.HTMLParser()).getroottree()
+        page = tree.getroot()
+        root = tree if stripped.startswith(tree.docinfo.doctype) else page
+
+        for comment in page.xpath('//comment()'):
+            if not (comment.text or '').startswith('[if'):
+                _remove_element(comment)
+        self._squeeze(page, False, styles_inlined)
+        if self.dedupe_styles:
+            self._dedupe_styles(page)
+
+        minified = etree.tostring(
+            root, method='html', encoding='utf-8').decode('utf-8')
+        before = len(html.encode('utf-8'))
+        after = len(minified.encode('utf-8'))
+        log.info('Minified HTML from {0} to {1} bytes, saving {2}'.format(
+            before, after, before - after))
+        Metrics.shared().record_size('minify_html', before, after)
+        return minified
+
+    def _is_block(self, element):
+        return element is not None and element.tag in self.block_tags
+
+    def _squeeze(self, element, preformatted, styles_inlined):
+        '''Removes the whitespace in an element that doesn't render.'''
+        preformatted = preformatted or (
+            element.tag in self.preformatted_tags or
+            self._preformatted_style.search(element.get('style', '')) or
+            (not styles_inlined and element.get('class')))
+        children = list(element)
+        block = self._is_block(element)
+        if not preformatted:
+            element.text = self._squeeze_text(
+                element.text, block,
+                self._is_block(children[0]) if children else block)
+        for index, child in enumerate(children):
+            if isinstance(child.tag, basestring):
+                self._squeeze(child, preformatted, styles_inlined)
+            if not preformatted:
+                following = children[index + 1] if (
+                    index + 1 < len(children)) else None
+                child.tail = self._squeeze_text(
+                    child.tail, self._is_block(child),
+                    self._is_block(following) if following is not None
+                    else block)
+
+    def _squeeze_text(self, text, after_block, before_block):
+        if not text:
+            return text
+        text = self._whitespace.sub(u' ', text)
+        if after_block:
+            text = text.lstrip(u' ')
+        if before_block:
+            text = text.rstrip(u' ')
+        return text or None
+
+    def _dedupe_styles(self, page):
+        '''Moves repeated style attributes to classes.'''
+        if page.xpath('//style|//link[@rel="stylesheet"]'):
+            log.info('Not moving styles, the HTML already has a stylesheet')
+            return
+        styled = page.xpath('//*[@style]')
+        uses = collections.Counter(
+            element.attrib['style'] for element in styled)
+        taken = set(
+            name for element in page.xpath('//*[@class]')
+            for name in element.attrib['class'].split())
+        class_names = {}
+        rules = []
+        number = 0
+        for style, count in sorted(
+                uses.iteritems(), key=lambda use: (-use[1], use[0])):
+            name = u's{0}'.format(number)
+            while name in taken:
+                number += 1
+                name = u's{0}'.format(number)
+            # Each use trades ' style="..."' for ' class="name"', and the
+            # style is written once in the stylesheet as '.name{...}'
+            if count * (len(style) - len(name)) <= len(style) + len(name) + 3:
+                continue
+            number += 1
+            class_names[style] = name
+            rules.append(u'.{0}{{{1}}}'.format(name, style))
+        if not rules:
+            return
+        for element in styled:
+            name = class_names.get(element.attrib['style'])
+            if name is not None:
+                del element.attrib['style']
+                classes = element.get('class')
+                element.set(
+                    'class', u'{0} {1}'.format(classes, name)
+                    if classes else name)
+        head = page.find('head')
+        if head is None:
+            head = etree.Element('head')
+            page.insert(0, head)
+        stylesheet = etree.SubElement(head, 'style', type='text/css')
+        stylesheet.text = u''.join(rules)
+
+
+def _remove_element(element):
+    '''Removes an element from its parent, keeping the text that follows.'''
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+
+def create_template_environments(bytecode_cache_dir=None):
+    '''Creates the Jinja2 Environments that templates are rendered in.
+
+    HTML templates are rendered with autoescaping, and text templates without,
+    so each gets its own Environment. A pair can be shared by any number of
+    renders, including concurrent ones.
+
+    :param bytecode_cache_dir: A directory to cache compiled templates in, so
+    later processes can skip parsing and compiling them
+    :return: A tuple of the HTML and text Environments
+    '''
+    environments = []
+    for autoescape in (True, False):
+        if bytecode_cache_dir is not None:
+            # Autoescaping changes the compiled code, so each Environment
+            # keeps its own cache files
+            bytecode_cache = FileSystemBytecodeCache(
+                bytecode_cache_dir, 'asana_mailer_{0}_%s.cache'.format(
+                    'html' if autoescape else 'text'))
+        else:
+            bytecode_cache = None
+        env = Environment(
+            loader=FileSystemLoader('templates'), trim_blocks=True,
+            lstrip_blocks=True, autoescape=autoescape,
+            bytecode_cache=bytecode_cache)
+        env.filters['last_comment'] = last_comment
+        env.filters['most_recent_comments'] = most_recent_comments
+        env.filters['comments_within_lookback'] = comments_within_lookback
+        env.filters['as_date'] = as_date
+        environments.append(env)
+    return tuple(environments)
+
+
+_template_environments = {}
+_template_environments_lock = threading.Lock()
+
+
+def template_environments(bytecode_cache_dir=None):
+    '''Returns the process-wide template Environments.
+
+    The Environments are created on first use and kept, so templates are only
+    loaded and compiled once per process, however many renders there are.
+
+    :param bytecode_cache_dir: A directory to cache compiled templates in, as
+    for create_template_environments
+    :return: A tuple of the HTML and text Environments
+    '''
+    with _template_environments_lock:
+        environments = _template_environments.get(bytecode_cache_dir)
+        if environments is None:
+            environments = create_template_environments(bytecode_cache_dir)
+            _template_environments[bytecode_cache_dir] = environments
+        return environments
+
+
 def generate_templates(
-        project, html_template, text_template, current_date, current_time_utc, skip_inline_css=False):
+        project, html_template, text_template, current_date, current_time_utc,
+        skip_inline_css=False, environments=None, minifier=None):
     '''Generates the templates using Jinja2 templates
 
     :param html_template: The filename of the HTML template in the templates
@@ -379,40 +2802,104 @@ def generate_templates(
     :param text_template: The filename of the text template in the templates
     folder
     :param current_date: The current date.
+    :param environments: The HTML and text Environments to render in, as
+    returned by create_template_environments (default: the process-wide pair)
+    :param minifier: An HTMLMinifier to shrink the HTML with, after its CSS
+    is inlined
     '''
-    env = Environment(
-        loader=FileSystemLoader('templates'), trim_blocks=True,
-        lstrip_blocks=True, autoescape=True)
-
-    env.filters['last_comment'] = last_comment
-    env.filters['most_recent_comments'] = most_recent_comments
-    env.filters['comments_within_lookback'] = comments_within_lookback
-    env.filters['as_date'] = as_date
+    if environments is None:
+        environments = template_environments()
+    html_env, text_env = environments
 
+    metrics = Metrics.shared()
     log.info('Rendering HTML Template')
-    html = env.get_template(html_template)
-    if skip_inline_css:
+    with metrics.phase('render:{0}'.format(html_template)):
+        html = html_env.get_template(html_template)
         rendered_html = html.render(
             project=project, current_date=current_date,
             current_time_utc=current_time_utc)
-    else:
-        rendered_html = premailer.transform(html.render(
-            project=project, current_date=current_date,
-            current_time_utc=current_time_utc))
+    if not skip_inline_css:
+        rendered_html = CSSInliner.shared().transform(rendered_html)
+    if minifier is not None:
+        rendered_html = minifier.minify(
+            rendered_html, styles_inlined=not skip_inline_css)
 
     log.info('Rendering Text Template')
-    env.autoescape = False
-    plaintext = env.get_template(text_template)
-    rendered_plaintext = plaintext.render(
-        project=project, current_date=current_date,
-        current_time_utc=current_time_utc)
+    with metrics.phase('render:{0}'.format(text_template)):
+        plaintext = text_env.get_template(text_template)
+        rendered_plaintext = plaintext.render(
+            project=project, current_date=current_date,
+            current_time_utc=current_time_utc)
 
     return (rendered_html, rendered_plaintext)
 
 
+def stream_templates(
+        project, html_template, text_template, current_date, current_time_utc,
+        skip_inline_css=False, environments=None, buffer_size=None,
+        minifier=None):
+    '''Renders the templates lazily, as iterables of text chunks.
+
+    The templates are rendered as the chunks are consumed, so the full email
+    never has to be held in memory. Inlining CSS and minifying need the whole
+    HTML document though, so the HTML is rendered in one piece unless
+    skip_inline_css is set and there's no minifier.
+
+    :param buffer_size: The number of characters to gather into each chunk
+    (default: 64K)
+    :return: A tuple of the HTML and text chunk iterables, with the same
+    arguments otherwise as generate_templates
+    '''
+    if environments is None:
+        environments = template_environments()
+    html_env, text_env = environments
+    context = dict(
+        project=project, current_date=current_date,
+        current_time_utc=current_time_utc)
+
+    html = html_env.get_template(html_template)
+    if skip_inline_css and minifier is None:
+        html_chunks = buffer_chunks(html.generate(**context), buffer_size)
+    else:
+        html_chunks = _render_whole(
+            html, context, skip_inline_css, minifier)
+    plaintext = text_env.get_template(text_template)
+    text_chunks = buffer_chunks(plaintext.generate(**context), buffer_size)
+    return (html_chunks, text_chunks)
+
+
+def _render_whole(template, context, skip_inline_css, minifier):
+    rendered = template.render(**context)
+    if not skip_inline_css:
+        rendered = CSSInliner.shared().transform(rendered)
+    if minifier is not None:
+        rendered = minifier.minify(
+            rendered, styles_inlined=not skip_inline_css)
+    yield rendered
+
+
+def buffer_chunks(chunks, buffer_size=None):
+    '''Gathers small chunks of text into chunks of about buffer_size.'''
+    if buffer_size is None:
+        buffer_size = 64 * 1024
+    buffered = []
+    buffered_size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= buffer_size:
+            yield u''.join(buffered)
+            buffered = []
+            buffered_size = 0
+    if buffered:
+        yield u''.join(buffered)
+
+
+@instrumented('send_email')
 def send_email(
         project, mail_server, from_address, to_addresses, cc_addresses,
-        rendered_html, rendered_text, current_date, smtp_username=None, smtp_password=None, smtp_port=None):
+        rendered_html, rendered_text, current_date, smtp_username=None,
+        smtp_password=None, smtp_port=None, smtp_conn=None, transport=None):
     '''Sends an email using a Project and rendered templates.
 
     :param project: The Project instance for this email
@@ -420,12 +2907,18 @@ def send_email(
     :param from_address: The From: Address for the email to send
     :param to_addresses: The list of To: addresses for the email to be sent to
     :param cc_addresses: The list of Cc: addresses for the email to be sent to
-    :param rendered_html: The rendered HTML template
-    :param rendered_text: The rendered text template
+    :param rendered_html: The rendered HTML template, or an iterable of its
+    chunks (as from stream_templates) to stream to the server
+    :param rendered_text: The rendered text template, or an iterable of its
+    chunks
     :param current_date: The current date
     :param smtp_username: The username to authenticate to SMTP server with
     :param smtp_password: The password to authenticate to SMTP server with
     :param smtp_port: The port to connect to the SMTP server with
+    :param smtp_conn: An open SMTP connection to send with, which is left open
+    rather than connecting to mail_server
+    :param transport: A MailTransport to send with, instead of a connection
+    :return: Whether the email was sent
     '''
 
     to_address_str = ', '.join(to_addresses)
@@ -436,69 +2929,441 @@ def send_email(
 
     log.info('Preparing Email - From: ({0}) To: ({1}) Cc: ({2})'.format(
         from_address, to_address_str, cc_address_str))
+    if isinstance(rendered_text, basestring) and isinstance(
+            rendered_html, basestring):
+        message = create_message(
+            project, from_address, to_addresses, cc_addresses, current_date,
+            rendered_html, rendered_text)
+        message_lines = None
+    else:
+        message = create_message(
+            project, from_address, to_addresses, cc_addresses, current_date)
+        message_lines = stream_message(
+            message, [('plain', rendered_text), ('html', rendered_html)])
+
+    if cc_addresses:
+        to_addresses.extend(cc_addresses)
+
+    try:
+        if transport is not None:
+            log.info('Sending Email')
+            transport.send(
+                from_address, to_addresses,
+                message.as_string() if message_lines is None
+                else message_lines)
+            return True
+        if smtp_conn is None:
+            conn = connect_smtp(
+                mail_server, smtp_username, smtp_password, smtp_port)
+        else:
+            conn = smtp_conn
+        log.info('Sending Email')
+        if message_lines is None:
+            conn.sendmail(from_address, to_addresses, message.as_string())
+        else:
+            send_streamed_message(
+                conn, from_address, to_addresses, message_lines)
+        if smtp_conn is None:
+            conn.quit()
+    except smtplib.SMTPException:
+        log.exception('Email could not be sent!')
+        return False
+    return True
+
+
+def create_message(
+        project, from_address, to_addresses, cc_addresses, current_date,
+        rendered_html=None, rendered_text=None):
+    '''Creates the multipart/alternative message for a Project's email.
+
+    :param project: The Project instance for this email
+    :param from_address: The From: Address for the email
+    :param to_addresses: The list of To: addresses for the email
+    :param cc_addresses: The list of Cc: addresses for the email, or None
+    :param current_date: The current date
+    :param rendered_html: The rendered HTML template to attach, if any
+    :param rendered_text: The rendered text template to attach, if any
+    :return: The MIMEMultipart message, with the rendered templates attached
+    when both are given
+    '''
     message = MIMEMultipart('alternative')
     message['Subject'] = '{0} Daily Mailer {1}'.format(
         project.name, current_date)
     message['From'] = from_address
-    message['To'] = to_address_str
+    message['To'] = ', '.join(to_addresses)
     if cc_addresses:
-        message['Cc'] = cc_address_str
+        message['Cc'] = ', '.join(cc_addresses)
 
-    text_part = MIMEText(rendered_text.encode('utf-8'), 'plain')
-    html_part = MIMEText(rendered_html.encode('utf-8'), 'html')
+    if rendered_html is not None and rendered_text is not None:
+        text_part = MIMEText(rendered_text.encode('utf-8'), 'plain')
+        html_part = MIMEText(rendered_html.encode('utf-8'), 'html')
 
-    message.attach(text_part)
-    message.attach(html_part)
+        message.attach(text_part)
+        message.attach(html_part)
+    return message
 
-    if cc_addresses:
-        to_addresses.extend(cc_addresses)
 
+def stream_message(message, parts):
+    '''Generates an email message with text parts streamed from chunks.
+
+    The headers and MIME structure come from the email package, and each
+    part's text is encoded as base64 UTF-8 as its chunks are consumed.
+
+    :param message: The multipart message, with its headers set
+    :param parts: A list of (subtype, chunks) pairs, one for each text part
+    of the message
+    :return: An iterator of the message's data, as whole CRLF-ended lines
+    '''
+    placeholders = []
+    for subtype, _ in parts:
+        part = MIMENonMultipart('text', subtype, charset='utf-8')
+        part['Content-Transfer-Encoding'] = 'base64'
+        placeholder = uuid.uuid4().hex
+        part.set_payload(placeholder)
+        message.attach(part)
+        placeholders.append(placeholder)
+    skeleton = message.as_string()
+
+    for placeholder, (_, chunks) in zip(placeholders, parts):
+        before, skeleton = skeleton.split(placeholder, 1)
+        yield _crlf_lines(before)
+        for encoded in _base64_lines(chunks):
+            yield encoded
+    yield _crlf_lines(skeleton)
+
+
+def _crlf_lines(text):
+    return re.sub(r'\r?\n', '\r\n', text)
+
+
+def _base64_lines(chunks):
+    # base64 encodes 57 bytes to each full 76 character line
+    pending = ''
+    for chunk in chunks:
+        pending += chunk.encode('utf-8')
+        whole = len(pending) - len(pending) % 57
+        if whole:
+            yield _crlf_lines(base64.encodestring(pending[:whole]))
+            pending = pending[whole:]
+    if pending:
+        yield _crlf_lines(base64.encodestring(pending))
+
+
+def send_streamed_message(
+        conn, from_address, to_addresses, message_lines, pipelining=False):
+    '''Sends a message to an SMTP server as it's generated.
+
+    This is SMTP.sendmail, except that the message data is written to the
+    DATA stream as it comes rather than from one string. If the message
+    can't be generated in full, the connection is closed, since the server
+    can't be told to discard the message.
+
+    :param conn: The open SMTP connection
+    :param from_address: The envelope sender address
+    :param to_addresses: The list of envelope recipient addresses
+    :param message_lines: An iterable of the message's data, as whole
+    CRLF-ended lines, as from stream_message
+    :param pipelining: Whether to send the envelope commands together, which
+    the server must advertise support for (RFC 2920)
+    :return: A dict of the refused recipients, as from SMTP.sendmail
+    '''
+    conn.ehlo_or_helo_if_needed()
+    if pipelining:
+        replies = pipeline_envelope(conn, from_address, to_addresses)
+    else:
+        replies = None
+
+    def abort():
+        if replies and replies[-1][0] == 354:
+            # The pipelined DATA was accepted, and can't be taken back
+            conn.close()
+        else:
+            conn.rset()
+    code, response = replies.pop(0) if replies else conn.mail(from_address)
+    if code != 250:
+        abort()
+        raise smtplib.SMTPSenderRefused(code, response, from_address)
+    refused = {}
+    for to_address in to_addresses:
+        code, response = replies.pop(0) if replies else conn.rcpt(to_address)
+        if code not in (250, 251):
+            refused[to_address] = (code, response)
+    if len(refused) == len(to_addresses):
+        abort()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    if not replies:
+        conn.putcmd('data')
+    code, response = replies.pop(0) if replies else conn.getreply()
+    if code != 354:
+        conn.rset()
+        raise smtplib.SMTPDataError(code, response)
+    # The last chunk is held back to go out with the terminating dot, since
+    # a small write of its own would wait on the server's delayed ACK
+    pending = ''
     try:
-        if (smtp_username != None and smtp_password != None):
-            if not smtp_port:
-                smtp_port = 465
-            log.info('Connecting to authenticated SMTP Server: {0}'.format(mail_server))
-            smtp_conn = smtplib.SMTP_SSL(mail_server, port=smtp_port, timeout=300)
-            log.info('Logging in to Email')
-            smtp_conn.ehlo()
-            smtp_conn.login(smtp_username, smtp_password)
+        for data in message_lines:
+            if pending:
+                conn.send(pending)
+            # Lines starting with a dot are escaped by doubling it
+            pending = re.sub(r'(?m)^\.', '..', data)
+    except:
+        conn.close()
+        raise
+    conn.send(pending + '.\r\n')
+    code, response = conn.getreply()
+    if code != 250:
+        conn.rset()
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def pipeline_envelope(conn, from_address, to_addresses):
+    '''Sends a message's MAIL, RCPT and DATA commands in one write.
+
+    A server that advertises PIPELINING replies to each in turn, so a
+    message's envelope costs one round trip rather than one per command.
+
+    :param conn: The open SMTP connection
+    :param from_address: The envelope sender address
+    :param to_addresses: The list of envelope recipient addresses
+    :return: The list of (code, response) replies, one for each command
+    '''
+    commands = ['mail FROM:{0}'.format(smtplib.quoteaddr(from_address))]
+    commands.extend(
+        'rcpt TO:{0}'.format(smtplib.quoteaddr(to_address))
+        for to_address in to_addresses)
+    commands.append('data')
+    conn.send(''.join(command + smtplib.CRLF for command in commands))
+    return [conn.getreply() for _ in commands]
+
+
+def connect_smtp(
+        mail_server, smtp_username=None, smtp_password=None, smtp_port=None):
+    '''Connects to an SMTP server, logging in if credentials are given.
+
+    :param mail_server: The hostname of the SMTP server to send mail from
+    :param smtp_username: The username to authenticate to SMTP server with
+    :param smtp_password: The password to authenticate to SMTP server with
+    :param smtp_port: The port to connect to the SMTP server with
+    :return: The open SMTP connection
+    '''
+    if (smtp_username != None and smtp_password != None):
+        if not smtp_port:
+            smtp_port = 465
+        log.info('Connecting to authenticated SMTP Server: {0}'.format(
+            mail_server))
+        smtp_conn = smtplib.SMTP_SSL(
+            mail_server, port=smtp_port, timeout=300)
+        log.info('Logging in to Email')
+        smtp_conn.ehlo()
+        smtp_conn.login(smtp_username, smtp_password)
+    else:
+        log.info('Connecting to anonymous SMTP Server: {0}'.format(
+            mail_server))
+        smtp_conn = smtplib.SMTP(mail_server, timeout=300)
+    return smtp_conn
+
+
+class MailTransport(object):
+    '''Sends mail over a bounded pool of reused SMTP connections.
+
+    Connections are opened (and logged in to) as they're needed, up to
+    pool_size of them, and kept open between messages, so sending many
+    messages costs one connection and login per connection rather than per
+    message. Messages can be sent from several threads at once, each over
+    its own connection. When a server advertises PIPELINING, each message's
+    envelope is sent in one round trip.
+
+    A pooled connection that the server has since closed is replaced, and
+    the message is sent again over a new connection if it was a string, or
+    if none of its data had been read yet. Data is read only once the
+    server has accepted DATA, so a connection found closed during the
+    envelope never costs a streamed message.
+
+    :param mail_server: The hostname of the SMTP server to send mail from
+    :param smtp_username: The username to authenticate to SMTP server with
+    :param smtp_password: The password to authenticate to SMTP server with
+    :param smtp_port: The port to connect to the SMTP server with
+    :param pool_size: The most connections to have open at once
+    :param pipelining: Whether to pipeline when the server supports it
+    '''
+
+    def __init__(
+            self, mail_server, smtp_username=None, smtp_password=None,
+            smtp_port=None, pool_size=1, pipelining=True):
+        self.mail_server = mail_server
+        self.smtp_username = smtp_username
+        self.smtp_password = smtp_password
+        self.smtp_port = smtp_port
+        self.pool_size = pool_size
+        self.pipelining = pipelining
+        self.connects = 0
+        self.messages = 0
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._open >= self.pool_size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop(), True
+            self._open += 1
+            self.connects += 1
+        try:
+            return connect_smtp(
+                self.mail_server, self.smtp_username, self.smtp_password,
+                self.smtp_port), False
+        except:
+            self._discard(None)
+            raise
+
+    def _release(self, conn):
+        with self._condition:
+            if self._closed:
+                self._open -= 1
+            else:
+                self._idle.append(conn)
+            self._condition.notify()
+        if self._closed:
+            _quit_smtp(conn)
+
+    def _return(self, conn):
+        if conn.sock is None:
+            self._discard(conn)
         else:
-            log.info('Connecting to anonymous SMTP Server: {0}'.format(mail_server))
-            smtp_conn = smtplib.SMTP(mail_server, timeout=300)
-            log.info('Sending Email')
-        smtp_conn.sendmail(from_address, to_addresses, message.as_string())
-        smtp_conn.quit()
-    except smtplib.SMTPException:
-        log.exception('Email could not be sent!')
+            self._release(conn)
+
+    def _discard(self, conn):
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+        if conn is not None:
+            conn.close()
+
+    def send(self, from_address, to_addresses, message):
+        '''Sends a message over a pooled connection.
+
+        :param from_address: The envelope sender address
+        :param to_addresses: The list of envelope recipient addresses
+        :param message: The message as a string, or an iterable of its data
+        as whole CRLF-ended lines, as from stream_message
+        :return: A dict of the refused recipients, as from SMTP.sendmail
+        :raises SMTPException: If the message couldn't be sent
+        '''
+        if isinstance(message, basestring):
+            data = _crlf_lines(message)
+            if not data.endswith('\r\n'):
+                data += '\r\n'
+            message_lines = [data]
+        else:
+            message_lines = message
+        started = []
+
+        def read_lines():
+            started.append(True)
+            for data in message_lines:
+                yield data
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.ehlo_or_helo_if_needed()
+                refused = send_streamed_message(
+                    conn, from_address, to_addresses, read_lines(),
+                    pipelining=self.pipelining and conn.does_esmtp and
+                    conn.has_extn('pipelining'))
+            except smtplib.SMTPServerDisconnected:
+                self._discard(conn)
+                if reused and (
+                        isinstance(message, basestring) or not started):
+                    log.info('Pooled SMTP connection was closed, reconnecting')
+                    continue
+                raise
+            except (smtplib.SMTPResponseException,
+                    smtplib.SMTPRecipientsRefused):
+                # Refusals leave the connection usable, unless it was closed
+                self._return(conn)
+                raise
+            except:
+                self._discard(conn)
+                raise
+            self._return(conn)
+            with self._condition:
+                self.messages += 1
+            return refused
+
+    def close(self):
+        '''Quits every pooled connection.'''
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            _quit_smtp(conn)
+
+
+def _quit_smtp(conn):
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, socket.error):
+        conn.close()
 
 
-def write_rendered_files(rendered_html, rendered_text, current_date):
+def write_rendered_files(
+        rendered_html, rendered_text, current_date, project_id=None):
     '''Writes the rendered files out to disk.
 
-    Currently, this creates a AsanaMailer_[Date].html and *.markdown file.
+    Currently, this creates a AsanaMailer_[Date].html and *.markdown file, or
+    AsanaMailer_[Project ID]_[Date].* files when a project id is given.
 
-    :param rendered_html: The rendered HTML template.
-    :param rendered_text: The rendered text template.
+    :param rendered_html: The rendered HTML template, or an iterable of its
+    chunks (as from stream_templates) to write as they come.
+    :param rendered_text: The rendered text template, or an iterable of its
+    chunks.
     :param current_date: The current date.
+    :param project_id: The project id to distinguish the files by.
     '''
+    if project_id is not None:
+        basename = 'AsanaMailer_{0}_{1}'.format(project_id, current_date)
+    else:
+        basename = 'AsanaMailer_{0}'.format(current_date)
     with codecs.open(
-            'AsanaMailer_{0}.html'.format(current_date), 'w', 'utf-8') as (
-            html_file):
+            '{0}.html'.format(basename), 'w', 'utf-8') as html_file:
         log.info('Writing HTML File')
-        html_file.write(rendered_html)
+        _write_chunks(html_file, rendered_html)
     with codecs.open(
-            'AsanaMailer_{0}.markdown'.format(current_date), 'w', 'utf-8') as (
-            markdown_file):
+            '{0}.markdown'.format(basename), 'w', 'utf-8') as markdown_file:
         log.info('Writing Text File')
-        markdown_file.write(rendered_text)
+        _write_chunks(markdown_file, rendered_text)
+
+
+def _write_chunks(output_file, rendered):
+    if isinstance(rendered, basestring):
+        output_file.write(rendered)
+    else:
+        for chunk in rendered:
+            output_file.write(chunk)
 
 
 def create_cli_parser():
     parser = argparse.ArgumentParser(
         description='Generates an email template for an Asana project',
         fromfile_prefix_chars='@')
-    parser.add_argument('project_id', help='the asana project id')
-    parser.add_argument('api_key', help='your asana api key')
+    parser.add_argument(
+        'project_id', nargs='?', help='the asana project id')
+    parser.add_argument('api_key', nargs='?', help='your asana api key')
+    parser.add_argument(
+        '--config', metavar='FILE',
+        help='a JSON file describing several projects to mail in one run, '
+        'instead of a project id and api key; per-project options given '
+        'here apply to every project that does not set them')
+    parser.add_argument(
+        '--parallel-projects', type=int, default=4, metavar='N',
+        help='the number of projects from --config to process at once '
+        '(default: 4)')
     parser.add_argument(
         '-i', '--skip-inline-css',
         action='store_false', 
@@ -511,15 +3376,111 @@ def create_cli_parser():
     parser.add_argument(
         '-f', '--filter-tags', nargs='+', dest='tag_filters', default=[],
         metavar='TAG', help='tags to filter tasks on')
+    parser.add_argument(
+        '--filter-expr', metavar='EXPR',
+        help='a tag expression to filter tasks on, combining tags with AND, '
+        'OR, NOT and parentheses, such as "urgent AND NOT (blocked OR '
+        'later)"')
     parser.add_argument(
         '-s', '--filter-sections', nargs='+', dest='section_filters',
         default=[], metavar='SECTION', help='sections to filter tasks on')
+    parser.add_argument(
+        '--concurrency', type=int, default=1, metavar='N',
+        help='the maximum number of Asana API calls to make at once '
+        '(default: 1)')
+    parser.add_argument(
+        '--rate-limit', type=int, default=1500, metavar='CALLS',
+        help='the number of Asana API calls allowed per minute, or 0 for no '
+        'limit (default: 1500)')
+    parser.add_argument(
+        '--batch', action='store_true',
+        help="fetch task comments through Asana's batch API, {0} tasks per "
+        'call'.format(AsanaAPI.batch_limit))
+    parser.add_argument(
+        '--cache', metavar='PATH',
+        help='a file to cache Asana API responses in between runs')
+    parser.add_argument(
+        '--cache-ttl', type=int, default=0, metavar='SECONDS',
+        help='serve cached responses younger than this without revalidating '
+        'them with Asana (default: 0)')
+    parser.add_argument(
+        '--cache-max-mb', type=int, default=256, metavar='MB',
+        help='the maximum size of cached responses (default: 256)')
+    parser.add_argument(
+        '--state-db', metavar='PATH',
+        help='a file recording task comments between runs, so comments are '
+        'only fetched for modified tasks')
+    parser.add_argument(
+        '--state-max-age', type=int, metavar='HOURS',
+        help='refetch comments recorded more than this many hours ago, even '
+        'for unmodified tasks')
+    parser.add_argument(
+        '--template-cache', metavar='DIR',
+        help='a directory to cache compiled templates in between runs')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='render the email as it is written or sent, rather than '
+        'holding all of it in memory')
+    parser.add_argument(
+        '--metrics', metavar='FILE',
+        help='write a JSON summary of the time spent in each phase and the '
+        'API calls made to a file, or - for standard output')
+    parser.add_argument(
+        '--statsd', metavar='HOST[:PORT]',
+        help='send the same summary to a statsd server')
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help='profile the run with cProfile, writing its stats to a file')
     parser.add_argument(
         '--html-template', default='Default.html',
         help='a custom template to use for the html portion')
     parser.add_argument(
         '--text-template', default='Default.markdown',
         help='a custom template to use for the plaintext portion')
+    parser.add_argument(
+        '--minify-html', action='store_true',
+        help='remove whitespace and comments from the HTML that would not '
+        'show, after inlining CSS')
+    parser.add_argument(
+        '--dedupe-styles', action='store_true',
+        help='with --minify-html, move style attributes that repeat to '
+        'classes in a stylesheet, for mail clients that support style '
+        'elements')
+    parser.add_argument(
+        '--save-snapshot', metavar='FILE',
+        help='save the project, with its tasks and comments, to a snapshot '
+        'file to render again later')
+    parser.add_argument(
+        '--from-snapshot', metavar='FILE',
+        help='render from a snapshot file instead of calling Asana, applying '
+        'any filters again')
+    parser.add_argument(
+        '--api-url', metavar='URL',
+        help="the base URL of Asana's API, such as a local stand-in (default: "
+        '{0})'.format(AsanaAPI.asana_api_url))
+    cassette_group = parser.add_argument_group(
+        'record and replay', 'arguments for recording API calls and '
+        'replaying them offline')
+    cassette_group.add_argument(
+        '--record', metavar='FILE',
+        help='record every API call and its response to a cassette file')
+    cassette_group.add_argument(
+        '--replay', metavar='FILE',
+        help='answer API calls from a cassette file instead of Asana')
+    cassette_group.add_argument(
+        '--replay-latency', type=float, default=0, metavar='MS',
+        help='milliseconds to delay each replayed call by (default: 0)')
+    cassette_group.add_argument(
+        '--replay-jitter', type=float, default=0, metavar='MS',
+        help='the most milliseconds to randomly vary the latency by '
+        '(default: 0)')
+    cassette_group.add_argument(
+        '--replay-error-rate', type=float, default=0, metavar='RATE',
+        help='the fraction of replayed calls to fail (default: 0)')
+    cassette_group.add_argument(
+        '--replay-error-status', type=int, default=429, metavar='STATUS',
+        help='the HTTP status to fail calls with (default: 429, which is '
+        'retried)')
     email_group = parser.add_argument_group(
         'email', 'arguments for sending emails')
     email_group.add_argument(
@@ -541,10 +3502,320 @@ def create_cli_parser():
     email_group.add_argument(
         '--password', metavar='ADDRESS', default=None,
         help="the password to authenticate to the outgoing (SMTP) mail server over SSL")
+    email_group.add_argument(
+        '--smtp-connections', type=int, default=1, metavar='N',
+        help='the most connections to the mail server to send --config '
+        'projects over at once, each kept open between emails (default: 1)')
 
     return parser
 
 
+# The command line options that each project in a config file can set
+project_options = (
+    'tag_filters', 'filter_expr', 'section_filters',
+    'completed_lookback_hours', 'skip_inline_css', 'minify_html',
+    'dedupe_styles', 'html_template', 'text_template', 'to_addresses',
+    'cc_addresses', 'from_address')
+
+
+def load_config(filename, cli_defaults=None):
+    '''Loads a configuration file describing several projects to mail.
+
+    The file is a JSON object with an "api_key" and a list of "projects".
+    Each project is an object of the per-project command line options, by
+    their long names with underscores (project_id and those in
+    project_options). An optional "defaults" object applies to every project,
+    as do the options given on the command line, unless the file sets them.
+
+    A project can instead be sent several ways from one fetch, with a list of
+    "outputs". Each output is an object of the options that can differ
+    between outputs (all but project_id and completed_lookback_hours), plus
+    an optional "name" for its files, and the project's own options apply to
+    every output.
+
+    :param filename: The filename of the configuration file
+    :param cli_defaults: A dict of the per-project options given on the
+    command line
+    :return: A tuple of the API key and a list of project option dicts, with
+    an "outputs" list of option dicts for projects that have outputs
+    '''
+    with codecs.open(filename, 'r', 'utf-8') as config_file:
+        config = json.load(config_file)
+    defaults = dict(cli_defaults or {})
+    defaults.update(config.get('defaults', {}))
+    projects = []
+    for entry in config['projects']:
+        options = dict(defaults)
+        options.update(entry)
+        if 'project_id' not in options:
+            raise ValueError('Every project needs a project_id')
+        if 'outputs' in options:
+            outputs = []
+            for output in options['outputs']:
+                if 'project_id' in output or (
+                        'completed_lookback_hours' in output):
+                    raise ValueError(
+                        'Outputs share the project_id and '
+                        'completed_lookback_hours of their project '
+                        '(project {0})'.format(options['project_id']))
+                output_options = dict(options)
+                del output_options['outputs']
+                output_options.update(output)
+                _check_output_options(output_options)
+                outputs.append(output_options)
+            if not outputs:
+                raise ValueError('Project {0} has no outputs'.format(
+                    options['project_id']))
+            options['outputs'] = outputs
+        else:
+            _check_output_options(options)
+        projects.append(options)
+    return config['api_key'], projects
+
+
+def _check_output_options(options):
+    if bool(options.get('from_address')) != bool(options.get('to_addresses')):
+        raise ValueError(
+            "'To:' and 'From:' address are required for sending email "
+            '(project {0})'.format(options['project_id']))
+    if options.get('filter_expr'):
+        TagExpression.parse(options['filter_expr'])
+
+
+def create_tag_filter(tags, filter_expr=None):
+    '''Creates the tag filter for the -f tags and --filter-expr expression.
+
+    :param tags: The tags that tasks must all have
+    :param filter_expr: An optional tag expression that tasks must match too
+    :return: A frozenset of the tags without an expression, otherwise a
+    TagExpression of both
+    :raises ValueError: If the expression isn't valid
+    '''
+    tags = frozenset(unicode(tag) for tag in tags)
+    if not filter_expr:
+        return tags
+    expression = TagExpression.parse(unicode(filter_expr))
+    if tags:
+        expression = TagExpression(
+            'and', (TagExpression.all_of(tags), expression))
+    return expression
+
+
+def create_minifier(minify_html, dedupe_styles):
+    '''Creates the HTMLMinifier the options ask for, if any.
+
+    Moving repeated styles to classes implies minifying.
+    '''
+    if not (minify_html or dedupe_styles):
+        return None
+    return HTMLMinifier(dedupe_styles=bool(dedupe_styles))
+
+
+def create_state_store(args):
+    '''Creates the TaskStateStore the arguments ask for, if any.'''
+    if not args.state_db:
+        return None
+    if args.state_max_age is not None:
+        state_max_age = args.state_max_age * 60 * 60
+    else:
+        state_max_age = None
+    return TaskStateStore(args.state_db, max_age=state_max_age)
+
+
+def create_asana(args, api_key, pool_size):
+    '''Creates an AsanaAPI as configured by the arguments.'''
+    if args.cache:
+        cache = ResponseCache(
+            args.cache, ttl=args.cache_ttl,
+            max_bytes=args.cache_max_mb * 1024 * 1024)
+    else:
+        cache = None
+    scheduler = RequestScheduler(
+        rate=args.rate_limit / 60.0, max_concurrency=pool_size)
+    if args.replay:
+        log.info('Replaying API calls from {0}'.format(args.replay))
+        adapter = CassetteReplayer(
+            Cassette.load(args.replay),
+            args.api_url or AsanaAPI.asana_api_url,
+            latency=args.replay_latency / 1000.0,
+            jitter=args.replay_jitter / 1000.0,
+            error_rate=args.replay_error_rate,
+            error_status=args.replay_error_status)
+    elif args.record:
+        log.info('Recording API calls to {0}'.format(args.record))
+        adapter = CassetteRecorder(
+            Cassette(args.record), args.api_url or AsanaAPI.asana_api_url,
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    else:
+        adapter = None
+    return AsanaAPI(
+        api_key, pool_size=pool_size, cache=cache, api_url=args.api_url,
+        scheduler=scheduler, adapter=adapter)
+
+
+def mail_projects(args, api_key, projects):
+    '''Mails several projects in one process.
+
+    The projects share one AsanaAPI (and so its connections and rate limit),
+    the template Environments and a MailTransport of up to --smtp-connections
+    connections, and up to --parallel-projects of them are processed at once.
+    A failure in one project is logged and doesn't affect the others.
+
+    A project with several outputs is fetched once, with every task and field
+    that any of its outputs need, and each output is rendered from a view of
+    it filtered for that output.
+
+    :param args: The parsed command line arguments, for shared options
+    :param api_key: The Asana API key
+    :param projects: A list of project option dicts, as from load_config
+    :return: A list with a result summary dict for each project
+    '''
+    current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+    current_date = str(datetime.date.today())
+    environments = template_environments(args.template_cache)
+    asana = create_asana(
+        args, api_key, args.concurrency * args.parallel_projects)
+    state_store = create_state_store(args)
+    render = stream_templates if args.stream else generate_templates
+    transport = MailTransport(
+        args.mail_server, args.username, args.password,
+        pool_size=args.smtp_connections)
+
+    def send(project, options, rendered_html, rendered_text):
+        return send_email(
+            project, args.mail_server, options['from_address'],
+            list(options['to_addresses']),
+            list(options.get('cc_addresses') or []) or None,
+            rendered_html, rendered_text, current_date, transport=transport)
+
+    def templates(options):
+        return (options.get('html_template', args.html_template),
+                options.get('text_template', args.text_template))
+
+    def section_filter(options):
+        return frozenset(
+            unicode(section + ':')
+            for section in options.get('section_filters', []))
+
+    def task_filter(options):
+        return create_tag_filter(
+            options.get('tag_filters', []), options.get('filter_expr'))
+
+    def mail_output(project, options, result, basename):
+        html_template, text_template = templates(options)
+        rendered_html, rendered_text = render(
+            project, html_template, text_template, current_date,
+            current_time_utc,
+            options.get('skip_inline_css', args.skip_inline_css),
+            environments=environments, minifier=create_minifier(
+                options.get('minify_html', args.minify_html),
+                options.get('dedupe_styles', args.dedupe_styles)))
+        if options.get('to_addresses'):
+            if send(project, options, rendered_html, rendered_text):
+                result['status'] = 'sent'
+            else:
+                # Counted as a failure, so the run exits non-zero
+                result['status'] = 'failed'
+                result['error'] = 'Email could not be sent'
+        else:
+            write_rendered_files(
+                rendered_html, rendered_text, current_date, basename)
+            result['status'] = 'written'
+        result['sections'] = len(project.sections)
+        result['tasks'] = sum(
+            len(section.tasks) for section in project.sections)
+
+    def fetch_outputs_project(project_id, options, outputs):
+        '''Fetches a project with everything its outputs need.'''
+        fields = TemplateFields.from_templates(
+            [template for output in outputs for template in templates(output)],
+            environments[0])
+        task_filters = [task_filter(output) for output in outputs]
+        fetch_task_filter = TagExpression.any_of(task_filters)
+        if fields is not None and fetch_task_filter is None and any(
+                task_filters):
+            # Some outputs filter on tags that others don't fetch by
+            fields = TemplateFields(
+                fields.task_fields | frozenset(['tags.name']),
+                fields.story_fields)
+        section_filters = [section_filter(output) for output in outputs]
+        if all(section_filters):
+            fetch_section_filter = frozenset.union(*section_filters)
+        else:
+            fetch_section_filter = frozenset()
+        if len(outputs) == 1:
+            # Fetch with the output's filters just as they are
+            fetch_task_filter = task_filters[0]
+        return Project.create_project(
+            asana, project_id, current_time_utc,
+            task_filters=fetch_task_filter,
+            section_filters=fetch_section_filter,
+            completed_lookback_hours=options.get('completed_lookback_hours'),
+            concurrency=args.concurrency, state_store=state_store,
+            batch=args.batch, fields=fields)
+
+    def mail_project(options):
+        project_id = unicode(options['project_id'])
+        start = time.time()
+        result = {'project_id': project_id}
+        try:
+            outputs = options.get('outputs')
+            project = fetch_outputs_project(
+                project_id, options, outputs or [options])
+            if outputs is None:
+                mail_output(project, options, result, project_id)
+            else:
+                tag_index = project.tag_index()
+                result['outputs'] = []
+                for index, output in enumerate(outputs):
+                    name = unicode(output.get('name', index))
+                    output_result = {'name': name}
+                    result['outputs'].append(output_result)
+                    try:
+                        view = project.filtered_view(
+                            section_filters=section_filter(output),
+                            task_filters=task_filter(output),
+                            tag_index=tag_index)
+                        mail_output(
+                            view, output, output_result,
+                            u'{0}_{1}'.format(project_id, name))
+                    except Exception as e:
+                        log.exception('Project {0} output {1} failed'.format(
+                            project_id, name))
+                        output_result['status'] = 'failed'
+                        output_result['error'] = repr(e)
+                statuses = set(output_result['status']
+                               for output_result in result['outputs'])
+                if 'failed' in statuses:
+                    result['status'] = 'failed'
+                elif len(statuses) == 1:
+                    result['status'] = statuses.pop()
+                else:
+                    result['status'] = 'mixed'
+        except Exception as e:
+            log.exception('Project {0} failed'.format(project_id))
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    pool = ThreadPool(args.parallel_projects)
+    try:
+        results = pool.map(mail_project, projects)
+    finally:
+        pool.close()
+        pool.join()
+        asana.close()
+        if state_store is not None:
+            state_store.close()
+        transport.close()
+
+    for result in results:
+        log.info('Project result: {0}'.format(
+            json.dumps(result, sort_keys=True)))
+    return results
+
+
 def main():
     '''The main function for generating the mailer.
 
@@ -552,6 +3823,9 @@ def main():
     appropriate Section and Tasks objects, and then renders templates
     accordingly. This can either be written out to two files, or can be mailed
     out using a SMTP server running on localhost.
+
+    With --config, this is done for each project in the configuration file,
+    and a summary of every project's result is printed.
     '''
 
     parser = create_cli_parser()
@@ -560,20 +3834,80 @@ def main():
     if bool(args.from_address) != bool(args.to_addresses):
         parser.error(
             "'To:' and 'From:' address are required for sending email")
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.record and args.replay:
+        parser.error('--record and --replay can not be used together')
+    try:
+        filters = create_tag_filter(args.tag_filters, args.filter_expr)
+    except ValueError as e:
+        parser.error('Invalid --filter-expr: {0}'.format(e))
+
+    if args.config:
+        if args.parallel_projects < 1:
+            parser.error('--parallel-projects must be at least 1')
+        if args.smtp_connections < 1:
+            parser.error('--smtp-connections must be at least 1')
+        if args.save_snapshot or args.from_snapshot:
+            parser.error('snapshots are for a single project, not --config')
+        # Per-project options on the command line apply to every project
+        cli_defaults = dict(
+            (name, getattr(args, name)) for name in project_options
+            if getattr(args, name) is not None)
+        try:
+            api_key, projects = load_config(args.config, cli_defaults)
+        except (IOError, KeyError, ValueError) as e:
+            parser.error('Invalid config file {0}: {1}'.format(
+                args.config, e))
+        with instrument_run(args):
+            results = mail_projects(args, api_key, projects)
+        print json.dumps(results, indent=2, sort_keys=True)
+        log.info('Finished')
+        if any(result['status'] == 'failed' for result in results):
+            sys.exit(1)
+        return
+    elif args.from_snapshot:
+        if args.record or args.replay:
+            parser.error('--from-snapshot makes no API calls to record or '
+                         'replay')
+    elif not (args.project_id and args.api_key):
+        parser.error('a project id and api key are required without --config')
+
+    with instrument_run(args):
+        run_project(args, filters)
+    log.info('Finished')
+
+
+def run_project(args, filters):
+    '''Mails (or writes out) the single project given on the command line.
 
-    asana = AsanaAPI(args.api_key)
-    filters = frozenset((unicode(filter) for filter in args.tag_filters))
+    :param args: The parsed command line arguments
+    :param filters: The tag filter, as from create_tag_filter
+    '''
     section_filters = frozenset(
         (unicode(section + ':') for section in args.section_filters))
     current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
     current_date = str(datetime.date.today())
-    project = Project.create_project(
-        asana, args.project_id, current_time_utc, task_filters=filters,
-        section_filters=section_filters,
-        completed_lookback_hours=args.completed_lookback_hours)
-    rendered_html, rendered_text = generate_templates(
+    environments = template_environments(args.template_cache)
+    if args.from_snapshot:
+        project = Project.load_snapshot(args.from_snapshot)
+        project.filter_tasks(
+            current_time_utc, section_filters=section_filters,
+            task_filters=filters)
+    else:
+        project = fetch_project(
+            args, args.project_id, current_time_utc, filters,
+            section_filters, args.completed_lookback_hours, environments)
+    if args.save_snapshot:
+        project.save_snapshot(args.save_snapshot)
+    if args.stream:
+        render = stream_templates
+    else:
+        render = generate_templates
+    rendered_html, rendered_text = render(
         project, args.html_template, args.text_template, current_date,
-        current_time_utc, args.skip_inline_css)
+        current_time_utc, args.skip_inline_css, environments=environments,
+        minifier=create_minifier(args.minify_html, args.dedupe_styles))
 
     if args.to_addresses and args.from_address:
         if args.cc_addresses:
@@ -582,10 +3916,80 @@ def main():
             cc_addresses = None
         send_email(
             project, args.mail_server, args.from_address, args.to_addresses[:],
-            cc_addresses, rendered_html, rendered_text, current_date, args.username, args.password)
+            cc_addresses, rendered_html, rendered_text, current_date,
+            args.username, args.password)
     else:
         write_rendered_files(rendered_html, rendered_text, current_date)
-    log.info('Finished')
+
+
+def fetch_project(
+        args, project_id, current_time_utc, filters, section_filters,
+        completed_lookback_hours, environments):
+    '''Creates a Project from Asana for the single project run.
+
+    Only the fields the templates use are requested, unless the project is
+    being saved as a snapshot, which could be rendered with any template.
+    '''
+    asana = create_asana(args, args.api_key, args.concurrency)
+    if args.save_snapshot:
+        fields = None
+    else:
+        fields = TemplateFields.from_templates(
+            [args.html_template, args.text_template], environments[0])
+    if fields is None:
+        log.info('Templates could use any field, requesting all of them')
+    state_store = create_state_store(args)
+    try:
+        return Project.create_project(
+            asana, project_id, current_time_utc, task_filters=filters,
+            section_filters=section_filters,
+            completed_lookback_hours=completed_lookback_hours,
+            concurrency=args.concurrency, state_store=state_store,
+            batch=args.batch, fields=fields)
+    finally:
+        asana.close()
+        if state_store is not None:
+            state_store.close()
+
+
+@contextlib.contextmanager
+def instrument_run(args):
+    '''Profiles and reports on the run within it, as the arguments ask.
+
+    With --profile, the run is profiled with cProfile and its stats are
+    written to a file (for pstats or a viewer such as snakeviz). With
+    --metrics, the shared Metrics summary is written as JSON, and with
+    --statsd, it is sent to a statsd server. Reports are made even if the
+    run fails.
+
+    :param args: The parsed command line arguments
+    '''
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            log.info('Writing profile to {0}'.format(args.profile))
+            profiler.dump_stats(args.profile)
+        metrics = Metrics.shared()
+        if args.metrics:
+            summary = json.dumps(metrics.summary(), indent=2, sort_keys=True)
+            if args.metrics == '-':
+                print summary
+            else:
+                log.info('Writing metrics to {0}'.format(args.metrics))
+                with open(args.metrics, 'w') as metrics_file:
+                    metrics_file.write(summary)
+        if args.statsd:
+            log.info('Sending metrics to statsd at {0}'.format(args.statsd))
+            try:
+                send_statsd(args.statsd, metrics.statsd_lines())
+            except (socket.error, ValueError):
+                log.exception('Metrics could not be sent to statsd')
 
 
 if __name__ == '__main__':
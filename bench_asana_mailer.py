@@ -0,0 +1,1247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Palantir Technologies
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Microbenchmarks and an end-to-end benchmark suite for Asana Mailer, run
+against synthetic projects, a stub Asana API and an SMTP sink so that no
+Asana account or mail server is needed.
+
+:copyright: (c) 2013 by Palantir Technologies
+:license: Apache 2.0, see LICENSE for more details.
+'''
+
+import argparse
+import asyncore
+import BaseHTTPServer
+import datetime
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import smtpd
+import smtplib
+import socket
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+import timeit
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import dateutil.parser
+import dateutil.tz
+import premailer
+
+import asana_mailer
+
+
+def synthetic_project(
+        num_tasks, num_sections=10, comments_per_task=5, seed=0):
+    '''Creates a Project filled with generated Sections and Tasks.
+
+    :param num_tasks: The total number of tasks in the project
+    :param num_sections: The number of sections to spread the tasks over
+    :param comments_per_task: The number of comments on each task
+    :param seed: The random seed, so runs are comparable
+    :return: A Project
+    '''
+    rand = random.Random(seed)
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    project = asana_mailer.Project(
+        u'1', u'Benchmark Project', u'A generated project')
+    for section_index in xrange(num_sections):
+        project.add_section(
+            asana_mailer.Section(u'Section {0}:'.format(section_index)))
+    for task_index in xrange(num_tasks):
+        comments = []
+        for comment_index in xrange(comments_per_task):
+            created_at = now - datetime.timedelta(
+                hours=rand.randint(0, 24 * 14))
+            comments.append({
+                u'text': u'Comment {0} on task {1} <with> & markup'.format(
+                    comment_index, task_index),
+                u'created_at': created_at.isoformat(),
+                u'created_by': {u'name': u'User {0}'.format(
+                    rand.randint(0, 50))},
+            })
+        comments.sort(key=lambda comment: comment[u'created_at'])
+        comments = asana_mailer.Comment.from_stories(comments)
+        completed = rand.random() < 0.2
+        task = asana_mailer.Task(
+            u'Task {0}'.format(task_index),
+            u'User {0}'.format(rand.randint(0, 50)), completed,
+            now if completed else None,
+            u'Notes for task {0}'.format(task_index),
+            (now + datetime.timedelta(days=rand.randint(-7, 30))).date(
+            ).isoformat(),
+            [u'tag{0}'.format(rand.randint(0, 20)) for _ in xrange(2)],
+            comments, id=task_index)
+        project.sections[task_index % num_sections].add_task(task)
+    return project
+
+
+def synthetic_tasks_json(
+        num_tasks, num_sections=10, num_tags=20, seed=0):
+    '''Creates the JSON of a project's tasks, as Asana's API returns it.
+
+    :param num_tasks: The total number of tasks, not counting section rows
+    :param num_sections: The number of sections to spread the tasks over
+    :param num_tags: The number of distinct tags, two of which are on each
+    task
+    :param seed: The random seed, so runs are comparable
+    :return: A list of task JSON objects, section rows included
+    '''
+    return list(iter_synthetic_tasks_json(
+        num_tasks, num_sections, num_tags, seed))
+
+
+def iter_synthetic_tasks_json(
+        num_tasks, num_sections=10, num_tags=20, seed=0):
+    '''Generates the JSON of a project's tasks one at a time, as for
+    synthetic_tasks_json.
+    '''
+    rand = random.Random(seed)
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    section_size = max(1, num_tasks // num_sections)
+    for task_index in xrange(num_tasks):
+        if task_index % section_size == 0:
+            yield {
+                u'id': -task_index - 1,
+                u'name': u'Section {0}:'.format(task_index // section_size)}
+        completed = rand.random() < 0.2
+        completed_at = now - datetime.timedelta(
+            minutes=rand.randint(0, 60 * 24 * 14))
+        yield {
+            u'id': task_index,
+            u'name': u'Task {0}'.format(task_index),
+            u'assignee': {u'name': u'User {0}'.format(rand.randint(0, 50))},
+            u'completed': completed,
+            u'completed_at': completed_at.isoformat() if completed else None,
+            u'modified_at': completed_at.isoformat(),
+            u'notes': u'Notes for task {0}'.format(task_index),
+            u'due_on': (now + datetime.timedelta(
+                days=rand.randint(-7, 30))).date().isoformat(),
+            u'tags': [
+                {u'name': u'tag{0}'.format(rand.randint(0, num_tags - 1))}
+                for _ in xrange(2)],
+        }
+
+
+class SyntheticStories(object):
+    '''Generates the comment stories of synthetic tasks when asked for
+    them, so they're never all in memory at once.
+    '''
+
+    def __init__(self, comments_per_task, seed=0):
+        self.comments_per_task = comments_per_task
+        self.rand = random.Random(seed)
+        self.now = datetime.datetime.now(dateutil.tz.tzutc())
+
+    def get(self, task_id):
+        stories = []
+        for comment_index in xrange(self.comments_per_task):
+            created_at = self.now - datetime.timedelta(
+                minutes=self.rand.randint(0, 60 * 24 * 14))
+            stories.append({
+                u'type': u'comment',
+                u'text': u'Comment {0} on task {1}'.format(
+                    comment_index, task_id),
+                u'created_at': created_at.isoformat(),
+                u'created_by': {
+                    u'id': self.rand.randint(0, 50),
+                    u'name': u'User {0}'.format(self.rand.randint(0, 50))},
+            })
+        stories.sort(key=lambda story: story[u'created_at'])
+        return stories
+
+
+class SyntheticAsana(object):
+    '''The JSON of a synthetic Asana project, with its tasks and stories.
+
+    The distributions are skewed like real projects rather than uniform:
+    section sizes vary widely, a few tags are on most tagged tasks while the
+    rest are rare, most tasks have a few comments but some have many, and
+    every task has system stories (which aren't comments) mixed in. Stories
+    are generated from the task id when asked for, so they are the same on
+    every call without being held in memory.
+
+    :param num_tasks: The number of tasks, not counting section rows
+    :param comments_per_task: The mean number of comments on a task
+    :param num_tags: The number of distinct tags
+    :param seed: The random seed, so runs are comparable
+    '''
+
+    project_id = u'1'
+
+    def __init__(self, num_tasks, comments_per_task=3, num_tags=30, seed=0):
+        self.num_tasks = num_tasks
+        self.comments_per_task = comments_per_task
+        self.num_tags = num_tags
+        self.seed = seed
+        self.now = datetime.datetime.now(dateutil.tz.tzutc())
+        self.project_json = {
+            u'id': self.project_id, u'name': u'Benchmark Project',
+            u'notes': u'A generated project with {0} tasks'.format(num_tasks)}
+        self.tasks_json = list(self._iter_tasks_json())
+        self.stories_served = 0
+
+    def _iter_tasks_json(self):
+        rand = random.Random(self.seed)
+        num_sections = max(1, int(self.num_tasks ** 0.5 / 2))
+        weights = [rand.paretovariate(1.5) for _ in xrange(num_sections)]
+        total_weight = sum(weights)
+        task_index = 0
+        for section_index, weight in enumerate(weights):
+            if section_index == num_sections - 1:
+                section_size = self.num_tasks - task_index
+            else:
+                section_size = min(
+                    self.num_tasks - task_index,
+                    int(round(self.num_tasks * weight / total_weight)))
+            yield {
+                u'id': -section_index - 1,
+                u'name': u'Section {0}:'.format(section_index)}
+            for _ in xrange(section_size):
+                yield self._task_json(rand, task_index)
+                task_index += 1
+
+    def _task_json(self, rand, task_index):
+        completed = rand.random() < 0.2
+        modified_at = self.now - datetime.timedelta(
+            minutes=rand.randint(0, 60 * 24 * 14))
+        num_tags = rand.choice((0, 0, 0, 1, 1, 1, 1, 2, 2, 3))
+        tags = set(
+            min(int(rand.paretovariate(1.2)) - 1, self.num_tags - 1)
+            for _ in xrange(num_tags))
+        if rand.random() < 0.15:
+            assignee = None
+        else:
+            assignee_id = rand.randint(0, 50)
+            assignee = {
+                u'id': assignee_id,
+                u'name': u'User {0}'.format(assignee_id)}
+        return {
+            u'id': task_index,
+            u'name': u'Task {0}'.format(task_index),
+            u'assignee': assignee,
+            u'completed': completed,
+            u'completed_at': modified_at.isoformat() if completed else None,
+            u'modified_at': modified_at.isoformat(),
+            u'notes': u' '.join(
+                [u'Notes for task {0}.'.format(task_index)] *
+                rand.randint(0, 5)),
+            u'due_on': (self.now + datetime.timedelta(
+                days=rand.randint(-7, 30))).date().isoformat(),
+            u'tags': [
+                {u'name': u'tag{0}'.format(tag)} for tag in sorted(tags)],
+        }
+
+    def stories_json(self, task_id):
+        '''Returns the stories of a task, oldest first.'''
+        self.stories_served += 1
+        rand = random.Random(self.seed * 1000003 + task_id)
+        num_comments = min(
+            int(rand.expovariate(1.0 / self.comments_per_task))
+            if self.comments_per_task else 0, 50)
+        stories = []
+        for story_index in xrange(num_comments + rand.randint(1, 3)):
+            created_at = self.now - datetime.timedelta(
+                minutes=rand.randint(0, 60 * 24 * 14))
+            user_id = rand.randint(0, 50)
+            if story_index < num_comments:
+                story_type = u'comment'
+                text = u' '.join([u'Comment {0} on task {1}.'.format(
+                    story_index, task_id)] * rand.randint(1, 8))
+            else:
+                story_type = u'system'
+                text = u'added to Benchmark Project'
+            stories.append({
+                u'id': task_id * 100 + story_index,
+                u'type': story_type,
+                u'text': text,
+                u'created_at': created_at.isoformat(),
+                u'created_by': {
+                    u'id': user_id, u'name': u'User {0}'.format(user_id)},
+            })
+        stories.sort(key=lambda story: story[u'created_at'])
+        return stories
+
+
+class StubAsanaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves a SyntheticAsana the way Asana's API would.
+
+    Supports the project, paginated project tasks, task stories and batch
+    endpoints, which is everything AsanaAPI calls.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, so Nagle's algorithm and delayed ACKs
+    # don't hold up keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    project_path = re.compile(r'^/projects/(\w+)$')
+    tasks_path = re.compile(r'^/projects/(\w+)/tasks$')
+    stories_path = re.compile(r'^/tasks/(-?\d+)/stories$')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        status, body = self.route(url.path, query)
+        self.send_json(status, body)
+
+    def do_POST(self):
+        request = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))
+        results = []
+        for action in request['data']['actions']:
+            query = dict(action.get('data') or {})
+            options = action.get('options') or {}
+            query.update(
+                (name, options[name]) for name in ('limit', 'offset')
+                if name in options)
+            status, body = self.route(action['relative_path'], query)
+            results.append(
+                {'status_code': status, 'headers': {}, 'body': body})
+        self.send_json(200, {'data': results})
+
+    def route(self, path, query):
+        fixture = self.server.fixture
+        if self.tasks_path.match(path):
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 100))
+            body = {'data': fixture.tasks_json[offset:offset + limit]}
+            if offset + limit < len(fixture.tasks_json):
+                body['next_page'] = {'offset': str(offset + limit)}
+            else:
+                body['next_page'] = None
+            return 200, body
+        match = self.stories_path.match(path)
+        if match:
+            return 200, {'data': fixture.stories_json(int(match.group(1)))}
+        if self.project_path.match(path):
+            return 200, {'data': fixture.project_json}
+        return 404, {'errors': [{'message': 'Unknown path {0}'.format(path)}]}
+
+    def send_json(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubAsanaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''A local HTTP server standing in for Asana's API, on its own thread.
+
+    :param fixture: The SyntheticAsana to serve
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, fixture):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StubAsanaHandler)
+        self.fixture = fixture
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CassetteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers requests from the server's CassetteReplayer.'''
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.replay(None)
+
+    def do_POST(self):
+        self.replay(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def replay(self, body):
+        status, headers, content = self.server.replayer.respond(
+            self.command, self.path.lstrip('/'), body)
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CassetteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''A local HTTP stand-in for Asana's API that replays a cassette.
+
+    :param replayer: The CassetteReplayer answering requests
+    :param port: The port to listen on, or 0 for any free port
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, replayer, port=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', port), CassetteHandler)
+        self.replayer = replayer
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+
+class SinkChannel(smtpd.SMTPChannel):
+    '''An SMTP channel that can also answer EHLO, advertising PIPELINING.
+
+    The asynchat channel already handles commands that arrive together one
+    after another, which is all PIPELINING asks of a server. Nagle is
+    disabled, as a mail server would, so that replies to pipelined commands
+    aren't held back waiting for the client's ACKs.
+    '''
+
+    def __init__(self, server, conn, addr, esmtp=False):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.esmtp = esmtp
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+
+    def smtp_EHLO(self, arg):
+        if not self.esmtp:
+            self.push('502 Error: command "EHLO" not implemented')
+            return
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+            return
+        self._SMTPChannel__greeting = arg
+        self.push('250-{0}\r\n250 PIPELINING'.format(
+            self._SMTPChannel__fqdn))
+
+
+class SMTPSink(smtpd.SMTPServer):
+    '''A local SMTP server that accepts and discards every message.
+
+    It runs its own asyncore loop on a background thread, and counts the
+    messages and bytes it receives. With esmtp, it answers EHLO and
+    advertises PIPELINING, otherwise clients fall back to HELO.
+    '''
+
+    def __init__(self, esmtp=False):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.esmtp = esmtp
+        self.messages = 0
+        self.bytes = 0
+        self.thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.05, 'use_poll': True})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def address(self):
+        return '127.0.0.1:{0}'.format(self.socket.getsockname()[1])
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            SinkChannel(self, pair[0], pair[1], esmtp=self.esmtp)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+        self.bytes += len(data)
+
+    def close(self):
+        smtpd.SMTPServer.close(self)
+        self.thread.join(1)
+
+
+def template_names():
+    '''Returns the (template name, is HTML) pairs of every template.'''
+    names = []
+    for filename in sorted(os.listdir('templates')):
+        if filename.endswith('.html'):
+            names.append((filename, True))
+        elif filename.endswith('.markdown'):
+            names.append((filename, False))
+    return names
+
+
+def best_time(func, repeat, number=1):
+    '''Returns the best per-call time of func, in milliseconds.'''
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1000
+
+
+def bench_templates(args):
+    '''Compares cold and warm render costs of each template.
+
+    cold: new Environments, so the template is loaded, parsed and compiled
+    bytecode: new Environments with a filled bytecode cache, as for a new
+    process run with --template-cache
+    warm: the process-wide Environments, with the template already compiled
+    '''
+    project = synthetic_project(args.tasks, comments_per_task=args.comments)
+    current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+    current_date = str(datetime.date.today())
+    context = dict(
+        project=project, current_date=current_date,
+        current_time_utc=current_time_utc)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # Fill the bytecode cache
+        environments = asana_mailer.create_template_environments(cache_dir)
+        for template_name, is_html in template_names():
+            environments[0 if is_html else 1].get_template(template_name)
+
+        print '{0:<30} {1:>10} {2:>10} {3:>10}'.format(
+            'template (ms)', 'cold', 'bytecode', 'warm')
+        for template_name, is_html in template_names():
+            index = 0 if is_html else 1
+
+            def cold():
+                env = asana_mailer.create_template_environments()[index]
+                env.get_template(template_name).render(**context)
+
+            def bytecode():
+                env = asana_mailer.create_template_environments(
+                    cache_dir)[index]
+                env.get_template(template_name).render(**context)
+
+            def warm():
+                env = asana_mailer.template_environments()[index]
+                env.get_template(template_name).render(**context)
+
+            warm()
+            print '{0:<30} {1:>10.2f} {2:>10.2f} {3:>10.2f}'.format(
+                template_name, best_time(cold, args.repeat),
+                best_time(bytecode, args.repeat),
+                best_time(warm, args.repeat))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def bench_inline(args):
+    '''Compares premailer.transform with the cached CSSInliner.
+
+    The inliner is timed cold (a new CSSInliner, so the stylesheet is parsed
+    and its selectors compiled) and warm (the stylesheet already cached).
+    '''
+    project = synthetic_project(args.tasks)
+    html = asana_mailer.template_environments()[0].get_template(
+        args.template).render(
+            project=project, current_date=str(datetime.date.today()),
+            current_time_utc=datetime.datetime.now(dateutil.tz.tzutc()))
+    inliner = asana_mailer.CSSInliner()
+    if inliner.transform(html) != premailer.transform(html):
+        raise AssertionError('CSSInliner output differs from premailer')
+
+    print '{0} with {1} tasks ({2} bytes of HTML)'.format(
+        args.template, args.tasks, len(html))
+    print '{0:<30} {1:>10.3f}'.format('premailer.transform (s)', best_time(
+        lambda: premailer.transform(html), args.repeat) / 1000)
+    print '{0:<30} {1:>10.3f}'.format('CSSInliner cold (s)', best_time(
+        lambda: asana_mailer.CSSInliner().transform(html), args.repeat) / 1000)
+    print '{0:<30} {1:>10.3f}'.format('CSSInliner warm (s)', best_time(
+        lambda: inliner.transform(html), args.repeat) / 1000)
+
+
+def bench_minify(args):
+    '''Measures how much HTMLMinifier shrinks a rendered email, and the time
+    it takes, on inlined HTML as it would be sent.
+    '''
+    project = synthetic_project(args.tasks)
+    html = asana_mailer.CSSInliner.shared().transform(
+        asana_mailer.template_environments()[0].get_template(
+            args.template).render(
+                project=project, current_date=str(datetime.date.today()),
+                current_time_utc=datetime.datetime.now(dateutil.tz.tzutc())))
+    size = len(html.encode('utf-8'))
+    print '{0} with {1} tasks, inlined'.format(args.template, args.tasks)
+    print '{0:<25} {1:>10} {2:>8} {3:>10}'.format(
+        'stage', 'bytes', 'saved', 'ms')
+    print '{0:<25} {1:>10} {2:>8} {3:>10}'.format('inlined', size, '', '')
+    for label, dedupe_styles in (('minified', False),
+                                 ('minified, styles moved', True)):
+        minifier = asana_mailer.HTMLMinifier(dedupe_styles=dedupe_styles)
+        minified_size = len(minifier.minify(html).encode('utf-8'))
+        print '{0:<25} {1:>10} {2:>7.1f}% {3:>10.1f}'.format(
+            label, minified_size, 100.0 * (size - minified_size) / size,
+            best_time(lambda: minifier.minify(html), args.repeat))
+
+
+def bench_sections(args):
+    '''Times making Sections and Tasks from task JSON, with and without
+    filters, so the cost can be compared with the number of tasks kept.
+    '''
+    tasks_json = synthetic_tasks_json(args.tasks)
+    section_names = [
+        task[u'name'] for task in tasks_json if task[u'name'].endswith(':')]
+    cases = [
+        ('no filters', None, None),
+        ('one section', frozenset(section_names[:1]), None),
+        ('one tag', None, frozenset([u'tag0'])),
+        ('one section and tag', frozenset(section_names[:1]),
+         frozenset([u'tag0'])),
+    ]
+    print '{0:<25} {1:>10} {2:>10}'.format('filters', 'kept', 'ms')
+    for label, section_filters, task_filters in cases:
+        def create_sections():
+            # Completion times are parsed when used, so use them
+            sections = asana_mailer.Section.create_sections(
+                tasks_json, {}, section_filters=section_filters,
+                task_filters=task_filters)
+            for section in sections:
+                for task in section.tasks:
+                    task.completion_time
+            return sections
+        kept = sum(len(section.tasks) for section in create_sections())
+        print '{0:<25} {1:>10} {2:>10.2f}'.format(
+            label, kept, best_time(create_sections, args.repeat))
+
+
+def bench_tags(args):
+    '''Times filtering a project's tasks on tag expressions, checking each
+    task's tags against the expression versus evaluating it on a TagIndex.
+    '''
+    project = synthetic_project(args.tasks, comments_per_task=0)
+    tasks = [task for section in project.sections for task in section.tasks]
+    index = asana_mailer.TagIndex(tasks)
+    print 'indexing {0} tasks: {1:.2f} ms'.format(
+        len(tasks), best_time(
+            lambda: asana_mailer.TagIndex(tasks), args.repeat))
+    print '{0:<35} {1:>8} {2:>10} {3:>10}'.format(
+        'expression', 'kept', 'per task', 'index')
+    for text in (u'tag0', u'tag0 AND tag1', u'tag0 OR tag1 OR tag2',
+                 u'NOT (tag0 OR tag1)'):
+        expression = asana_mailer.TagExpression.parse(text)
+
+        def per_task():
+            return [task for task in tasks
+                    if expression.matches(frozenset(task.tags))]
+
+        def indexed():
+            return expression.select(index)
+        print '{0:<35} {1:>8} {2:>10.2f} {3:>10.2f}'.format(
+            text, len(indexed()), best_time(per_task, args.repeat),
+            best_time(indexed, args.repeat))
+
+
+def bench_snapshot(args):
+    '''Times saving and loading a project snapshot, next to building the
+    same sections from task JSON, which a run from Asana would also fetch.
+    '''
+    project = synthetic_project(
+        args.tasks, comments_per_task=args.comments)
+    tasks_json = synthetic_tasks_json(args.tasks)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'project.snapshot')
+
+        def load_snapshot():
+            loaded = asana_mailer.Project.load_snapshot(path)
+            for section in loaded.sections:
+                for task in section.tasks:
+                    task.completion_time
+            return loaded
+        save_ms = best_time(lambda: project.save_snapshot(path), args.repeat)
+        size = os.path.getsize(path)
+        load_ms = best_time(load_snapshot, args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+    sections_ms = best_time(
+        lambda: asana_mailer.Section.create_sections(tasks_json, {}),
+        args.repeat)
+    print '{0} tasks, {1} comments each'.format(args.tasks, args.comments)
+    print '{0:<30} {1:>10.1f}'.format('save snapshot (ms)', save_ms)
+    print '{0:<30} {1:>10.1f}'.format('load snapshot (ms)', load_ms)
+    print '{0:<30} {1:>10.1f}'.format('snapshot size (KB)', size / 1024.0)
+    print '{0:<30} {1:>10.1f}'.format(
+        'create_sections, no comments', sections_ms)
+
+
+def bench_dates(args):
+    '''Compares dateutil with parse_datetime on comment timestamps.
+
+    The first parse_datetime pass parses every timestamp, and the second is
+    answered from the memo, as when the same comments are rendered again.
+    '''
+    rand = random.Random(0)
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    timestamps = [
+        (now - datetime.timedelta(seconds=rand.randint(0, 10 ** 8))).strftime(
+            '%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(rand.randint(0, 999))
+        for _ in xrange(args.timestamps)]
+
+    def parse_all():
+        for timestamp in timestamps:
+            asana_mailer.parse_datetime(timestamp)
+
+    def parse_all_cold():
+        asana_mailer._parsed_datetimes.clear()
+        parse_all()
+
+    def parse_all_dateutil():
+        for timestamp in timestamps:
+            dateutil.parser.parse(timestamp)
+
+    max_parsed = asana_mailer.max_parsed_datetimes
+    asana_mailer.max_parsed_datetimes = max(max_parsed, args.timestamps)
+    try:
+        print '{0} timestamps'.format(args.timestamps)
+        print '{0:<30} {1:>10.1f}'.format(
+            'dateutil (ms)', best_time(parse_all_dateutil, args.repeat))
+        print '{0:<30} {1:>10.1f}'.format(
+            'parse_datetime (ms)', best_time(parse_all_cold, args.repeat))
+        print '{0:<30} {1:>10.1f}'.format(
+            'parse_datetime memoized (ms)', best_time(parse_all, args.repeat))
+    finally:
+        asana_mailer.max_parsed_datetimes = max_parsed
+        asana_mailer._parsed_datetimes.clear()
+
+
+def bench_memory(args):
+    '''Compares the peak RSS of holding a synthetic project in memory with
+    the slotted, interned domain model and with a dict-backed one.
+
+    The project is made from generated task JSON by Section.create_sections,
+    in a child process for each model so that each run starts from a clean
+    heap. The dict-backed model stands in for the one before Project,
+    Section and Task were slotted and strings were interned: the same
+    classes without __slots__, with interning turned off.
+    '''
+    measurements = []
+    for dict_backed in (True, False):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_measure_project_memory,
+            args=(queue, args.tasks, args.comments, dict_backed))
+        process.start()
+        measurements.append(queue.get())
+        process.join()
+    print '{0} tasks with {1} comments each in {2} sections'.format(
+        args.tasks, args.comments, measurements[0][2])
+    print '{0:<30} {1:>12} {2:>12}'.format('', 'dict-backed', 'slotted')
+    for label, values in (
+            ('baseline RSS (MB)', [m[0] for m in measurements]),
+            ('peak RSS (MB)', [m[1] for m in measurements]),
+            ('project (MB)', [m[1] - m[0] for m in measurements])):
+        print '{0:<30} {1:>12.1f} {2:>12.1f}'.format(
+            label, values[0] / 1024.0, values[1] / 1024.0)
+
+
+def _unslotted(cls):
+    '''Copies a slotted class into one whose instances keep a __dict__.'''
+    namespace = dict(
+        (name, value) for name, value in vars(cls).iteritems()
+        if name != '__slots__' and name not in cls.__slots__)
+    return type(cls.__name__, (object,), namespace)
+
+
+def _measure_project_memory(
+        queue, num_tasks, comments_per_task, dict_backed=False):
+    if dict_backed:
+        # This is a child process, so the module can be changed freely
+        for name in ('Project', 'Section', 'Task'):
+            setattr(asana_mailer, name,
+                    _unslotted(getattr(asana_mailer, name)))
+        asana_mailer.intern_string = lambda value: value
+        asana_mailer.intern_user = lambda user_json: user_json
+    gc.collect()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sections = asana_mailer.Section.create_sections(
+        iter_synthetic_tasks_json(num_tasks),
+        SyntheticStories(comments_per_task))
+    gc.collect()
+    queue.put((
+        baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        len(sections)))
+
+
+def bench_smtp(args):
+    '''Compares ways of sending many messages to a local SMTP sink.
+
+    connect per message: a new connection for each message, as send_email
+    makes without a MailTransport. The transports keep their connections
+    open, with and without PIPELINING, and over one or several
+    connections at once.
+    '''
+    project = asana_mailer.Project(u'1', u'Benchmark Project', u'')
+    to_addresses = [
+        'to{0}@example.com'.format(i) for i in xrange(args.recipients)]
+    message = asana_mailer.create_message(
+        project, 'from@example.com', to_addresses, None, 'today',
+        u'<p>{0}</p>'.format(u'x' * args.size * 1024), u'text').as_string()
+
+    def connect_per_message(mail_server):
+        for _ in xrange(args.messages):
+            conn = asana_mailer.connect_smtp(mail_server)
+            conn.sendmail('from@example.com', to_addresses, message)
+            conn.quit()
+
+    def transport_send(pool_size, pipelining):
+        def send_all(mail_server):
+            transport = asana_mailer.MailTransport(
+                mail_server, pool_size=pool_size, pipelining=pipelining)
+            pool = ThreadPool(pool_size)
+            try:
+                pool.map(
+                    lambda _: transport.send(
+                        'from@example.com', to_addresses, message),
+                    xrange(args.messages))
+            finally:
+                pool.close()
+                pool.join()
+                transport.close()
+        return send_all
+
+    cases = [('connect per message', connect_per_message, False),
+             ('transport, 1 connection', transport_send(1, False), False),
+             ('transport, pipelining', transport_send(1, True), True)]
+    if args.connections > 1:
+        cases.append((
+            'transport, {0} connections'.format(args.connections),
+            transport_send(args.connections, True), True))
+    print '{0} messages of {1} KB to {2} recipients'.format(
+        args.messages, args.size, args.recipients)
+    print '{0:<30} {1:>10} {2:>12}'.format('sender', 'ms', 'messages/s')
+    for label, send_all, esmtp in cases:
+        sink = SMTPSink(esmtp=esmtp)
+        try:
+            elapsed = best_time(
+                lambda: send_all(sink.address), args.repeat)
+            assert sink.messages == args.messages * args.repeat
+        finally:
+            sink.close()
+        print '{0:<30} {1:>10.1f} {2:>12.1f}'.format(
+            label, elapsed, args.messages / (elapsed / 1000))
+
+
+def bench_e2e(args):
+    '''Times each phase of a mailer run, end to end, at several sizes.
+
+    Each size gets a SyntheticAsana served by a StubAsanaServer, and the
+    email is sent to an SMTPSink. The phases are timed separately:
+
+    fetch: the project, task and story JSON, through AsanaAPI
+    parse: making the Project, Sections, Tasks and Comments from the JSON
+    filter: Project.filter_tasks on --filter-expr
+    render: both templates, without CSS inlining
+    inline: CSSInliner on the rendered HTML
+    mime: building the message and serializing it
+    send: sending it over an open SMTP connection
+
+    create_project is also timed on its own, as it fetches, parses and
+    filters at once in an actual run. The results are printed, and written
+    as JSON to --output for comparing runs with the compare command.
+    '''
+    results = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'started': datetime.datetime.now(dateutil.tz.tzutc()).isoformat(),
+        'options': {
+            'comments': args.comments, 'concurrency': args.concurrency,
+            'batch': args.batch, 'filter_expr': args.filter_expr,
+            'html_template': args.html_template,
+            'text_template': args.text_template, 'repeat': args.repeat},
+        'runs': [],
+    }
+    phases = ('fetch', 'parse', 'filter', 'render', 'inline', 'mime', 'send',
+              'create_project')
+    print '{0:>8} {1}'.format('tasks', ' '.join(
+        '{0:>14}'.format(phase + ' (ms)') for phase in phases))
+    sink = SMTPSink()
+    try:
+        for num_tasks in args.sizes:
+            fixture = SyntheticAsana(num_tasks, args.comments)
+            server = StubAsanaServer(fixture)
+            try:
+                runs = [
+                    _e2e_run(args, fixture, server, sink)
+                    for _ in xrange(args.repeat)]
+            finally:
+                server.close()
+            run = runs[0]
+            run['phases'] = dict(
+                (phase, min(r['phases'][phase] for r in runs))
+                for phase in phases)
+            results['runs'].append(run)
+            print '{0:>8} {1}'.format(num_tasks, ' '.join(
+                '{0:>14.1f}'.format(run['phases'][phase])
+                for phase in phases))
+    finally:
+        sink.close()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print 'Wrote {0}'.format(args.output)
+
+
+def _e2e_run(args, fixture, server, sink):
+    current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+    current_date = str(datetime.date.today())
+    tag_filter = asana_mailer.create_tag_filter([], args.filter_expr)
+    timings = {}
+    run = {'tasks': fixture.num_tasks, 'phases': timings}
+
+    def timed(phase, func, *func_args):
+        start = time.time()
+        result = func(*func_args)
+        timings[phase] = (time.time() - start) * 1000
+        return result
+
+    def create_asana():
+        return asana_mailer.AsanaAPI(
+            'api_key', pool_size=args.concurrency, api_url=server.api_url,
+            scheduler=asana_mailer.RequestScheduler(
+                rate=0, max_concurrency=args.concurrency))
+
+    def fetch(asana):
+        project_json = asana.get(
+            'project', {'project_id': fixture.project_id})
+        tasks_json = list(asana.iter_items(
+            'project_tasks', {'project_id': fixture.project_id}, expand='.',
+            params={'completed_since': 'now'}))
+        task_ids = [
+            unicode(task[u'id']) for task in tasks_json
+            if not task[u'name'].endswith(':')]
+        pool = ThreadPool(args.concurrency)
+        try:
+            if args.batch:
+                batches = [
+                    task_ids[i:i + asana.batch_limit]
+                    for i in xrange(0, len(task_ids), asana.batch_limit)]
+                comments = sum(pool.map(
+                    lambda batch: asana_mailer.get_batch_task_comments(
+                        asana, batch), batches), [])
+            else:
+                comments = pool.map(
+                    lambda task_id: asana_mailer.get_task_comments(
+                        asana, task_id), task_ids)
+        finally:
+            pool.close()
+            pool.join()
+        return project_json, tasks_json, dict(zip(task_ids, comments))
+
+    def parse(project_json, tasks_json, task_comments):
+        project = asana_mailer.Project(
+            fixture.project_id, project_json[u'name'], project_json[u'notes'])
+        project.add_sections(asana_mailer.Section.create_sections(
+            tasks_json, task_comments))
+        return project
+
+    with create_asana() as asana:
+        project_json, tasks_json, task_comments = timed('fetch', fetch, asana)
+    run['api_calls'] = fixture.stories_served
+    project = timed('parse', parse, project_json, tasks_json, task_comments)
+    run['comments'] = sum(
+        len(task.comments or ()) for section in project.sections
+        for task in section.tasks)
+    timed('filter', project.filter_tasks, current_time_utc, None, tag_filter)
+    run['tasks_kept'] = sum(
+        len(section.tasks) for section in project.sections)
+    rendered_html, rendered_text = timed(
+        'render', asana_mailer.generate_templates, project,
+        args.html_template, args.text_template, current_date,
+        current_time_utc, True)
+    rendered_html = timed(
+        'inline', asana_mailer.CSSInliner.shared().transform, rendered_html)
+    run['html_bytes'] = len(rendered_html)
+    message = timed(
+        'mime', lambda: asana_mailer.create_message(
+            project, 'bench@example.com', ['team@example.com'], None,
+            current_date, rendered_html, rendered_text).as_string())
+    run['message_bytes'] = len(message)
+    conn = smtplib.SMTP(sink.address)
+    try:
+        timed(
+            'send', conn.sendmail, 'bench@example.com', ['team@example.com'],
+            message)
+    finally:
+        conn.quit()
+
+    with create_asana() as asana:
+        timed(
+            'create_project', asana_mailer.Project.create_project, asana,
+            fixture.project_id, current_time_utc, tag_filter, None, None,
+            args.concurrency, None, args.batch)
+    return run
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_compare(args):
+    '''Compares the phase timings of two e2e result files.'''
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.current) as current_file:
+        current = json.load(current_file)
+    print 'baseline {0}, current {1}'.format(
+        baseline.get('commit'), current.get('commit'))
+    baseline_runs = dict((run['tasks'], run) for run in baseline['runs'])
+    print '{0:>8} {1:<15} {2:>12} {3:>12} {4:>8}'.format(
+        'tasks', 'phase', 'baseline ms', 'current ms', 'ratio')
+    for run in current['runs']:
+        baseline_run = baseline_runs.get(run['tasks'])
+        if baseline_run is None:
+            continue
+        for phase in sorted(run['phases']):
+            if phase not in baseline_run['phases']:
+                continue
+            before = baseline_run['phases'][phase]
+            after = run['phases'][phase]
+            print '{0:>8} {1:<15} {2:>12.1f} {3:>12.1f} {4:>8.2f}'.format(
+                run['tasks'], phase, before, after,
+                after / before if before else float('nan'))
+
+
+def bench_replay_server(args):
+    '''Serves a cassette recorded with asana_mailer.py --record over HTTP,
+    for runs with --api-url pointed at it, until interrupted.
+    '''
+    replayer = asana_mailer.CassetteReplayer(
+        asana_mailer.Cassette.load(args.cassette), None,
+        latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+        error_rate=args.error_rate, error_status=args.error_status)
+    server = CassetteServer(replayer, args.port)
+    print 'Replaying {0} at {1}'.format(args.cassette, server.api_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print '{0} calls, {1} injected errors'.format(
+        replayer.calls, replayer.errors)
+
+
+def create_cli_parser():
+    parser = argparse.ArgumentParser(
+        description='Runs Asana Mailer microbenchmarks')
+    subparsers = parser.add_subparsers()
+
+    templates_parser = subparsers.add_parser(
+        'templates', help='cold versus warm template rendering')
+    templates_parser.add_argument(
+        '--tasks', type=int, default=10, metavar='N',
+        help='the number of tasks in the rendered project (default: 10)')
+    templates_parser.add_argument(
+        '--comments', type=int, default=5, metavar='N',
+        help='the number of comments on each task (default: 5)')
+    templates_parser.add_argument(
+        '--repeat', type=int, default=20, metavar='N',
+        help='the number of timings to take the best of (default: 20)')
+    templates_parser.set_defaults(func=bench_templates)
+
+    inline_parser = subparsers.add_parser(
+        'inline', help='premailer versus the cached CSS inliner')
+    inline_parser.add_argument(
+        '--tasks', type=int, default=5000, metavar='N',
+        help='the number of tasks in the rendered project (default: 5000)')
+    inline_parser.add_argument(
+        '--template', default='Project_Styled.html',
+        help='the HTML template to render (default: Project_Styled.html)')
+    inline_parser.add_argument(
+        '--repeat', type=int, default=1, metavar='N',
+        help='the number of timings to take the best of (default: 1)')
+    inline_parser.set_defaults(func=bench_inline)
+
+    minify_parser = subparsers.add_parser(
+        'minify', help='HTML size and time to minify it, after inlining')
+    minify_parser.add_argument(
+        '--tasks', type=int, default=5000, metavar='N',
+        help='the number of tasks in the rendered project (default: 5000)')
+    minify_parser.add_argument(
+        '--template', default='Project_Styled.html',
+        help='the HTML template to render (default: Project_Styled.html)')
+    minify_parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='the number of timings to take the best of (default: 3)')
+    minify_parser.set_defaults(func=bench_minify)
+
+    sections_parser = subparsers.add_parser(
+        'sections', help='making tasks from JSON, with and without filters')
+    sections_parser.add_argument(
+        '--tasks', type=int, default=10000, metavar='N',
+        help='the number of tasks in the project (default: 10000)')
+    sections_parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='the number of timings to take the best of (default: 3)')
+    sections_parser.set_defaults(func=bench_sections)
+
+    tags_parser = subparsers.add_parser(
+        'tags', help='tag expressions, per task versus on a tag index')
+    tags_parser.add_argument(
+        '--tasks', type=int, default=100000, metavar='N',
+        help='the number of tasks in the project (default: 100000)')
+    tags_parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='the number of timings to take the best of (default: 3)')
+    tags_parser.set_defaults(func=bench_tags)
+
+    snapshot_parser = subparsers.add_parser(
+        'snapshot', help='saving and loading a project snapshot')
+    snapshot_parser.add_argument(
+        '--tasks', type=int, default=10000, metavar='N',
+        help='the number of tasks in the project (default: 10000)')
+    snapshot_parser.add_argument(
+        '--comments', type=int, default=3, metavar='N',
+        help='the number of comments on each task (default: 3)')
+    snapshot_parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='the number of timings to take the best of (default: 3)')
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    dates_parser = subparsers.add_parser(
+        'dates', help='dateutil versus the ISO-8601 timestamp parser')
+    dates_parser.add_argument(
+        '--timestamps', type=int, default=100000, metavar='N',
+        help='the number of timestamps to parse (default: 100000)')
+    dates_parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='the number of timings to take the best of (default: 3)')
+    dates_parser.set_defaults(func=bench_dates)
+
+    smtp_parser = subparsers.add_parser(
+        'smtp', help='sending many messages, with and without a MailTransport')
+    smtp_parser.add_argument(
+        '--messages', type=int, default=200, metavar='N',
+        help='the number of messages to send (default: 200)')
+    smtp_parser.add_argument(
+        '--size', type=int, default=20, metavar='KB',
+        help='the size of each message (default: 20)')
+    smtp_parser.add_argument(
+        '--recipients', type=int, default=10, metavar='N',
+        help='the number of recipients of each message (default: 10)')
+    smtp_parser.add_argument(
+        '--connections', type=int, default=4, metavar='N',
+        help='the connections for the pooled transport (default: 4)')
+    smtp_parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='the number of timings to take the best of (default: 3)')
+    smtp_parser.set_defaults(func=bench_smtp)
+
+    e2e_parser = subparsers.add_parser(
+        'e2e', help='each phase of a run, against a stub Asana and SMTP sink')
+    e2e_parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10, 1000, 10000, 100000],
+        metavar='N',
+        help='the numbers of tasks to run with (default: 10 1000 10000 '
+        '100000)')
+    e2e_parser.add_argument(
+        '--comments', type=int, default=3, metavar='N',
+        help='the mean number of comments on each task (default: 3)')
+    e2e_parser.add_argument(
+        '--concurrency', type=int, default=8, metavar='N',
+        help='the number of API calls to make at once (default: 8)')
+    e2e_parser.add_argument(
+        '--batch', action='store_true',
+        help='fetch comments through batched calls')
+    e2e_parser.add_argument(
+        '--filter-expr', default='NOT tag0',
+        help='the tag expression to filter on (default: "NOT tag0")')
+    e2e_parser.add_argument(
+        '--html-template', default='Project_Styled.html',
+        help='the HTML template (default: Project_Styled.html)')
+    e2e_parser.add_argument(
+        '--text-template', default='Default.markdown',
+        help='the text template (default: Default.markdown)')
+    e2e_parser.add_argument(
+        '--repeat', type=int, default=1, metavar='N',
+        help='the number of runs to take the best phase times of (default: '
+        '1)')
+    e2e_parser.add_argument(
+        '--output', metavar='FILE',
+        help='a file to write the results to as JSON')
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare the results of two e2e runs')
+    compare_parser.add_argument('baseline', help='the earlier results file')
+    compare_parser.add_argument('current', help='the later results file')
+    compare_parser.set_defaults(func=bench_compare)
+
+    replay_parser = subparsers.add_parser(
+        'replay-server', help='serve a recorded cassette as a stand-in for '
+        "Asana's API")
+    replay_parser.add_argument(
+        'cassette', help='a cassette recorded with asana_mailer.py --record')
+    replay_parser.add_argument(
+        '--port', type=int, default=8080,
+        help='the port to listen on (default: 8080)')
+    replay_parser.add_argument(
+        '--latency', type=float, default=0, metavar='MS',
+        help='milliseconds to delay each call by (default: 0)')
+    replay_parser.add_argument(
+        '--jitter', type=float, default=0, metavar='MS',
+        help='the most milliseconds to randomly vary the latency by '
+        '(default: 0)')
+    replay_parser.add_argument(
+        '--error-rate', type=float, default=0, metavar='RATE',
+        help='the fraction of calls to fail (default: 0)')
+    replay_parser.add_argument(
+        '--error-status', type=int, default=429, metavar='STATUS',
+        help='the HTTP status to fail calls with (default: 429)')
+    replay_parser.set_defaults(func=bench_replay_server)
+
+    memory_parser = subparsers.add_parser(
+        'memory',
+        help='the peak memory of holding a project, with the slotted domain '
+        'model and a dict-backed one')
+    memory_parser.add_argument(
+        '--tasks', type=int, default=100000, metavar='N',
+        help='the number of tasks in the project (default: 100000)')
+    memory_parser.add_argument(
+        '--comments', type=int, default=3, metavar='N',
+        help='the number of comments on each task (default: 3)')
+    memory_parser.set_defaults(func=bench_memory)
+
+    return parser
+
+
+def main():
+    args = create_cli_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,88 @@
 import argparse
+import BaseHTTPServer
 import codecs
 import datetime
+import email
 import glob
+import json
 import os
 import os.path
+import re
+import pstats
+import shutil
 import smtplib
+import socket
+import StringIO
+import tempfile
+import threading
 import unittest
 
 import dateutil
 import mock
 import nose
+import premailer
 import requests
 
 import asana_mailer
 
+from jinja2 import DictLoader, Environment
 from requests.exceptions import HTTPError
 
 
 class AsanaAPITestCase(unittest.TestCase):
 
-    @classmethod
-    def setup_class(cls):
-        cls.api = asana_mailer.AsanaAPI('api_key')
+    def setUp(self):
+        self.session_patcher = mock.patch('requests.Session')
+        self.mock_session = self.session_patcher.start().return_value
+        self.api = asana_mailer.AsanaAPI('api_key')
+
+    def tearDown(self):
+        self.session_patcher.stop()
 
     def test_init(self):
-        self.assertEqual(type(self).api.api_key, 'api_key')
+        self.assertEqual(self.api.api_key, 'api_key')
+        self.assertEqual(self.mock_session.auth, ('api_key', ''))
+        self.mock_session.headers.update.assert_called_once_with({
+            'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self.assertEqual(self.mock_session.mount.call_count, 2)
+        adapter = self.mock_session.mount.call_args[0][1]
+        self.assertEqual(
+            adapter._pool_maxsize, asana_mailer.AsanaAPI.default_pool_size)
+        self.assertEqual(self.api.timeout, (
+            asana_mailer.AsanaAPI.default_connect_timeout,
+            asana_mailer.AsanaAPI.default_read_timeout))
+
+        api = asana_mailer.AsanaAPI(
+            'api_key', pool_size=3, connect_timeout=1, read_timeout=2)
+        adapter = self.mock_session.mount.call_args[0][1]
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(api.timeout, (1, 2))
+
+    def test_close(self):
+        self.api.close()
+        self.mock_session.close.assert_called_once_with()
+        self.mock_session.close.reset_mock()
+        with asana_mailer.AsanaAPI('api_key') as api:
+            self.assertIsInstance(api, asana_mailer.AsanaAPI)
+        self.mock_session.close.assert_called_once_with()
 
     @mock.patch('json.loads')
-    @mock.patch('requests.get')
-    def test_get(self, mock_get_request, mock_json_loads):
-        api = type(self).api
+    def test_get(self, mock_json_loads):
+        api = self.api
+        mock_get_request = self.mock_session.get
         mock_response = mock_get_request.return_value
         mock_response.status_code = requests.codes.ok
         with self.assertRaises(AttributeError):
             api.get('not_an_endpoint')
         with self.assertRaises(KeyError):
             api.get('project', {'invalid_path_var': 'invalid'})
-        auth = ('api_key', '')
+        timeout = api.timeout
 
         # No Path Vars
         api.get('project')
         mock_get_request.assert_called_once_with('{0}{1}'.format(
-            api.asana_api_url, api.project_endpoint), params=None, auth=auth)
+            api.asana_api_url, api.project_endpoint), params=None,
+            timeout=timeout)
 
         mock_get_request.reset_mock()
         api.get('project', {'project_id': u'123'})
@@ -59,7 +100,7 @@ class AsanaAPITestCase(unittest.TestCase):
             project_id=u'123')
         mock_get_request.assert_called_once_with(
             '{0}{1}'.format(api.asana_api_url, full_endpoint),
-            params={'opt_expand': 'name'}, auth=auth)
+            params={'opt_expand': 'name'}, timeout=timeout)
 
         mock_response.reset_mock()
         mock_response.status_code = requests.codes.not_found
@@ -95,18 +136,532 @@ class AsanaAPITestCase(unittest.TestCase):
             mock.call(url='{}{}'.format(
                 type(api).asana_api_url,
                 type(api).project_endpoint.format(project_id=u'123')),
-                auth=auth),
+                timeout=timeout),
             mock.call(url='{}{}'.format(
                 type(api).asana_api_url,
                 type(api).project_tasks_endpoint.format(project_id=u'123')),
-                auth=auth),
+                timeout=timeout),
             mock.call(url='{}{}'.format(
                 type(api).asana_api_url,
                 type(api).task_stories_endpoint.format(task_id=u'123')),
-                auth=auth),
+                timeout=timeout),
         ])
 
 
+    def test_iter_pages(self):
+        api = self.api
+        pages = [
+            {u'data': [1, 2], u'next_page': {u'offset': u'a'}},
+            {u'data': [3, 4], u'next_page': {u'offset': u'b'}},
+            {u'data': [5], u'next_page': None},
+        ]
+        mock_response = self.mock_session.get.return_value
+        mock_response.status_code = requests.codes.ok
+        mock_response.json.side_effect = pages
+        self.assertEquals(
+            list(api.iter_pages(
+                'project_tasks', {'project_id': u'123'}, expand='.',
+                params={'completed_since': 'now'}, page_size=2)),
+            [[1, 2], [3, 4], [5]])
+        url = '{0}{1}'.format(
+            api.asana_api_url,
+            api.project_tasks_endpoint.format(project_id=u'123'))
+        params = {'completed_since': 'now', 'opt_expand': '.', 'limit': 2}
+        self.assertEquals(self.mock_session.get.call_args_list, [
+            mock.call(url, params=params, timeout=api.timeout),
+            mock.call(
+                url, params=dict(params, offset=u'a'), timeout=api.timeout),
+            mock.call(
+                url, params=dict(params, offset=u'b'), timeout=api.timeout),
+        ])
+
+        mock_response.json.side_effect = pages[-1:]
+        self.assertEquals(list(api.iter_items('project_tasks')), [5])
+        self.mock_session.get.assert_called_with(
+            '{0}{1}'.format(api.asana_api_url, api.project_tasks_endpoint),
+            params={'limit': api.default_page_size}, timeout=api.timeout)
+
+        # Errors fetching a later page surface in the consumer
+        error_response = mock.MagicMock()
+        error_response.status_code = requests.codes.not_found
+        error_response.content = None
+        error_response.raise_for_status.side_effect = HTTPError()
+        mock_response.json.side_effect = pages[:1]
+        self.mock_session.get.side_effect = [mock_response, error_response]
+        pages_iter = api.iter_pages('project_tasks')
+        self.assertEquals(next(pages_iter), [1, 2])
+        with self.assertRaises(HTTPError):
+            next(pages_iter)
+
+
+    def test_get_cached(self):
+        cache = asana_mailer.ResponseCache(':memory:', ttl=60)
+        api = asana_mailer.AsanaAPI('api_key', cache=cache)
+        mock_response = self.mock_session.get.return_value
+        mock_response.status_code = requests.codes.ok
+        mock_response.content = '{"data": {"name": "Project"}}'
+        mock_response.json.return_value = {u'data': {u'name': u'Project'}}
+        mock_response.headers = {'ETag': '"abc"'}
+        url = '{0}{1}'.format(api.asana_api_url, api.project_endpoint)
+
+        # Miss, then a fresh hit that never touches the network
+        self.assertEquals(api.get('project'), {u'name': u'Project'})
+        self.mock_session.get.assert_called_once_with(
+            url, params=None, timeout=api.timeout, headers={})
+        self.assertEquals(api.get('project'), {u'name': u'Project'})
+        self.assertEquals(self.mock_session.get.call_count, 1)
+
+        # Stale entries are revalidated with their validators
+        cache.ttl = 0
+        mock_response.status_code = requests.codes.not_modified
+        self.assertEquals(api.get('project'), {u'name': u'Project'})
+        self.mock_session.get.assert_called_with(
+            url, params=None, timeout=api.timeout,
+            headers={'If-None-Match': '"abc"'})
+        self.assertEquals(cache.stats(), {
+            'hits': 1, 'revalidations': 1, 'misses': 1,
+            'round_trips_saved': 1,
+            'bytes_saved': 2 * len(mock_response.content)})
+
+        # Errors are still raised, and never cached
+        mock_response.status_code = requests.codes.not_found
+        mock_response.raise_for_status.side_effect = HTTPError()
+        with self.assertRaises(HTTPError):
+            api.get('project', {'project_id': u'123'})
+        self.assertIsNone(cache.lookup(asana_mailer.ResponseCache.key(
+            api.endpoint_url('project', {'project_id': u'123'}), None,
+            'api_key')))
+
+        # Another API key sharing the cache never sees these responses
+        mock_response.status_code = requests.codes.ok
+        mock_response.raise_for_status.side_effect = None
+        cache.ttl = 60
+        other_api = asana_mailer.AsanaAPI('other_key', cache=cache)
+        self.mock_session.get.reset_mock()
+        self.assertEquals(other_api.get('project'), {u'name': u'Project'})
+        self.mock_session.get.assert_called_once_with(
+            url, params=None, timeout=api.timeout, headers={})
+
+
+    def test_get_rate_limited(self):
+        throttled = mock.MagicMock()
+        throttled.status_code = requests.codes.too_many_requests
+        throttled.headers = {'Retry-After': '0.01'}
+        ok = mock.MagicMock()
+        ok.status_code = requests.codes.ok
+        ok.json.return_value = {u'data': u'data'}
+        scheduler = asana_mailer.RequestScheduler(rate=0)
+        api = asana_mailer.AsanaAPI('api_key', scheduler=scheduler)
+        self.mock_session.get.side_effect = [throttled, throttled, ok]
+        self.assertEquals(api.get('project'), u'data')
+        self.assertEquals(self.mock_session.get.call_count, 3)
+        self.assertEquals(scheduler.throttles, 2)
+
+        # Give up after max_retries, raising the 429
+        throttled.headers = {}
+        throttled.raise_for_status.side_effect = HTTPError()
+        self.mock_session.get.reset_mock()
+        self.mock_session.get.side_effect = None
+        self.mock_session.get.return_value = throttled
+        with mock.patch.object(asana_mailer.AsanaAPI, 'max_retries', 1), \
+                mock.patch.object(
+                    asana_mailer.AsanaAPI, '_retry_after', return_value=0):
+            with self.assertRaises(HTTPError):
+                api.get('project')
+        self.assertEquals(self.mock_session.get.call_count, 2)
+
+    def test_retry_after(self):
+        response = mock.MagicMock()
+        response.headers = {'Retry-After': '30'}
+        self.assertEquals(asana_mailer.AsanaAPI._retry_after(response, 0), 30)
+        response.headers = {}
+        self.assertEquals(asana_mailer.AsanaAPI._retry_after(response, 3), 8)
+
+
+class RequestSchedulerTestCase(unittest.TestCase):
+
+    def test_shared(self):
+        self.assertIs(
+            asana_mailer.RequestScheduler.shared(),
+            asana_mailer.RequestScheduler.shared())
+
+    def test_token_bucket(self):
+        scheduler = asana_mailer.RequestScheduler(rate=100, burst=1)
+        start = datetime.datetime.now()
+        for _ in xrange(6):
+            scheduler.acquire()
+            scheduler.release()
+        elapsed = datetime.datetime.now() - start
+        self.assertGreaterEqual(elapsed, datetime.timedelta(seconds=0.045))
+
+    def test_concurrency_limit(self):
+        scheduler = asana_mailer.RequestScheduler(rate=0, max_concurrency=1)
+        scheduler.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            scheduler.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        scheduler.release()
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_aimd(self):
+        scheduler = asana_mailer.RequestScheduler(
+            rate=0, max_concurrency=8, latency_target=1)
+        scheduler.record_throttle(0)
+        self.assertEquals(scheduler.concurrency, 4)
+        # Congestion reported by calls already in flight is ignored
+        scheduler.record_throttle(0)
+        scheduler.record_response(2)
+        self.assertEquals(scheduler.concurrency, 4)
+        for _ in xrange(5):
+            scheduler.record_response(0.1)
+        self.assertEquals(int(scheduler.concurrency), 5)
+        for _ in xrange(100):
+            scheduler.record_response(0.1)
+        self.assertEquals(scheduler.concurrency, 8)
+        with mock.patch.object(
+                asana_mailer.RequestScheduler, 'decrease_interval', 0):
+            scheduler.record_response(2)
+            self.assertEquals(scheduler.concurrency, 4)
+            for _ in xrange(5):
+                scheduler.record_throttle(0)
+            self.assertEquals(scheduler.concurrency, 1)
+
+    def test_throttle_pauses(self):
+        scheduler = asana_mailer.RequestScheduler(rate=0)
+        scheduler.record_throttle(0.05)
+        start = datetime.datetime.now()
+        scheduler.acquire()
+        self.assertGreaterEqual(
+            datetime.datetime.now() - start,
+            datetime.timedelta(seconds=0.04))
+
+
+class StubBatchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves Asana's batch envelope for stories of numeric task ids.
+
+    Task ids that aren't numeric fail with a 404 inside the batch, and
+    actions that put options in their data fail with a 400, as Asana's do.
+    '''
+
+    stories_path = re.compile(r'^/tasks/(\w+)/stories$')
+    option_params = frozenset(('opt_fields', 'opt_expand', 'limit', 'offset'))
+
+    def do_POST(self):
+        request = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))
+        self.batch_sizes.append(len(request['data']['actions']))
+        results = []
+        for action in request['data']['actions']:
+            task_id = self.stories_path.match(
+                action['relative_path']).group(1)
+            options = action.get('options', {})
+            self.options.append(options)
+            if (set(action) - set(('relative_path', 'method', 'data',
+                                   'options')) or
+                    action['method'] != 'get' or
+                    self.option_params & set(action['data']) or
+                    set(options) - set(('fields', 'expand', 'limit',
+                                        'offset')) or
+                    not isinstance(options.get('fields', []), list)):
+                results.append({'status_code': 400, 'headers': {}, 'body': {
+                    'errors': [{'message': 'Invalid action'}]}})
+            elif task_id.isdigit():
+                results.append({'status_code': 200, 'headers': {}, 'body': {
+                    'data': [
+                        {'type': 'comment', 'text': task_id},
+                        {'type': 'system', 'text': 'added to project'},
+                    ]}})
+            else:
+                results.append({'status_code': 404, 'headers': {}, 'body': {
+                    'errors': [{'message': 'task: Unknown object'}]}})
+        self.send_json({'data': results})
+
+    def do_GET(self):
+        self.gets.append(self.path)
+        self.send_response(404)
+        self.end_headers()
+
+    def send_json(self, body):
+        content = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BatchTestCase(unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), StubBatchHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubBatchHandler.batch_sizes = []
+        StubBatchHandler.gets = []
+        StubBatchHandler.options = []
+        self.api = asana_mailer.AsanaAPI(
+            'api_key', api_url='http://127.0.0.1:{0}/'.format(
+                type(self).server.server_address[1]))
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_get_batch(self):
+        results = self.api.get_batch([
+            ('task_stories', {'task_id': u'1'}),
+            ('task_stories', {'task_id': u'missing'}, {'limit': 5}),
+        ])
+        self.assertEquals(results[0], [
+            {u'type': u'comment', u'text': u'1'},
+            {u'type': u'system', u'text': u'added to project'},
+        ])
+        self.assertIsInstance(results[1], HTTPError)
+        self.assertIn('task: Unknown object', str(results[1]))
+        self.assertEquals(StubBatchHandler.options, [{}, {u'limit': 5}])
+        with self.assertRaises(ValueError):
+            self.api.get_batch(
+                [('task_stories', {'task_id': u'1'})] *
+                (self.api.batch_limit + 1))
+
+    def test_get_batch_task_comments(self):
+        self.assertEquals(
+            asana_mailer.get_batch_task_comments(self.api, [u'1', u'2']),
+            [[{u'type': u'comment', u'text': u'1'}],
+             [{u'type': u'comment', u'text': u'2'}]])
+        # Story fields are requested through each action's options
+        StubBatchHandler.options = []
+        self.assertEquals(
+            asana_mailer.get_batch_task_comments(
+                self.api, [u'1'], fields=['text']),
+            [[{u'type': u'comment', u'text': u'1'}]])
+        self.assertEquals(StubBatchHandler.options, [
+            {u'fields': [u'text', u'type']}])
+        self.assertEquals(StubBatchHandler.gets, [])
+        # Failed actions are retried alone, which raises their error
+        with self.assertRaises(HTTPError):
+            asana_mailer.get_batch_task_comments(
+                self.api, [u'1', u'missing'])
+        self.assertEquals(StubBatchHandler.gets, ['/tasks/missing/stories'])
+
+    def test_create_project(self):
+        project_tasks_json = [
+            {
+                u'id': i, u'name': u'Task #{0}'.format(i),
+                u'assignee': None, u'completed': False, u'notes': None,
+                u'due_on': None, u'tags': []
+            }
+            for i in xrange(25)
+        ]
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        for concurrency in (1, 3):
+            StubBatchHandler.batch_sizes = []
+            with mock.patch.object(self.api, 'get') as mock_get, \
+                    mock.patch.object(self.api, 'iter_items') as mock_items:
+                mock_get.return_value = {u'name': u'Project', u'notes': None}
+                mock_items.return_value = iter(project_tasks_json)
+                project = asana_mailer.Project.create_project(
+                    self.api, u'123', current_time_utc, batch=True,
+                    concurrency=concurrency)
+            self.assertEquals(
+                sorted(StubBatchHandler.batch_sizes), [5, 10, 10])
+            self.assertEquals(
+                [task.comments for task in project.sections[0].tasks],
+                [[asana_mailer.Comment(unicode(i), None, None)]
+                 for i in xrange(25)])
+
+
+class CassetteTestCase(unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), StubBatchHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubBatchHandler.batch_sizes = []
+        StubBatchHandler.gets = []
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'cassette.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_key(self):
+        key = asana_mailer.Cassette.key(
+            'get', 'projects/1/tasks?limit=100&completed_since=2013-01-01')
+        self.assertEquals(key, asana_mailer.Cassette.key(
+            'GET', '/projects/1/tasks?completed_since=2013-01-01&limit=100'))
+        self.assertEquals(
+            asana_mailer.Cassette.key(
+                'POST', 'batch', '{"b": 1, "a": [2]}'),
+            asana_mailer.Cassette.key(
+                'POST', 'batch', '{"a": [2], "b": 1}'))
+
+    def test_lookup(self):
+        cassette = asana_mailer.Cassette()
+        key = asana_mailer.Cassette.key(
+            'GET', 'projects/1/tasks?limit=100&completed_since=2013-01-01')
+        cassette.record(key, 200, {
+            'Content-Type': 'application/json', 'Date': 'today'}, 'first')
+        cassette.record(key, 200, {}, 'second')
+        # Responses are replayed in order, repeating the last one
+        self.assertEquals(cassette.lookup(key), (
+            200, {'Content-Type': 'application/json'}, 'first'))
+        self.assertEquals(cassette.lookup(key), (200, {}, 'second'))
+        self.assertEquals(cassette.lookup(key), (200, {}, 'second'))
+        # Volatile parameters are matched loosely
+        self.assertEquals(cassette.lookup(asana_mailer.Cassette.key(
+            'GET', 'projects/1/tasks?limit=100&completed_since=2014-01-01'
+        ))[2], 'first')
+        self.assertIsNone(cassette.lookup(asana_mailer.Cassette.key(
+            'GET', 'projects/1/tasks?limit=50')))
+
+    def test_record_and_replay(self):
+        api_url = 'http://127.0.0.1:{0}/'.format(
+            type(self).server.server_address[1])
+        recorder = asana_mailer.CassetteRecorder(
+            asana_mailer.Cassette(self.path), api_url)
+        with asana_mailer.AsanaAPI(
+                'api_key', api_url=api_url, adapter=recorder) as api:
+            comments = asana_mailer.get_batch_task_comments(
+                api, [u'1', u'2'])
+            with self.assertRaises(HTTPError):
+                api.get('project', {'project_id': u'1'})
+        self.assertEquals(
+            len(asana_mailer.Cassette.load(self.path).entries), 2)
+
+        # Replayed in-process, against any base URL
+        replay_url = 'https://app.example.com/api/1.0/'
+        replayer = asana_mailer.CassetteReplayer(
+            asana_mailer.Cassette.load(self.path), replay_url)
+        with asana_mailer.AsanaAPI(
+                'api_key', api_url=replay_url, adapter=replayer) as api:
+            self.assertEquals(
+                asana_mailer.get_batch_task_comments(api, [u'1', u'2']),
+                comments)
+            with self.assertRaises(HTTPError):
+                api.get('project', {'project_id': u'1'})
+            # Calls that weren't recorded fail
+            with self.assertRaises(HTTPError):
+                api.get('task_stories', {'task_id': u'3'})
+        self.assertEquals(replayer.calls, 3)
+        self.assertEquals(len(StubBatchHandler.batch_sizes), 1)
+
+    @mock.patch('time.sleep')
+    def test_injected_latency_and_errors(self, mock_sleep):
+        cassette = asana_mailer.Cassette()
+        key = asana_mailer.Cassette.key('GET', 'projects/1')
+        cassette.record(key, 200, {}, '{"data": {"name": "Project"}}')
+        replayer = asana_mailer.CassetteReplayer(
+            cassette, 'http://asana/', latency=0.5, jitter=0.25, seed=0)
+        for _ in xrange(10):
+            self.assertEquals(replayer.respond('GET', 'projects/1')[0], 200)
+        delays = [call[0][0] for call in mock_sleep.call_args_list]
+        self.assertEquals(len(delays), 10)
+        self.assertTrue(all(0.25 <= delay <= 0.75 for delay in delays))
+        self.assertNotEquals(len(set(delays)), 1)
+
+        # Injected rate limit errors are retried by AsanaAPI
+        replayer = asana_mailer.CassetteReplayer(
+            cassette, 'http://asana/', error_rate=0.5, seed=1)
+        with asana_mailer.AsanaAPI(
+                'api_key', api_url='http://asana/', adapter=replayer,
+                scheduler=asana_mailer.RequestScheduler(rate=0)) as api:
+            for _ in xrange(5):
+                self.assertEquals(
+                    api.get('project', {'project_id': u'1'}),
+                    {u'name': u'Project'})
+        self.assertEquals(replayer.calls, 5 + replayer.errors)
+        self.assertTrue(replayer.errors > 0)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = asana_mailer.ResponseCache(':memory:', max_bytes=10)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_key(self):
+        self.assertEquals(
+            asana_mailer.ResponseCache.key('url', {'b': 1, 'a': 2}),
+            asana_mailer.ResponseCache.key('url', {'a': 2, 'b': 1}))
+        self.assertNotEqual(
+            asana_mailer.ResponseCache.key('url', None),
+            asana_mailer.ResponseCache.key('url', {'a': 2}))
+        key = asana_mailer.ResponseCache.key('url', None, 'key one')
+        self.assertNotEqual(
+            key, asana_mailer.ResponseCache.key('url', None, 'key two'))
+        self.assertNotIn('key one', key)
+
+    def test_store_and_lookup(self):
+        self.assertIsNone(self.cache.lookup('key'))
+        self.cache.store('key', 'body', '"etag"', 'Tue, 01 Jan 2013')
+        entry = self.cache.lookup('key')
+        self.assertEquals(entry.body, 'body')
+        self.assertEquals(entry.validators(), {
+            'If-None-Match': '"etag"',
+            'If-Modified-Since': 'Tue, 01 Jan 2013'})
+        self.assertFalse(self.cache.is_fresh(entry))
+        self.cache.ttl = 60
+        self.assertTrue(self.cache.is_fresh(entry))
+
+    @mock.patch('time.time')
+    def test_evict(self, mock_time):
+        for i, key in enumerate(('a', 'b', 'c')):
+            mock_time.return_value = i
+            self.cache.store(key, 'four')
+        # 'a' was least recently used, so it makes room for 'c'
+        self.assertIsNone(self.cache.lookup('a'))
+        mock_time.return_value = 3
+        self.assertIsNotNone(self.cache.lookup('b'))
+        mock_time.return_value = 4
+        self.cache.store('d', 'four')
+        self.assertIsNone(self.cache.lookup('c'))
+        self.assertIsNotNone(self.cache.lookup('b'))
+        self.assertIsNotNone(self.cache.lookup('d'))
+
+
+class BackgroundCallTestCase(unittest.TestCase):
+
+    def test_get(self):
+        call = asana_mailer.BackgroundCall(
+            lambda first, second=0: first + second, 1, second=2)
+        self.assertEquals(call.get(), 3)
+        call = asana_mailer.BackgroundCall(int, 'not_an_int')
+        with self.assertRaises(ValueError):
+            call.get()
+
+
 class ProjectTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -125,19 +680,34 @@ class ProjectTestCase(unittest.TestCase):
             self.id, self.name, self.description, ['123'])
         self.assertEquals(self.project.sections, ['123'])
 
-    @mock.patch('asana_mailer.Project.filter_tasks')
-    @mock.patch('asana_mailer.Section.create_sections')
-    def test_create_project(self, mock_create_sections, mock_filter_tasks):
+    @staticmethod
+    def mock_asana(project_json, project_tasks_json, task_stories):
+        # Mock's own call counting isn't thread safe
+        calls = []
+
+        def get(endpoint_name, path_vars=None, expand=None, params=None):
+            calls.append(endpoint_name)
+            if endpoint_name == 'project':
+                return project_json
+            return task_stories[path_vars['task_id']]
+
         mock_asana = mock.MagicMock()
+        mock_asana.get.side_effect = get
+        mock_asana.iter_items.side_effect = (
+            lambda *args, **kwargs: iter(project_tasks_json))
+        mock_asana.calls = calls
+        return mock_asana
+
+    @mock.patch('asana_mailer.Project.filter_tasks')
+    def test_create_project(self, mock_filter_tasks):
         current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
-        now = current_time_utc.isoformat()
         project_json = {
             u'name': 'My Project',
             u'notes': 'My Project Description'
         }
         project_tasks_json = [
             {
-                'id': u'123', u'name': u'Test Section:',
+                u'id': u'123', u'name': u'Test Section:',
                 u'assignee': None, u'completed': False,
                 u'notes': u'test_description', u'due_on': None,
                 u'tags': []
@@ -148,123 +718,257 @@ class ProjectTestCase(unittest.TestCase):
                 u'completed': False,
                 u'notes': u'more_test_description',
                 u'due_on': None,
+                u'tags': [{u'name': u'Tag #1'}]
+            },
+            {
+                u'id': u'789', u'name': u'Other Work',
+                u'assignee': None,
+                u'completed': False,
+                u'notes': None,
+                u'due_on': None,
                 u'tags': []
             },
         ]
-        task_comments_json = (
-            (
-                {u'text': u'blah', u'type': u'comment'},
-                {u'text': u'blah2', u'type': u'not_a_comment'}
-            ),
-            (
-                {u'text': u'blah', u'type': 'comment'},
-                {u'text': u'blah3', u'type': 'comment'}
-            )
-        )
-        all_calls = [project_json, project_tasks_json]
-        all_calls.extend(task_comments_json)
-        mock_asana.get.side_effect = all_calls
-        new_section = asana_mailer.Section(u'Test Section:')
-        new_tasks = (
-            asana_mailer.Task(
-                u'Do Work', u'test_user', True,
-                dateutil.parser.parse(now), u'test_description',
-                dateutil.parser.parse(now),
-                [u'Tag #{}'.format(i) for i in xrange(5)], [
-                    {u'text': u'blah', u'type': u'comment'},
-                    {u'text': u'blah2', u'type': u'not_a_comment'}
-                ]
-            ),
-            asana_mailer.Task(
-                u'More Work', None, False, None, u'more_test_description',
-                None, [], [
-                    {u'text': u'blah', u'type': 'comment'},
-                    {u'text': u'blah3', u'type': 'comment'}
-                ]
-            )
-        )
-        task_comments = {
-            u'123': [
+        task_stories = {
+            u'456': [
                 {u'text': u'blah', u'type': u'comment'},
+                {u'text': u'blah2', u'type': u'not_a_comment'},
+                {u'text': u'blah3', u'type': u'comment'}
             ],
-            u'456': [
-                {u'text': u'blah', u'type': 'comment'},
-                {u'text': u'blah3', u'type': 'comment'}
+            u'789': [
+                {u'text': u'blah', u'type': u'not_a_comment'},
             ]
         }
-        new_section.add_tasks(new_tasks)
-        new_sections = [new_section]
+        mock_asana = self.mock_asana(
+            project_json, project_tasks_json, task_stories)
 
-        mock_create_sections.return_value = new_sections
         # No Filters
         new_project = asana_mailer.Project.create_project(
             mock_asana, u'123', current_time_utc)
-        self.assertEquals(new_project.sections, new_sections)
-        mock_create_sections.assert_called_once_with(
-            project_tasks_json, task_comments)
-        mock_filter_tasks.assert_called_once_with(
-            current_time_utc, section_filters=None, task_filters=None)
+        self.assertEquals(new_project.name, 'My Project')
+        self.assertEquals(new_project.description, 'My Project Description')
+        self.assertEquals(len(new_project.sections), 1)
+        more_work, other_work = new_project.sections[0].tasks
+        self.assertEquals(more_work.id, u'456')
+        self.assertEquals(more_work.comments, [
+            asana_mailer.Comment(u'blah', None, None),
+            asana_mailer.Comment(u'blah3', None, None)
+        ])
+        # Task with no comments
+        self.assertIsNone(other_work.comments)
+        mock_asana.iter_items.assert_called_once_with(
+            'project_tasks', {'project_id': u'123'}, expand='.',
+            params={'completed_since': 'now'})
+        # Section rows never have their stories fetched
+        self.assertEquals(mock_asana.get.call_count, 3)
+        # Filtering happens as the tasks stream in, leaving none to do after
+        self.assertFalse(mock_filter_tasks.called)
 
         # Completed Lookback
-        mock_create_sections.return_value = new_sections
-        mock_asana.get.side_effect = all_calls
+        mock_asana.reset_mock()
         lookback_hours = 10
         new_project = asana_mailer.Project.create_project(
             mock_asana, u'123', current_time_utc,
             completed_lookback_hours=lookback_hours)
         completed_since = (current_time_utc - datetime.timedelta(
             hours=lookback_hours)).replace(microsecond=0).isoformat()
-        mock_asana.get.assert_any_call(
+        mock_asana.iter_items.assert_called_once_with(
             'project_tasks', {'project_id': u'123'}, expand='.',
             params={'completed_since': completed_since})
 
         # Section Filters
         section_filters = (u'Other Section:',)
-        mock_filter_tasks.reset_mock()
-        mock_create_sections.reset_mock()
-        mock_asana.get.side_effect = all_calls
+        mock_asana.reset_mock()
         new_project = asana_mailer.Project.create_project(
             mock_asana, u'123', current_time_utc,
             section_filters=section_filters)
-        self.assertEquals(new_project.sections, new_sections)
-        mock_create_sections.assert_called_once_with(
-            project_tasks_json, {})
-        mock_filter_tasks.assert_called_once_with(
-            current_time_utc, section_filters=section_filters,
-            task_filters=None)
+        self.assertEquals(mock_asana.get.call_count, 1)
+        # Tasks outside the filtered sections are never made
+        self.assertEquals(new_project.sections, [])
+        self.assertFalse(mock_filter_tasks.called)
 
         # Task Filters
-        mock_filter_tasks.reset_mock()
-        mock_create_sections.reset_mock()
-        mock_asana.get.side_effect = all_calls
-        task_filters = [u'Tag #1']
+        mock_asana.reset_mock()
+        task_filters = frozenset([u'Tag #1'])
         new_project = asana_mailer.Project.create_project(
             mock_asana, u'123', current_time_utc,
             task_filters=task_filters)
-        self.assertEquals(new_project.sections, new_sections)
-        mock_create_sections.assert_called_once_with(
-            project_tasks_json, {})
-        mock_filter_tasks.assert_called_once_with(
-            current_time_utc, section_filters=None, task_filters=task_filters)
-
-        all_calls[-1] = (
-            {u'text': u'blah', u'type': 'not_a_comment'},
-            {u'text': u'blah3', u'type': 'not_a_comment'}
-        )
+        self.assertEquals(mock_asana.get.call_count, 2)
+        mock_asana.get.assert_called_with(
+            'task_stories', {'task_id': u'456'})
+        self.assertEquals(
+            [task.id for task in new_project.sections[0].tasks], [u'456'])
+        self.assertFalse(mock_filter_tasks.called)
 
-        # Task with no comments
-        mock_filter_tasks.reset_mock()
-        mock_create_sections.reset_mock()
-        mock_asana.get.side_effect = all_calls
-        new_project = asana_mailer.Project.create_project(
-            mock_asana, u'123', current_time_utc)
-        self.assertEquals(new_project.sections, new_sections)
-        remove_not_comments = dict(task_comments)
-        del remove_not_comments[u'456']
-        mock_create_sections.assert_called_once_with(
-            project_tasks_json, remove_not_comments)
-        mock_filter_tasks.assert_called_once_with(
-            current_time_utc, section_filters=None, task_filters=None)
+    def test_create_project_concurrent(self):
+        project_json = {u'name': u'My Project', u'notes': u'Description'}
+        project_tasks_json = [
+            {
+                u'id': i, u'name': u'Task #{0}'.format(i),
+                u'assignee': None, u'completed': False, u'notes': None,
+                u'due_on': None,
+                u'tags': [{u'name': u'Tag #{0}'.format(i % 2)}]
+            }
+            for i in xrange(20)
+        ]
+        task_stories = dict(
+            (unicode(i), [
+                {u'text': u'{0}'.format(i), u'type': u'comment'},
+                {u'text': u'skip', u'type': u'system'}
+            ]) for i in xrange(20))
+        mock_asana = self.mock_asana(
+            project_json, project_tasks_json, task_stories)
+
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        serial_project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc,
+            task_filters=frozenset((u'Tag #1',)))
+        del mock_asana.calls[:]
+        concurrent_project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc,
+            task_filters=frozenset((u'Tag #1',)), concurrency=4)
+        # Only tasks passing the tag filter have their stories fetched
+        self.assertEquals(len(mock_asana.calls), 11)
+        self.assertEquals(
+            [(t.id, t.comments) for t in serial_project.sections[0].tasks],
+            [(t.id, t.comments) for t in concurrent_project.sections[0].tasks])
+        for task in concurrent_project.sections[0].tasks:
+            if int(task.id) % 2:
+                self.assertEquals(
+                    task.comments, asana_mailer.Comment.from_stories(
+                        task_stories[task.id][:1]))
+            else:
+                self.assertIsNone(task.comments)
+
+    def test_create_project_state_store(self):
+        project_json = {u'name': u'My Project', u'notes': u'Description'}
+        project_tasks_json = [
+            {
+                u'id': i, u'name': u'Task #{0}'.format(i),
+                u'assignee': None, u'completed': False, u'notes': None,
+                u'due_on': None, u'tags': [],
+                u'modified_at': u'2013-01-01T00:00:00.000Z'
+            }
+            for i in xrange(3)
+        ]
+        task_stories = dict(
+            (unicode(i), [{u'text': u'{0}'.format(i), u'type': u'comment'}])
+            for i in xrange(3))
+        mock_asana = self.mock_asana(
+            project_json, project_tasks_json, task_stories)
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        state_store = asana_mailer.TaskStateStore(':memory:')
+
+        asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, state_store=state_store)
+        self.assertEquals(mock_asana.get.call_count, 4)
+
+        # Only the modified task has its comments fetched
+        task_stories[u'1'] = [{u'text': u'new', u'type': u'comment'}]
+        task_stories[u'2'] = [{u'text': u'unseen', u'type': u'comment'}]
+        project_tasks_json[1][u'modified_at'] = u'2013-01-02T00:00:00.000Z'
+        mock_asana.get.reset_mock()
+        project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, state_store=state_store)
+        self.assertEquals(mock_asana.get.call_count, 2)
+        mock_asana.get.assert_called_with('task_stories', {'task_id': u'1'})
+        self.assertEquals(
+            [task.comments[0].text for task in project.sections[0].tasks],
+            [u'0', u'new', u'2'])
+
+        # Stored comments expire after max_age
+        state_store.max_age = -1
+        mock_asana.get.reset_mock()
+        asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, state_store=state_store)
+        self.assertEquals(mock_asana.get.call_count, 4)
+
+    def test_create_project_state_store_fields(self):
+        project_json = {u'name': u'My Project', u'notes': u'Description'}
+        project_tasks_json = [{
+            u'id': u'1', u'name': u'Task',
+            u'modified_at': u'2013-01-01T00:00:00.000Z'}]
+        story = {
+            u'type': u'comment', u'text': u'blah',
+            u'created_at': u'2013-01-01T00:00:00.000Z',
+            u'created_by': {u'name': u'Someone'}}
+        mock_asana = self.mock_asana(
+            project_json, project_tasks_json, {u'1': [story]})
+
+        def get_stories(endpoint, path_vars=None, params=None):
+            if endpoint == 'project':
+                return project_json
+            # Only the requested fields come back
+            fields = [field.split('.')[0]
+                      for field in params['opt_fields'].split(',')]
+            return [{
+                field: value for field, value in story.iteritems()
+                if field in fields}]
+        mock_asana.get.side_effect = get_stories
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        state_store = asana_mailer.TaskStateStore(':memory:')
+
+        def create_project(*templates):
+            fields = asana_mailer.TemplateFields.from_templates(templates)
+            return asana_mailer.Project.create_project(
+                mock_asana, u'123', current_time_utc, state_store=state_store,
+                fields=fields)
+
+        create_project('Default.html', 'Default.markdown')
+        self.assertEquals(mock_asana.get.call_count, 2)
+        # Comments stored without created_at aren't reused by templates
+        # that need it
+        project = create_project(
+            'Last_Weeks_Comments.html', 'Last_Weeks_Comments.markdown')
+        self.assertEquals(mock_asana.get.call_count, 4)
+        self.assertEquals(
+            project.sections[0].tasks[0].comments[0].created_at,
+            story[u'created_at'])
+        # While comments stored with more fields are
+        create_project('Default.html', 'Default.markdown')
+        self.assertEquals(mock_asana.get.call_count, 5)
+
+    def test_create_project_fields(self):
+        project_json = {u'name': u'My Project', u'notes': u'Description'}
+        project_tasks_json = [
+            {u'id': u'1', u'name': u'Task', u'tags': [{u'name': u'Tag'}]},
+            {u'id': u'2', u'name': u'Other Task'},
+        ]
+        task_stories = {u'1': [{u'type': u'comment', u'text': u'blah'}]}
+        mock_asana = self.mock_asana(
+            project_json, project_tasks_json, task_stories)
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+
+        # Templates that never use comments skip stories entirely
+        fields = asana_mailer.TemplateFields(['tags.name'], None)
+        project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, fields=fields)
+        mock_asana.iter_items.assert_called_once_with(
+            'project_tasks', {'project_id': u'123'}, expand=None,
+            params={
+                'completed_since': 'now', 'opt_fields': 'name,tags.name'})
+        self.assertEquals(mock_asana.get.call_count, 1)
+        task, other_task = project.sections[0].tasks
+        self.assertEquals(task.tags, [u'Tag'])
+        self.assertIsNone(task.assignee)
+        self.assertFalse(task.completed)
+        self.assertEquals(other_task.tags, [])
+
+        mock_asana.reset_mock()
+        fields = asana_mailer.TemplateFields([], ['text'])
+        project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, fields=fields,
+            task_filters=frozenset([u'Tag']))
+        mock_asana.iter_items.assert_called_once_with(
+            'project_tasks', {'project_id': u'123'}, expand=None,
+            params={
+                'completed_since': 'now', 'opt_fields': 'name,tags.name'})
+        mock_asana.get.assert_called_with(
+            'task_stories', {'task_id': u'1'},
+            params={'opt_fields': 'text,type'})
+        self.assertEquals(
+            project.sections[0].tasks[0].comments,
+            asana_mailer.Comment.from_stories(task_stories[u'1']))
 
     def test_add_section(self):
         self.project.add_section('test')
@@ -325,6 +1029,168 @@ class ProjectTestCase(unittest.TestCase):
         self.assertEquals(len(self.project.sections), 1)
         self.assertEquals(len(self.project.sections[0].tasks), 1)
 
+        # Tag Expressions
+        other_section = asana_mailer.Section('Other Tasks')
+        other_section.add_task(incomplete_task)
+        section_with_tasks.add_task(incomplete_task)
+        self.project.sections = [section_with_tasks, other_section]
+        self.project.filter_tasks(
+            current_time_utc,
+            task_filters=asana_mailer.TagExpression.parse(u'NOT "Tag #1"'))
+        self.assertEquals(self.project.sections, [
+            section_with_tasks, other_section])
+        self.assertEquals(section_with_tasks.tasks, [incomplete_task])
+        self.assertEquals(other_section.tasks, [incomplete_task])
+
+    def test_snapshot(self):
+        section = asana_mailer.Section(u'Some Tasks:')
+        section.add_task(asana_mailer.Task.from_json({
+            u'id': 1, u'name': u'Done \u2713', u'completed': True,
+            u'completed_at': u'2015-01-01T12:00:00.000Z',
+            u'assignee': {u'name': u'test_user'}, u'notes': u'notes',
+            u'due_on': u'2015-01-02', u'tags': [{u'name': u'Tag #1'}]},
+            [{u'type': u'comment', u'text': u'blah',
+              u'created_at': u'2015-01-01T11:00:00.000Z',
+              u'created_by': {u'name': u'test_user'}}]))
+        section.add_task(asana_mailer.Task(
+            u'More Work', None, False, None, None, None, [], None))
+        self.project.sections = [asana_mailer.Section(u'Empty:'), section]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'project.snapshot')
+            self.project.save_snapshot(path)
+            project = asana_mailer.Project.load_snapshot(path)
+            with open(path, 'wb') as bad_file:
+                bad_file.write('not a snapshot')
+            self.assertRaises(
+                (IOError, ValueError), asana_mailer.Project.load_snapshot,
+                path)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEquals(
+            (project.id, project.name, project.description),
+            (self.project.id, self.project.name, self.project.description))
+        self.assertEquals(
+            [(s.name, len(s.tasks)) for s in project.sections],
+            [(u'Empty:', 0), (u'Some Tasks:', 2)])
+        for task, expected in zip(project.sections[1].tasks, section.tasks):
+            self.assertEquals(task.to_json(), expected.to_json())
+            self.assertEquals(task.comments, expected.comments)
+            self.assertEquals(task.completion_time, expected.completion_time)
+        self.assertEquals(project.sections[1].tasks[1].id, None)
+
+    def test_filtered_view(self):
+        tasks = [
+            asana_mailer.Task(
+                u'Task {0}'.format(i), None, False, None, None, None,
+                task_tags, None)
+            for i, task_tags in enumerate(
+                [[u'a'], [u'b'], [u'a', u'b'], [u'b']])]
+        self.project.sections = [
+            asana_mailer.Section(u'One:', tasks[:2]),
+            asana_mailer.Section(u'Two:', tasks[2:])]
+        view = self.project.filtered_view(
+            task_filters=frozenset([u'a']),
+            tag_index=self.project.tag_index())
+        self.assertEquals(
+            [(s.name, s.tasks) for s in view.sections],
+            [(u'One:', [tasks[0]]), (u'Two:', [tasks[2]])])
+        view = self.project.filtered_view(
+            section_filters=frozenset([u'Two:']),
+            task_filters=asana_mailer.TagExpression.parse(u'NOT a'))
+        self.assertEquals(
+            [(s.name, s.tasks) for s in view.sections],
+            [(u'Two:', [tasks[3]])])
+        self.assertEquals(
+            len(self.project.filtered_view(
+                task_filters=frozenset([u'c'])).sections), 0)
+        self.assertEquals(self.project.filtered_view().name, self.name)
+        # The project itself is untouched
+        self.assertEquals(
+            [s.tasks for s in self.project.sections],
+            [tasks[:2], tasks[2:]])
+
+
+class TagExpressionTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        parse = asana_mailer.TagExpression.parse
+        tag = asana_mailer.TagExpression.tag
+        expression = parse(u'a OR b AND NOT c')
+        self.assertEquals(expression, asana_mailer.TagExpression('or', (
+            tag(u'a'), asana_mailer.TagExpression('and', (
+                tag(u'b'),
+                asana_mailer.TagExpression('not', (tag(u'c'),))))
+        )))
+        self.assertEquals(parse(u'(a OR b) AND c').tags(), frozenset(
+            (u'a', u'b', u'c')))
+        self.assertEquals(
+            parse(u'\'AND\' AND "two words"'),
+            asana_mailer.TagExpression.all_of((u'two words', u'AND')))
+        for text in (u'(a OR b) AND c', u'a OR b AND NOT c',
+                     u'"two words" AND NOT (\'say "hi"\' OR "OR")'):
+            self.assertEquals(parse(unicode(parse(text))), parse(text))
+        for text in (u'', u'a AND', u'(a OR b', u'a b', u'"a', u')',
+                     u'a OR OR'):
+            with self.assertRaises(ValueError):
+                parse(text)
+
+    def test_coerce(self):
+        coerce = asana_mailer.TagExpression.coerce
+        self.assertIsNone(coerce(None))
+        self.assertIsNone(coerce(frozenset()))
+        expression = asana_mailer.TagExpression.parse(u'a OR b')
+        self.assertIs(coerce(expression), expression)
+        self.assertEquals(
+            coerce(frozenset((u'b', u'a'))),
+            asana_mailer.TagExpression.parse(u'a AND b'))
+
+    def test_any_of(self):
+        any_of = asana_mailer.TagExpression.any_of
+        parse = asana_mailer.TagExpression.parse
+        self.assertEquals(
+            any_of([frozenset((u'a', u'b')), parse(u'NOT c')]),
+            parse(u'(a AND b) OR NOT c'))
+        self.assertIsNone(any_of([parse(u'a'), frozenset()]))
+
+    def test_matches_and_select(self):
+        tags = [[u'a'], [u'a', u'b'], [u'b', u'c'], []]
+        tasks = [
+            asana_mailer.Task(
+                u'Task {0}'.format(i), None, False, None, u'', None,
+                task_tags, [])
+            for i, task_tags in enumerate(tags)]
+        index = asana_mailer.TagIndex(tasks)
+        self.assertEquals(index.all_positions, frozenset(xrange(4)))
+        self.assertEquals(index.positions(u'b'), frozenset((1, 2)))
+        self.assertEquals(index.positions(u'd'), frozenset())
+        for text, expected in (
+                (u'a', (0, 1)),
+                (u'a AND b', (1,)),
+                (u'a OR c', (0, 1, 2)),
+                (u'NOT b', (0, 3)),
+                (u'NOT (a OR b)', (3,)),
+                (u'd OR NOT d', (0, 1, 2, 3))):
+            expression = asana_mailer.TagExpression.parse(text)
+            self.assertEquals(expression.select(index), frozenset(expected))
+            self.assertEquals(
+                tuple(i for i, task_tags in enumerate(tags)
+                      if expression.matches(frozenset(task_tags))),
+                expected)
+
+    def test_create_tag_filter(self):
+        self.assertEquals(
+            asana_mailer.create_tag_filter(['a', 'b']),
+            frozenset((u'a', u'b')))
+        self.assertEquals(
+            asana_mailer.create_tag_filter([], 'a OR b'),
+            asana_mailer.TagExpression.parse(u'a OR b'))
+        self.assertEquals(
+            asana_mailer.create_tag_filter(['c'], 'a OR b'),
+            asana_mailer.TagExpression.parse(u'c AND (a OR b)'))
+        with self.assertRaises(ValueError):
+            asana_mailer.create_tag_filter([], 'a AND')
+
 
 class SectionTestCase(unittest.TestCase):
 
@@ -397,8 +1263,8 @@ class SectionTestCase(unittest.TestCase):
         self.assertEquals(first_task.description, u'test_description')
         self.assertEquals(first_task.due_date, now)
         self.assertEquals(first_task.comments, [
-            {u'text': u'blah', u'type': 'comment'},
-            {u'text': u'blah3', u'type': 'comment'}
+            asana_mailer.Comment(u'blah', None, None),
+            asana_mailer.Comment(u'blah3', None, None)
         ])
         self.assertEquals(
             first_task.tags, [u'Tag #{}'.format(i) for i in xrange(5)])
@@ -411,6 +1277,14 @@ class SectionTestCase(unittest.TestCase):
         self.assertIsNone(second_task.due_date)
         self.assertEquals(second_task.tags, [])
 
+        # Kept tasks are passed on with their JSON as they are made
+        on_task = mock.Mock()
+        sections = asana_mailer.Section.create_sections(
+            project_tasks_json, task_comments,
+            task_filters=frozenset([u'Tag #1']), on_task=on_task)
+        on_task.assert_called_once_with(
+            sections[0].tasks[0], project_tasks_json[1])
+
         project_tasks_json.append(
             {u'id': u'654', u'name': u'Section With No Tasks:'})
         sections = asana_mailer.Section.create_sections(
@@ -440,6 +1314,25 @@ class SectionTestCase(unittest.TestCase):
         self.assertIsNone(misc_task.due_date)
         self.assertEquals(misc_task.tags, [])
 
+        # Filtered out tasks are never parsed
+        with mock.patch(
+                'asana_mailer.Task.from_json',
+                wraps=asana_mailer.Task.from_json) as mock_from_json:
+            sections = asana_mailer.Section.create_sections(
+                project_tasks_json, task_comments,
+                section_filters=frozenset([u'Test Section:']),
+                task_filters=frozenset([u'Tag #1']))
+            mock_from_json.assert_called_once_with(
+                project_tasks_json[2], task_comments[u'321'])
+        self.assertEquals(
+            [(section.name, len(section.tasks)) for section in sections],
+            [(u'Test Section:', 1)])
+
+        sections = asana_mailer.Section.create_sections(
+            project_tasks_json, task_comments,
+            section_filters=frozenset([u'Misc:']))
+        self.assertEquals([section.name for section in sections], [u'Misc:'])
+
     def test_add_task(self):
         self.section.add_task('test')
         self.assertNotIn('test', self.section.tasks)
@@ -456,6 +1349,131 @@ class SectionTestCase(unittest.TestCase):
         self.assertEquals(type(self).tasks, self.section.tasks)
 
 
+class CommentTestCase(unittest.TestCase):
+
+    def test_from_stories(self):
+        created_by = {u'name': u'User'}
+        comment = asana_mailer.Comment(u'Other', None, None)
+        comments = asana_mailer.Comment.from_stories([
+            {u'text': u'Text', u'created_at': u'2015-01-02T03:04:05.000Z',
+             u'created_by': created_by, u'type': u'comment'},
+            {u'text': u'Fields missing'}, comment])
+        self.assertEquals(comments[0].text, u'Text')
+        self.assertEquals(comments[0].created_at, u'2015-01-02T03:04:05.000Z')
+        self.assertEquals(
+            comments[0].created_time, datetime.datetime(
+                2015, 1, 2, 3, 4, 5, tzinfo=dateutil.tz.tzutc()))
+        self.assertEquals(comments[0].created_by, created_by)
+        self.assertIsNone(comments[1].created_time)
+        self.assertIsNone(comments[1].created_by)
+        self.assertIs(comments[2], comment)
+        self.assertNotEqual(comments[1], comment)
+        self.assertEqual(
+            comments[1], asana_mailer.Comment(u'Fields missing', None, None))
+        with self.assertRaises(AttributeError):
+            comment.type = u'comment'
+
+
+class InternTestCase(unittest.TestCase):
+
+    def test_intern_string(self):
+        first = u''.join([u'Tag', u' #1'])
+        second = u''.join([u'Tag', u' #1'])
+        self.assertIsNot(first, second)
+        self.assertIs(asana_mailer.intern_string(first), first)
+        self.assertIs(asana_mailer.intern_string(second), first)
+        self.assertIsNone(asana_mailer.intern_string(None))
+
+    def test_intern_user(self):
+        first = asana_mailer.intern_user({u'id': 1, u'name': u'User'})
+        self.assertEquals(first, {u'id': 1, u'name': u'User'})
+        self.assertIs(
+            asana_mailer.intern_user({u'name': u'User', u'id': 1}), first)
+        self.assertIsNot(asana_mailer.intern_user({u'id': 2}), first)
+        self.assertIsNone(asana_mailer.intern_user(None))
+        nested = {u'name': u'User', u'photo': {u'small': u'url'}}
+        self.assertIs(asana_mailer.intern_user(nested), nested)
+
+    def test_shared_across_tasks(self):
+        tasks = [
+            asana_mailer.Task.from_json({
+                u'id': i, u'name': u'Task',
+                u'assignee': {u'name': u''.join([u'Assign', u'ee'])},
+                u'tags': [{u'name': u''.join([u'T', u'ag'])}]},
+                [{u'text': u'Text', u'created_by': {u'name': u'User'}}])
+            for i in xrange(2)]
+        self.assertIs(tasks[0].assignee, tasks[1].assignee)
+        self.assertIs(tasks[0].tags[0], tasks[1].tags[0])
+        self.assertIs(
+            tasks[0].comments[0].created_by, tasks[1].comments[0].created_by)
+        # Slots leave no room for other attributes
+        with self.assertRaises(AttributeError):
+            tasks[0].other = None
+
+
+class TaskFromJsonTestCase(unittest.TestCase):
+
+    def test_from_json(self):
+        task_json = {
+            u'id': 321, u'name': u'Do Work', u'completed': True,
+            u'completed_at': u'2015-01-02T03:04:05.000Z'}
+        with mock.patch('asana_mailer.parse_datetime') as mock_parse:
+            task = asana_mailer.Task.from_json(
+                task_json, [{u'text': u'comment'}])
+            self.assertEquals(mock_parse.call_count, 0)
+            self.assertIs(task.completion_time, mock_parse.return_value)
+            self.assertIs(task.completion_time, mock_parse.return_value)
+            mock_parse.assert_called_once_with(u'2015-01-02T03:04:05.000Z')
+        self.assertEquals(task.id, u'321')
+        self.assertEquals(
+            task.comments, [asana_mailer.Comment(u'comment', None, None)])
+        self.assertIsNone(task.assignee)
+        self.assertIsNone(task.description)
+        self.assertEquals(task.tags, [])
+
+        # Setting the completion time replaces any unparsed one
+        task = asana_mailer.Task.from_json(task_json)
+        task.completion_time = None
+        self.assertIsNone(task.completion_time)
+
+        task_json[u'completed'] = False
+        self.assertIsNone(
+            asana_mailer.Task.from_json(task_json).completion_time)
+
+
+class ParseDatetimeTestCase(unittest.TestCase):
+
+    def test_parse_datetime(self):
+        timestamps = [
+            u'2015-01-02T03:04:05.123Z', u'2015-01-02T03:04:05+00:00',
+            u'2015-01-02T03:04:05-05:30', u'2015-01-02T03:04:05+0530',
+            u'2015-01-02T03:04:05.1234567Z', u'2015-01-02T03:04',
+            u'2015-01-02', u'Jan 5 2015']
+        for timestamp in timestamps:
+            self.assertEquals(
+                asana_mailer.parse_datetime(timestamp),
+                dateutil.parser.parse(timestamp))
+        parsed = asana_mailer.parse_datetime(u'2015-01-02T03:04:05.123Z')
+        self.assertEquals(parsed.utcoffset(), datetime.timedelta(0))
+        self.assertIsNone(asana_mailer.parse_datetime(u'2015-01-02').tzinfo)
+        with self.assertRaises(ValueError):
+            asana_mailer.parse_datetime(u'2015-13-01T00:00:00Z')
+
+    @mock.patch('asana_mailer.max_parsed_datetimes', 2)
+    @mock.patch.dict('asana_mailer._parsed_datetimes', clear=True)
+    def test_parse_datetime_memoized(self):
+        parsed = asana_mailer.parse_datetime(u'2015-01-02T03:04:05Z')
+        with mock.patch('asana_mailer._parse_iso_datetime') as mock_parse:
+            self.assertIs(
+                asana_mailer.parse_datetime(u'2015-01-02T03:04:05Z'), parsed)
+            self.assertEquals(mock_parse.call_count, 0)
+        # Only dateutil understands this one
+        asana_mailer.parse_datetime(u'Jan 5 2015')
+        asana_mailer.parse_datetime(u'2015-01-03')
+        self.assertEquals(
+            asana_mailer._parsed_datetimes.keys(), [u'2015-01-03'])
+
+
 class FiltersTestCase(unittest.TestCase):
 
     def test_last_comment(self):
@@ -508,6 +1526,18 @@ class FiltersTestCase(unittest.TestCase):
         self.assertEqual(
             asana_mailer.comments_within_lookback([], now, 200), [])
 
+        # Comments are binary searched rather than scanned
+        comments = asana_mailer.Comment.from_stories(
+            {u'created_at': (now - datetime.timedelta(hours=i)).isoformat()}
+            for i in reversed(xrange(1024)))
+        with mock.patch(
+                'asana_mailer._comment_time',
+                wraps=asana_mailer._comment_time) as mock_comment_time:
+            self.assertEqual(
+                asana_mailer.comments_within_lookback(comments, now, 10.5),
+                comments[-11:])
+            self.assertLessEqual(mock_comment_time.call_count, 11)
+
     def test_as_date(self):
         now = datetime.datetime.now()
         now_str = now.isoformat()
@@ -516,6 +1546,58 @@ class FiltersTestCase(unittest.TestCase):
         self.assertEqual(asana_mailer.as_date(now_str), now_date_str)
 
 
+class TemplateFieldsTestCase(unittest.TestCase):
+
+    def fields(self, *templates, **sources):
+        env = Environment(loader=DictLoader(sources))
+        return asana_mailer.TemplateFields.from_templates(templates, env)
+
+    def test_from_templates(self):
+        fields = self.fields(
+            'child.html',
+            base=(
+                '{% for section in project.sections %}'
+                '{% for t in section.tasks %}{{ t.name }}{{ t.due_date }}'
+                '{% block comments scoped %}{% endblock %}'
+                '{% endfor %}{% endfor %}'),
+            **{'child.html': (
+                '{% extends "base" %}{% block comments %}'
+                '{% for c in task.comments|comments_within_lookback(now, 5) %}'
+                '{{ c.text }}{{ c.created_by.name }}'
+                '{% endfor %}{% endblock %}')})
+        self.assertEquals(fields.task_fields, frozenset(['name', 'due_on']))
+        self.assertEquals(
+            fields.story_fields,
+            frozenset(['text', 'created_by.name', 'created_at']))
+        self.assertTrue(fields.comments)
+
+    def test_from_templates_without_comments(self):
+        fields = self.fields(
+            'a', 'b',
+            a='{% for task in tasks %}{{ task.completion_time }}{% endfor %}',
+            b='{% include "c" %}',
+            c='{{ task.tags|join(", ") }}')
+        self.assertEquals(
+            fields.task_fields,
+            frozenset(['completed', 'completed_at', 'tags.name']))
+        self.assertIsNone(fields.story_fields)
+        self.assertFalse(fields.comments)
+
+    def test_from_templates_unknown(self):
+        # Whole tasks, unknown attributes and dynamic templates
+        self.assertIsNone(self.fields('a', a='{{ describe(task) }}'))
+        self.assertIsNone(self.fields('a', a='{{ task.custom_field }}'))
+        self.assertIsNone(self.fields('a', a='{% include name %}'))
+
+    def test_repository_templates(self):
+        for html in glob.glob('templates/*_Comments.html'):
+            html = os.path.basename(html)
+            fields = asana_mailer.TemplateFields.from_templates(
+                [html, html.replace('.html', '.markdown')])
+            self.assertIn('text', fields.story_fields)
+            self.assertIn('name', fields.task_fields)
+
+
 class TaskTestCase(unittest.TestCase):
 
     @classmethod
@@ -549,15 +1631,273 @@ class TaskTestCase(unittest.TestCase):
         self.assertEqual(task.tags, original.tags)
         self.assertEqual(task.comments, original.comments)
 
-    def test_tags_in(self):
-        filter_set = set()
-        self.assertEqual(type(self).task.tags_in(filter_set), True)
-        filter_set = {'test1'}
-        self.assertEqual(type(self).task.tags_in(filter_set), True)
-        filter_set = {'test1', 'test2'}
-        self.assertEqual(type(self).task.tags_in(filter_set), True)
-        filter_set = {'test1', 'test2', 'test3'}
-        self.assertEqual(type(self).task.tags_in(filter_set), False)
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = asana_mailer.Metrics()
+
+    def test_shared(self):
+        self.assertIs(
+            asana_mailer.Metrics.shared(), asana_mailer.Metrics.shared())
+
+    @mock.patch('time.clock')
+    @mock.patch('time.time')
+    def test_phase(self, mock_time, mock_clock):
+        mock_time.side_effect = [10.0, 10.5, 20.0, 20.25]
+        mock_clock.side_effect = [1.0, 1.25, 2.0, 2.0]
+        with self.metrics.phase('render'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.phase('render'):
+                raise ValueError()
+        self.assertEquals(self.metrics.summary()['phases'], {
+            'render': {'count': 2, 'wall_ms': 750.0, 'cpu_ms': 250.0}})
+
+    def test_record_call(self):
+        for latency in xrange(1, 101):
+            self.metrics.record_call(
+                'tasks/{0}/stories?limit=10'.format(latency),
+                latency / 1000.0, 10)
+        self.metrics.record_call('projects/123/tasks', 0.5, 1000)
+        self.metrics.record_call('batch', 0.25, 100)
+        self.assertEquals(self.metrics.summary()['api_calls'], {
+            '/tasks/{id}/stories': {
+                'count': 100, 'bytes': 1000,
+                'latency_ms': {
+                    'p50': 50.0, 'p90': 90.0, 'p99': 99.0, 'max': 100.0}},
+            '/projects/{id}/tasks': {
+                'count': 1, 'bytes': 1000,
+                'latency_ms': {
+                    'p50': 500.0, 'p90': 500.0, 'p99': 500.0, 'max': 500.0}},
+            '/batch': {
+                'count': 1, 'bytes': 100,
+                'latency_ms': {
+                    'p50': 250.0, 'p90': 250.0, 'p99': 250.0, 'max': 250.0}},
+        })
+
+    def test_statsd_lines(self):
+        with mock.patch('time.time', side_effect=[0.0, 0.125]), \
+                mock.patch('time.clock', side_effect=[0.0, 0.0625]):
+            with self.metrics.phase('render:Default.html'):
+                pass
+        self.metrics.record_call('projects/1', 0.5, 42)
+        self.metrics.record_size('minify_html', 100, 60)
+        self.metrics.record_size('minify_html', 50, 40)
+        self.assertEquals(self.metrics.summary()['sizes'], {'minify_html': {
+            'count': 2, 'bytes_before': 150, 'bytes_after': 100,
+            'bytes_saved': 50}})
+        self.assertEquals(self.metrics.statsd_lines(prefix='mailer'), [
+            'mailer.phase.render_Default.html.wall:125.0|ms',
+            'mailer.phase.render_Default.html.cpu:62.5|ms',
+            'mailer.api.projects.id.calls:1|c',
+            'mailer.api.projects.id.bytes:42|c',
+            'mailer.api.projects.id.latency.max:500.0|g',
+            'mailer.api.projects.id.latency.p50:500.0|g',
+            'mailer.api.projects.id.latency.p90:500.0|g',
+            'mailer.api.projects.id.latency.p99:500.0|g',
+            'mailer.size.minify_html.saved:50|c',
+        ])
+
+    def test_send_statsd(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        try:
+            lines = ['a.b:{0}|c'.format('1' * 10) for _ in xrange(10)]
+            asana_mailer.send_statsd(
+                '127.0.0.1:{0}'.format(sock.getsockname()[1]), lines,
+                max_packet_size=50)
+            packets = [sock.recv(1024) for _ in xrange(5)]
+        finally:
+            sock.close()
+        # Two 16 byte lines and their newlines fit in each 50 byte packet
+        self.assertEquals(packets, ['\n'.join(lines[:2])] * 5)
+
+    def test_instrument_run(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            args = argparse.Namespace(
+                profile=os.path.join(temp_dir, 'run.prof'),
+                metrics=os.path.join(temp_dir, 'metrics.json'),
+                statsd='127.0.0.1:0')
+            with mock.patch('asana_mailer.send_statsd') as mock_statsd:
+                with self.assertRaises(ValueError):
+                    with asana_mailer.instrument_run(args):
+                        asana_mailer.parse_datetime(u'2013-01-01')
+                        raise ValueError()
+            # Reports are made even when the run fails
+            self.assertEquals(mock_statsd.call_count, 1)
+            stats = pstats.Stats(args.profile)
+            self.assertTrue(any(
+                function[2] == 'parse_datetime' for function in stats.stats))
+            with open(args.metrics) as metrics_file:
+                self.assertEquals(
+                    sorted(json.load(metrics_file)),
+                    ['api_calls', 'phases', 'sizes'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class CSSInlinerTestCase(unittest.TestCase):
+
+    document = u'''<!DOCTYPE html>
+<html><head><style>
+h1, h2 { color: red !important; }
+p { font-size: 2px; text-align: center }
+p.footer { font-size: 1px; background-color: #fff; width: 10px }
+a:hover { color: blue }
+li:first-child { color: green }
+@media (max-width: 600px) { p { color: black } }
+#main p { padding: 1px }
+</style><style media="print">p { color: gray }</style></head>
+<body><div id="main"><h1>Hi &amp; \u00e9</h1>
+<p class="footer" style="color: red">Footer</p>
+<ul><li>a</li><li style="font-weight: bold">b</li></ul><a href="#">x</a>
+</div></body></html>'''
+
+    def test_transform(self):
+        inliner = asana_mailer.CSSInliner()
+        expected = premailer.transform(type(self).document)
+        self.assertEquals(inliner.transform(type(self).document), expected)
+
+        # The stylesheet is only parsed once, and the output is the same
+        with mock.patch.object(
+                inliner._premailer, '_parse_style_rules') as mock_parse:
+            self.assertEquals(
+                inliner.transform(type(self).document), expected)
+            self.assertEquals(mock_parse.call_count, 0)
+
+        # Without a stylesheet
+        document = u'<html><body><p class="a">Text</p></body></html>'
+        self.assertEquals(
+            inliner.transform(document), premailer.transform(document))
+
+    def test_transform_templates(self):
+        project = asana_mailer.Project(u'1', u'Project', u'Description')
+        project.add_section(asana_mailer.Section(u'Section:', [
+            asana_mailer.Task(
+                u'Task', u'Assignee', False, None, u'Notes', u'2015-01-01',
+                [u'Tag'], [{u'text': u'Comment', u'created_at': u'2015-01-01',
+                            u'created_by': {u'name': u'User'}}])]))
+        html = asana_mailer.template_environments()[0].get_template(
+            'Project_Styled.html').render(
+                project=project, current_date='2015-01-01',
+                current_time_utc=datetime.datetime.now(dateutil.tz.tzutc()))
+        self.assertEquals(
+            asana_mailer.CSSInliner.shared().transform(html),
+            premailer.transform(html))
+
+    @mock.patch('premailer.transform')
+    def test_transform_external_stylesheet(self, mock_transform):
+        document = (
+            u'<html><head><link rel="stylesheet" href="style.css"></head>'
+            u'<body></body></html>')
+        self.assertEquals(
+            asana_mailer.CSSInliner().transform(document),
+            mock_transform.return_value)
+        mock_transform.assert_called_once_with(document)
+
+
+class HTMLMinifierTestCase(unittest.TestCase):
+
+    document = u'''<!DOCTYPE html>
+<html>
+  <head>
+    <title>  Title  </title>
+    <!-- a comment -->
+    <!--[if mso]><p>Outlook</p><![endif]-->
+  </head>
+  <body>
+    <h1>  Hi   &amp;
+      there\u00a0 </h1>
+    <ul>
+      <li><span>a</span> <span>b</span></li>
+      <li class="x">  keep\n  these  </li>
+    </ul>
+    <pre>  line one
+    line  two</pre>
+    <p style="white-space: pre-wrap">  a  b  </p>
+    <script>var  a;</script>
+  </body>
+</html>
+'''
+
+    def setUp(self):
+        self.metrics = asana_mailer.Metrics()
+        patcher = mock.patch.object(
+            asana_mailer.Metrics, 'shared', return_value=self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_minify(self):
+        minified = asana_mailer.HTMLMinifier().minify(type(self).document)
+        self.assertEquals(minified, (
+            u'<!DOCTYPE html>\n<html><head><title>Title</title>'
+            u'<!--[if mso]><p>Outlook</p><![endif]--></head><body>'
+            u'<h1>Hi &amp; there\xa0</h1><ul><li><span>a</span> <span>b'
+            u'</span></li><li class="x">keep these</li></ul>'
+            u'<pre>  line one\n    line  two</pre>'
+            u'<p style="white-space: pre-wrap">  a  b  </p>'
+            u'<script>var  a;</script></body></html>'))
+        self.assertEquals(self.metrics.summary()['sizes'], {'minify_html': {
+            'count': 1,
+            'bytes_before': len(type(self).document.encode('utf-8')),
+            'bytes_after': len(minified.encode('utf-8')),
+            'bytes_saved': len(type(self).document.encode('utf-8')) - len(
+                minified.encode('utf-8'))}})
+
+        # Without inlined CSS, a stylesheet could preformat a classed element
+        minified = asana_mailer.HTMLMinifier().minify(
+            type(self).document, styles_inlined=False)
+        self.assertIn(u'<li class="x">  keep\n  these  </li>', minified)
+
+    def test_dedupe_styles(self):
+        style = u'font-family: &quot;Georgia&quot;, serif; color: #FFA039'
+        document = (
+            u'<html><body><p class="a" style="{0}">a</p>'
+            u'<p style="{0}">b</p><p style="{0}">c</p>'
+            u'<p style="color: red">d</p></body></html>').format(style)
+        minifier = asana_mailer.HTMLMinifier(dedupe_styles=True)
+        self.assertEquals(minifier.minify(document), (
+            u'<html><head><style type="text/css">.s0{{{0}}}</style></head>'
+            u'<body><p class="a s0">a</p><p class="s0">b</p>'
+            u'<p class="s0">c</p><p style="color: red">d</p></body></html>'
+        ).format(style.replace(u'&quot;', u'"')))
+
+        # Other stylesheet rules could override the moved styles
+        document = document.replace(
+            u'<body>', u'<head><style>p { color: blue }</style></head><body>')
+        self.assertIn(u'<p style="color: red">', minifier.minify(document))
+        self.assertEquals(
+            minifier.minify(document).count(u'font-family: "Georgia"'), 3)
+
+    def test_generate_templates(self):
+        project = asana_mailer.Project(u'1', u'Project', u'Description')
+        project.add_section(asana_mailer.Section(u'Section:', [
+            asana_mailer.Task(
+                u'Task {0}'.format(i), u'Assignee', False, None,
+                u'Notes\n  indented', u'2015-01-01', [u'Tag'], None)
+            for i in xrange(10)]))
+        now = datetime.datetime.now(dateutil.tz.tzutc())
+        inlined, _ = asana_mailer.generate_templates(
+            project, 'Project_Styled.html', 'Default.markdown', '2015-01-01',
+            now)
+        minifier = asana_mailer.HTMLMinifier(dedupe_styles=True)
+        minified, _ = asana_mailer.generate_templates(
+            project, 'Project_Styled.html', 'Default.markdown', '2015-01-01',
+            now, minifier=minifier)
+        self.assertLess(len(minified), len(inlined) * 3 / 4)
+        self.assertIn(u'>Notes\n  indented</pre>', minified)
+        streamed, _ = asana_mailer.stream_templates(
+            project, 'Project_Styled.html', 'Default.markdown', '2015-01-01',
+            now, skip_inline_css=True, minifier=minifier)
+        self.assertEquals(
+            u''.join(streamed), minifier.minify(
+                asana_mailer.generate_templates(
+                    project, 'Project_Styled.html', 'Default.markdown',
+                    '2015-01-01', now, skip_inline_css=True)[0],
+                styles_inlined=False))
 
 
 class AsanaMailerTestCase(unittest.TestCase):
@@ -573,35 +1913,94 @@ class AsanaMailerTestCase(unittest.TestCase):
             if os.path.exists(fname):
                 os.remove(fname)
 
-    @mock.patch('premailer.transform')
-    @mock.patch('asana_mailer.FileSystemLoader')
-    @mock.patch('asana_mailer.Environment')
-    def test_generate_templates(
-            self, mock_jinja_env, mock_fs_loader, mock_transform):
-        mock_fs_instance = mock_fs_loader.return_value
-        mock_env_instance = mock_jinja_env.return_value
-        mock_get_template = mock_env_instance.get_template.return_value
-        mock_get_template.render.return_value = 'template render'
-        mock_transform.return_value = 'premailer transform'
+    @mock.patch('asana_mailer.CSSInliner.shared')
+    @mock.patch('asana_mailer.template_environments')
+    def test_generate_templates(self, mock_environments, mock_inliner):
+        html_env, text_env = mock.MagicMock(), mock.MagicMock()
+        mock_environments.return_value = (html_env, text_env)
+        html_env.get_template.return_value.render.return_value = 'html'
+        text_env.get_template.return_value.render.return_value = 'text'
+        mock_transform = mock_inliner.return_value.transform
+        mock_transform.return_value = 'inlined'
 
         project = mock.MagicMock()
 
+        # The process-wide environments are used by default
         return_vals = asana_mailer.generate_templates(
             project, 'html_template', 'text_template', type(self).current_date,
             type(self).current_time_utc)
-        mock_jinja_env.assert_called_once_with(
-            loader=mock_fs_instance, trim_blocks=True, lstrip_blocks=True,
-            autoescape=True)
-
-        mock_env_instance.get_template.assert_has_calls(
-            [mock.call('html_template'), mock.call('text_template')],
-            any_order=True)
-        mock_fs_loader.assert_called_once_with('templates')
-        self.assertFalse(mock_env_instance.autoescape)
-
-        self.assertEquals(
-            ('premailer transform', 'template render'), return_vals)
+        mock_environments.assert_called_once_with()
+        html_env.get_template.assert_called_once_with('html_template')
+        text_env.get_template.assert_called_once_with('text_template')
+        mock_transform.assert_called_once_with('html')
+        self.assertEquals(('inlined', 'text'), return_vals)
+
+        # Given environments are used as they are
+        mock_environments.reset_mock()
+        other_html_env, other_text_env = mock.MagicMock(), mock.MagicMock()
+        other_html_env.get_template.return_value.render.return_value = 'h'
+        other_text_env.get_template.return_value.render.return_value = 't'
+        return_vals = asana_mailer.generate_templates(
+            project, 'html_template', 'text_template', type(self).current_date,
+            type(self).current_time_utc, skip_inline_css=True,
+            environments=(other_html_env, other_text_env))
+        self.assertEquals(mock_environments.call_count, 0)
+        self.assertEquals(('h', 't'), return_vals)
 
+    @mock.patch('asana_mailer.FileSystemBytecodeCache')
+    @mock.patch('asana_mailer.FileSystemLoader')
+    @mock.patch('asana_mailer.Environment')
+    def test_create_template_environments(
+            self, mock_jinja_env, mock_fs_loader, mock_bytecode_cache):
+        mock_fs_instance = mock_fs_loader.return_value
+        asana_mailer.create_template_environments()
+        self.assertEquals(mock_jinja_env.call_args_list, [
+            mock.call(
+                loader=mock_fs_instance, trim_blocks=True, lstrip_blocks=True,
+                autoescape=True, bytecode_cache=None),
+            mock.call(
+                loader=mock_fs_instance, trim_blocks=True, lstrip_blocks=True,
+                autoescape=False, bytecode_cache=None)])
+        mock_fs_loader.assert_called_with('templates')
+        self.assertEquals(mock_bytecode_cache.call_count, 0)
+
+        # Each environment has its own bytecode cache files
+        mock_jinja_env.reset_mock()
+        asana_mailer.create_template_environments('cache_dir')
+        self.assertEquals(mock_bytecode_cache.call_args_list, [
+            mock.call('cache_dir', 'asana_mailer_html_%s.cache'),
+            mock.call('cache_dir', 'asana_mailer_text_%s.cache')])
+        for call in mock_jinja_env.call_args_list:
+            self.assertIs(
+                call[1]['bytecode_cache'], mock_bytecode_cache.return_value)
+
+    def test_template_environments(self):
+        environments = asana_mailer.template_environments()
+        html_env, text_env = environments
+        self.assertTrue(html_env.autoescape)
+        self.assertFalse(text_env.autoescape)
+        for env in (html_env, text_env):
+            self.assertIs(env.filters['as_date'], asana_mailer.as_date)
+        self.assertIs(asana_mailer.template_environments(), environments)
+
+        # Compiled templates are shared between calls, and written to the
+        # bytecode cache
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cached_html_env = asana_mailer.template_environments(cache_dir)[0]
+            self.assertIsNot(cached_html_env, html_env)
+            template = cached_html_env.get_template('Default.html')
+            self.assertIs(
+                asana_mailer.template_environments(cache_dir)[0].get_template(
+                    'Default.html'), template)
+            self.assertEquals(
+                len(glob.glob(os.path.join(
+                    cache_dir, 'asana_mailer_html_*.cache'))), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+            del asana_mailer._template_environments[cache_dir]
+
+    @mock.patch('asana_mailer.TemplateFields.from_templates')
     @mock.patch('datetime.date')
     @mock.patch('datetime.datetime')
     @mock.patch('asana_mailer.write_rendered_files')
@@ -613,7 +2012,8 @@ class AsanaMailerTestCase(unittest.TestCase):
     def test_main(
             self, mock_cli_parser, mock_asana_api, mock_create_project,
             mock_generate_templates, mock_send_email,
-            mock_write_rendered_files, mock_datetime, mock_date):
+            mock_write_rendered_files, mock_datetime, mock_date,
+            mock_template_fields):
 
         mock_cli_instance = mock_cli_parser.return_value
         mock_cli_instance.error.side_effect = SystemExit(2)
@@ -631,33 +2031,71 @@ class AsanaMailerTestCase(unittest.TestCase):
             asana_mailer.main()
         self.assertEquals(cm.exception.code, 2)
 
+        # Concurrency must be positive
+        mock_cli_instance.parse_args.return_value = argparse.Namespace(
+            from_address=None, to_addresses=None, concurrency=0)
+        with self.assertRaises(SystemExit) as cm:
+            asana_mailer.main()
+        self.assertEquals(cm.exception.code, 2)
+
         namespace = argparse.Namespace(
+            config=None,
             api_key='api_key',
             tag_filters=['tag_filter'],
+            filter_expr=None,
             section_filters=['section_filter'],
             project_id='project_id',
             completed_lookback_hours=None,
+            concurrency=1,
+            rate_limit=1500,
+            batch=False,
+            cache=None,
+            state_db=None,
+            skip_inline_css=True,
+            template_cache=None,
+            stream=False,
+            profile=None,
+            metrics=None,
+            statsd=None,
+            api_url=None,
+            record=None,
+            replay=None,
+            save_snapshot=None,
+            from_snapshot=None,
+            minify_html=False,
+            dedupe_styles=False,
             html_template='Mock.html',
             text_template='Mock.markdown',
             mail_server='mockhost',
             cc_addresses=None,
             from_address='example@example.com',
-            to_addresses=['example2@example.com'])
+            to_addresses=['example2@example.com'],
+            username=None,
+            password=None)
         mock_cli_instance.parse_args.return_value = namespace
         asana_mailer.main()
-        mock_asana_api.assert_called_once_with('api_key')
+        mock_asana_api.assert_called_once_with(
+            'api_key', pool_size=1, cache=None, api_url=None,
+            scheduler=mock.ANY, adapter=None)
+        mock_asana_api.call_args[1]['scheduler'].rate = 1500 / 60.0
+        mock_asana_instance.close.assert_called_once_with()
         mock_create_project.assert_called_once_with(
             mock_asana_instance, 'project_id', mock_datetime_now_instance,
             task_filters=frozenset((u'tag_filter',)),
             section_filters=frozenset((u'section_filter:',)),
-            completed_lookback_hours=None)
+            completed_lookback_hours=None, concurrency=1, state_store=None,
+            batch=False, fields=mock_template_fields.return_value)
+        environments = asana_mailer.template_environments()
+        mock_template_fields.assert_called_with(
+            ['Mock.html', 'Mock.markdown'], environments[0])
         mock_generate_templates.assert_called_once_with(
             'Project', 'Mock.html', 'Mock.markdown', 'Mock Date',
-            mock_datetime_now_instance)
+            mock_datetime_now_instance, True, environments=environments,
+            minifier=None)
         mock_send_email.assert_called_once_with(
             'Project', 'mockhost', 'example@example.com',
             ['example2@example.com'], None, 'rendered_html', 'rendered_text',
-            'Mock Date')
+            'Mock Date', None, None)
 
         # With Cc Addresses
         namespace.cc_addresses = [
@@ -670,7 +2108,7 @@ class AsanaMailerTestCase(unittest.TestCase):
             'Project', 'mockhost', 'example@example.com',
             ['example2@example.com'],
             ['example3@example.com', 'example4@example.com'], 'rendered_html',
-            'rendered_text', 'Mock Date')
+            'rendered_text', 'Mock Date', None, None)
 
         # With No Addresses
         namespace.to_addresses = None
@@ -682,6 +2120,316 @@ class AsanaMailerTestCase(unittest.TestCase):
         mock_write_rendered_files.assert_called_once_with(
             'rendered_html', 'rendered_text', 'Mock Date')
 
+    @mock.patch('asana_mailer.create_cli_parser')
+    def test_main_config(self, mock_cli_parser):
+        mock_cli_instance = mock_cli_parser.return_value
+        mock_cli_instance.error.side_effect = SystemExit(2)
+        namespace = argparse.Namespace(
+            config='config.json', parallel_projects=2, concurrency=1,
+            from_address=None, to_addresses=None, project_id=None,
+            api_key=None, profile=None, metrics=None, statsd=None,
+            record=None, replay=None, save_snapshot=None, from_snapshot=None,
+            smtp_connections=1, tag_filters=['tag'], filter_expr=None,
+            section_filters=[], completed_lookback_hours=24,
+            skip_inline_css=True, minify_html=False, dedupe_styles=False,
+            html_template='Default.html', text_template='Default.markdown',
+            cc_addresses=None)
+        mock_cli_instance.parse_args.return_value = namespace
+        results = [{'project_id': u'1', 'status': 'written'}]
+        with mock.patch('asana_mailer.load_config') as mock_load_config, \
+                mock.patch('asana_mailer.mail_projects') as mock_mail:
+            mock_load_config.return_value = ('api_key', [{}])
+            mock_mail.return_value = results
+            asana_mailer.main()
+            mock_mail.assert_called_once_with(namespace, 'api_key', [{}])
+            # Per-project options on the command line are project defaults
+            mock_load_config.assert_called_once_with('config.json', {
+                'tag_filters': ['tag'], 'section_filters': [],
+                'completed_lookback_hours': 24, 'skip_inline_css': True,
+                'minify_html': False, 'dedupe_styles': False,
+                'html_template': 'Default.html',
+                'text_template': 'Default.markdown'})
+
+            results.append({'project_id': u'2', 'status': 'failed'})
+            with self.assertRaises(SystemExit) as cm:
+                asana_mailer.main()
+            self.assertEquals(cm.exception.code, 1)
+
+            mock_load_config.side_effect = ValueError('bad')
+            with self.assertRaises(SystemExit) as cm:
+                asana_mailer.main()
+            self.assertEquals(cm.exception.code, 2)
+
+            # An invalid --filter-expr is rejected like a config's would be
+            mock_load_config.side_effect = None
+            namespace.filter_expr = u'tag AND'
+            with self.assertRaises(SystemExit) as cm:
+                asana_mailer.main()
+            self.assertEquals(cm.exception.code, 2)
+            self.assertIn(
+                'Invalid --filter-expr',
+                mock_cli_instance.error.call_args[0][0])
+            namespace.filter_expr = None
+
+        # Neither a config nor a project
+        namespace.config = None
+        with self.assertRaises(SystemExit) as cm:
+            asana_mailer.main()
+        self.assertEquals(cm.exception.code, 2)
+
+    @mock.patch('asana_mailer.connect_smtp')
+    @mock.patch('asana_mailer.send_email')
+    @mock.patch('asana_mailer.generate_templates')
+    @mock.patch('asana_mailer.Project.create_project')
+    @mock.patch('asana_mailer.AsanaAPI')
+    @mock.patch('asana_mailer.load_config')
+    def test_main_config_send_failed(
+            self, mock_load_config, mock_asana_api, mock_create_project,
+            mock_generate_templates, mock_send_email, mock_connect_smtp):
+        mock_create_project.return_value = asana_mailer.Project(
+            u'1', 'Project', None)
+        mock_generate_templates.return_value = ('html', 'text')
+        addresses = {
+            'to_addresses': ['to@example.com'],
+            'from_address': 'from@example.com'}
+        projects = [
+            dict(addresses, project_id=u'1'),
+            {'project_id': u'2', 'outputs': [
+                dict(addresses, name='sent'), dict(addresses, name='bad')]},
+        ]
+        mock_load_config.return_value = ('api_key', projects)
+        send_results = [False, True, False]
+        mock_send_email.side_effect = lambda *args, **kwargs: (
+            send_results.pop(0))
+
+        # Rejected emails fail their project, and so the run
+        argv = ['asana_mailer.py', '--config', 'c.json',
+                '--parallel-projects', '1']
+        stdout = StringIO.StringIO()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stdout', stdout):
+            with self.assertRaises(SystemExit) as cm:
+                asana_mailer.main()
+        self.assertEquals(cm.exception.code, 1)
+        results = json.loads(stdout.getvalue())
+        self.assertEquals(
+            [result['status'] for result in results], ['failed', 'failed'])
+        self.assertEquals(results[0]['error'], 'Email could not be sent')
+        self.assertEquals(
+            [output['status'] for output in results[1]['outputs']],
+            ['sent', 'failed'])
+
+    def test_load_config(self):
+        config = {
+            'api_key': 'api_key',
+            'defaults': {'tag_filters': ['tag'], 'html_template': 'A.html'},
+            'projects': [
+                {'project_id': '1'},
+                {'project_id': '2', 'html_template': 'B.html',
+                 'to_addresses': ['to@example.com'],
+                 'from_address': 'from@example.com'},
+            ]
+        }
+        filename = 'AsanaMailer_test_config.json'
+        with open(filename, 'w') as config_file:
+            json.dump(config, config_file)
+        api_key, projects = asana_mailer.load_config(filename)
+        self.assertEquals(api_key, 'api_key')
+        self.assertEquals(projects[0], {
+            'project_id': '1', 'tag_filters': ['tag'],
+            'html_template': 'A.html'})
+        self.assertEquals(projects[1]['html_template'], 'B.html')
+
+        # Command line options apply beneath the file's defaults
+        api_key, projects = asana_mailer.load_config(filename, {
+            'tag_filters': ['cli'], 'completed_lookback_hours': 24,
+            'section_filters': ['Section']})
+        self.assertEquals(projects[0], {
+            'project_id': '1', 'tag_filters': ['tag'],
+            'html_template': 'A.html', 'completed_lookback_hours': 24,
+            'section_filters': ['Section']})
+
+        del config['projects'][1]['from_address']
+        with open(filename, 'w') as config_file:
+            json.dump(config, config_file)
+        with self.assertRaises(ValueError):
+            asana_mailer.load_config(filename)
+
+        config['projects'] = [{'project_id': '3', 'outputs': [
+            {'name': 'engineers', 'html_template': 'C.html'},
+            {'tag_filters': [], 'to_addresses': ['to@example.com'],
+             'from_address': 'from@example.com'},
+        ]}]
+        with open(filename, 'w') as config_file:
+            json.dump(config, config_file)
+        api_key, projects = asana_mailer.load_config(filename)
+        self.assertEquals(projects[0]['outputs'], [
+            {'project_id': '3', 'tag_filters': ['tag'],
+             'html_template': 'C.html', 'name': 'engineers'},
+            {'project_id': '3', 'tag_filters': [], 'html_template': 'A.html',
+             'to_addresses': ['to@example.com'],
+             'from_address': 'from@example.com'},
+        ])
+        for outputs in ([], [{'completed_lookback_hours': 1}],
+                        [{'from_address': 'from@example.com'}]):
+            config['projects'] = [{'project_id': '3', 'outputs': outputs}]
+            with open(filename, 'w') as config_file:
+                json.dump(config, config_file)
+            with self.assertRaises(ValueError):
+                asana_mailer.load_config(filename)
+
+    @mock.patch('asana_mailer.connect_smtp')
+    @mock.patch('asana_mailer.write_rendered_files')
+    @mock.patch('asana_mailer.send_email')
+    @mock.patch('asana_mailer.generate_templates')
+    @mock.patch('asana_mailer.Project.create_project')
+    @mock.patch('asana_mailer.AsanaAPI')
+    def test_mail_projects(
+            self, mock_asana_api, mock_create_project,
+            mock_generate_templates, mock_send_email,
+            mock_write_rendered_files, mock_connect_smtp):
+        args = argparse.Namespace(
+            concurrency=2, parallel_projects=2, cache=None, rate_limit=1500,
+            state_db=None, batch=False, skip_inline_css=True,
+            template_cache=None, stream=False, html_template='Default.html',
+            text_template='Default.markdown', mail_server='mockhost',
+            username=None, password=None, api_url=None, record=None,
+            replay=None, smtp_connections=1, minify_html=False,
+            dedupe_styles=False)
+
+        def create_project(asana, project_id, *args, **kwargs):
+            if project_id == u'bad':
+                raise HTTPError('404')
+            project = asana_mailer.Project(project_id, 'Project', None)
+            project.add_section(asana_mailer.Section(u'Section:', [1, 2]))
+            return project
+
+        mock_create_project.side_effect = create_project
+        mock_generate_templates.return_value = ('html', 'text')
+        mock_send_email.return_value = True
+        projects = [
+            {'project_id': u'1', 'to_addresses': ['to@example.com'],
+             'from_address': 'from@example.com', 'tag_filters': ['tag']},
+            {'project_id': u'bad'},
+            {'project_id': u'3', 'to_addresses': ['to@example.com'],
+             'from_address': 'from@example.com',
+             'cc_addresses': ['cc@example.com'],
+             'html_template': 'All_Comments.html'},
+            {'project_id': u'4', 'section_filters': ['Section']},
+        ]
+        results = asana_mailer.mail_projects(args, 'api_key', projects)
+
+        self.assertEquals(
+            [(r['project_id'], r['status']) for r in results],
+            [(u'1', 'sent'), (u'bad', 'failed'), (u'3', 'sent'),
+             (u'4', 'written')])
+        self.assertEquals(results[0]['tasks'], 2)
+        self.assertIn('404', results[1]['error'])
+        mock_asana_api.assert_called_once_with(
+            'api_key', pool_size=4, cache=None, api_url=None,
+            scheduler=mock.ANY, adapter=None)
+        mock_asana_api.return_value.close.assert_called_once_with()
+
+        # Everything shares one API client, environment pair and transport
+        transports = set(
+            c[1]['transport'] for c in mock_send_email.call_args_list)
+        self.assertEquals(len(transports), 1)
+        transport = transports.pop()
+        self.assertIsInstance(transport, asana_mailer.MailTransport)
+        self.assertEquals(
+            (transport.mail_server, transport.pool_size), ('mockhost', 1))
+        self.assertTrue(transport._closed)
+        self.assertEquals(
+            len(set(id(c[1]['environments'])
+                    for c in mock_generate_templates.call_args_list)), 1)
+        for call in mock_create_project.call_args_list:
+            self.assertIs(call[0][0], mock_asana_api.return_value)
+        create_project_kwargs = dict(
+            (call[0][1], call[1])
+            for call in mock_create_project.call_args_list)
+        self.assertEquals(create_project_kwargs[u'1'], {
+            'task_filters': frozenset([u'tag']),
+            'section_filters': frozenset(), 'completed_lookback_hours': None,
+            'concurrency': 2, 'state_store': None, 'batch': False,
+            'fields': create_project_kwargs[u'1']['fields']})
+        self.assertEquals(
+            create_project_kwargs[u'4']['section_filters'],
+            frozenset([u'Section:']))
+        mock_write_rendered_files.assert_called_once_with(
+            'html', 'text', mock.ANY, u'4')
+
+    @mock.patch('asana_mailer.connect_smtp')
+    @mock.patch('asana_mailer.write_rendered_files')
+    @mock.patch('asana_mailer.send_email')
+    @mock.patch('asana_mailer.generate_templates')
+    @mock.patch('asana_mailer.Project.create_project')
+    @mock.patch('asana_mailer.AsanaAPI')
+    def test_mail_projects_outputs(
+            self, mock_asana_api, mock_create_project,
+            mock_generate_templates, mock_send_email,
+            mock_write_rendered_files, mock_connect_smtp):
+        args = argparse.Namespace(
+            concurrency=1, parallel_projects=1, cache=None, rate_limit=1500,
+            state_db=None, batch=False, skip_inline_css=True,
+            template_cache=None, stream=False, html_template='Default.html',
+            text_template='Default.markdown', mail_server='mockhost',
+            username=None, password=None, api_url=None, record=None,
+            replay=None, smtp_connections=1, minify_html=False,
+            dedupe_styles=False)
+        tasks = [
+            asana_mailer.Task(
+                u'Task {0}'.format(i), None, False, None, None, None,
+                task_tags, None)
+            for i, task_tags in enumerate([[u'a'], [u'b'], []])]
+        project = asana_mailer.Project(u'1', 'Project', None)
+        project.add_section(asana_mailer.Section(u'One:', tasks[:2]))
+        project.add_section(asana_mailer.Section(u'Two:', tasks[2:]))
+        mock_create_project.return_value = project
+        rendered = []
+
+        def generate_templates(project, html_template, *args, **kwargs):
+            rendered.append((html_template, [
+                (section.name, section.tasks)
+                for section in project.sections]))
+            return 'html', 'text'
+        mock_generate_templates.side_effect = generate_templates
+        mock_send_email.return_value = True
+        projects = [{'project_id': u'1', 'outputs': [
+            {'name': 'engineers', 'html_template': 'Last_Five_Comments.html',
+             'filter_expr': u'a', 'to_addresses': ['to@example.com'],
+             'from_address': 'from@example.com'},
+            {'name': 'managers', 'section_filters': ['Two']},
+            {'name': 'bad', 'filter_expr': u'b'},
+        ]}]
+        mock_write_rendered_files.side_effect = [None, IOError('disk full')]
+        results = asana_mailer.mail_projects(args, 'api_key', projects)
+
+        # One fetch, for every task and field the outputs need
+        mock_create_project.assert_called_once_with(
+            mock_asana_api.return_value, u'1', mock.ANY, task_filters=None,
+            section_filters=frozenset(), completed_lookback_hours=None,
+            concurrency=1, state_store=None, batch=False, fields=mock.ANY)
+        fields = mock_create_project.call_args[1]['fields']
+        self.assertTrue(fields.comments)
+        self.assertIn('tags.name', fields.task_fields)
+        self.assertEquals(rendered, [
+            ('Last_Five_Comments.html', [(u'One:', [tasks[0]])]),
+            ('Default.html', [(u'Two:', [tasks[2]])]),
+            ('Default.html', [(u'One:', [tasks[1]])]),
+        ])
+        self.assertEquals(
+            [s.tasks for s in project.sections], [tasks[:2], tasks[2:]])
+        self.assertEquals(mock_send_email.call_count, 1)
+        self.assertEquals(
+            [c[0][3] for c in mock_write_rendered_files.call_args_list],
+            [u'1_managers', u'1_bad'])
+        self.assertEquals(results[0]['status'], 'failed')
+        self.assertEquals(
+            [(r['name'], r['status'], r['tasks'])
+             for r in results[0]['outputs'] if 'tasks' in r],
+            [(u'engineers', 'sent', 1), (u'managers', 'written', 1)])
+        self.assertEquals(results[0]['outputs'][2]['status'], 'failed')
+        self.assertIn('disk full', results[0]['outputs'][2]['error'])
+
     @mock.patch('asana_mailer.MIMEText')
     @mock.patch('asana_mailer.MIMEMultipart')
     @mock.patch('smtplib.SMTP')
@@ -755,13 +2503,27 @@ class AsanaMailerTestCase(unittest.TestCase):
         )
         smtp_mock_instance.quit.assert_called_once_with()
 
+        # Shared connections are left open
+        smtp_mock_instance.quit.reset_mock()
+        mock_smtp.reset_mock()
+        shared_conn = mock.MagicMock()
+        self.assertTrue(asana_mailer.send_email(
+            project, 'localhost', from_address, to_addresses[:], None,
+            'test_html', 'test_text', type(self).current_date,
+            smtp_conn=shared_conn))
+        self.assertEquals(mock_smtp.call_count, 0)
+        shared_conn.sendmail.assert_called_once_with(
+            from_address, to_addresses, 'test message')
+        self.assertEquals(shared_conn.quit.call_count, 0)
+
         smtp_mock_instance.sendmail.side_effect = smtplib.SMTPException
         try:
-            asana_mailer.send_email(
+            sent = asana_mailer.send_email(
                 project, 'localhost', from_address, to_addresses[:], None,
                 'test_html', 'test_text', type(self).current_date)
         except smtplib.SMTPException:
             self.fail('asana_mailer.send_email threw an SMTPException!')
+        self.assertFalse(sent)
 
     def test_write_rendered_files(self):
         today = type(self).current_date.isoformat()
@@ -774,6 +2536,292 @@ class AsanaMailerTestCase(unittest.TestCase):
             with codecs.open(fname, 'r', 'utf-8') as fobj:
                 self.assertEqual(fobj.read(), 'testing')
 
+        # Streamed chunks are written as they come
+        asana_mailer.write_rendered_files(
+            iter([u'test', u'ing \u00e9']), iter([u'text']), today, u'1')
+        with codecs.open(
+                'AsanaMailer_1_{0}.html'.format(today), 'r', 'utf-8') as fobj:
+            self.assertEqual(fobj.read(), u'testing \u00e9')
+
+    def test_stream_templates(self):
+        project = asana_mailer.Project(u'1', u'Project', u'Description')
+        project.add_section(asana_mailer.Section(u'Section:', [
+            asana_mailer.Task(
+                u'Task \u00e9', u'Assignee', False, None, u'Notes <b>',
+                u'2015-01-01', [u'Tag'], [])]))
+        args = (
+            project, 'Project_Styled.html', 'Project.markdown',
+            type(self).current_date, type(self).current_time_utc)
+        for skip_inline_css in (True, False):
+            html_chunks, text_chunks = asana_mailer.stream_templates(
+                *args, skip_inline_css=skip_inline_css, buffer_size=10)
+            text_chunks = list(text_chunks)
+            self.assertGreater(len(text_chunks), 1)
+            self.assertEquals(
+                (u''.join(html_chunks), u''.join(text_chunks)),
+                asana_mailer.generate_templates(
+                    *args, skip_inline_css=skip_inline_css))
+
+    def test_buffer_chunks(self):
+        chunks = [u'a', u'bc', u'd', u'efgh', u'i']
+        self.assertEquals(
+            list(asana_mailer.buffer_chunks(chunks, 3)),
+            [u'abc', u'defgh', u'i'])
+        self.assertEquals(list(asana_mailer.buffer_chunks([], 3)), [])
+
+    def test_create_message(self):
+        project = asana_mailer.Project(u'1', u'Test Project', u'')
+        message = asana_mailer.create_message(
+            project, 'from@example.com', ['to@example.com'],
+            ['cc@example.com'], type(self).current_date, u'<p>\u00e9</p>',
+            u'text')
+        self.assertEquals(
+            message['Subject'],
+            'Test Project Daily Mailer {0}'.format(type(self).current_date))
+        self.assertEquals(message['To'], 'to@example.com')
+        self.assertEquals(message['Cc'], 'cc@example.com')
+        self.assertEquals(
+            [part.get_content_type() for part in message.get_payload()],
+            ['text/plain', 'text/html'])
+        self.assertEquals(
+            message.get_payload()[1].get_payload(decode=True).decode('utf-8'),
+            u'<p>\u00e9</p>')
+
+        # Without rendered templates, only the headers are set
+        message = asana_mailer.create_message(
+            project, 'from@example.com', ['to@example.com'], None,
+            type(self).current_date)
+        self.assertIsNone(message['Cc'])
+        self.assertEquals(message.get_payload(), [])
+
+    def test_send_email_streamed(self):
+        project = mock.MagicMock()
+        project.name = 'Test Project'
+        conn = mock.MagicMock()
+        conn.mail.return_value = (250, 'OK')
+        conn.rcpt.return_value = (250, 'OK')
+        conn.getreply.side_effect = [(354, 'Go ahead'), (250, 'OK')]
+        sent_data = []
+        conn.send.side_effect = sent_data.append
+        html = u'<p>\u00e9</p>\n' * 100
+        text = u'.leading dot\n' + u'x' * 1000
+
+        self.assertTrue(asana_mailer.send_email(
+            project, 'localhost', 'from@example.com', ['to@example.com'],
+            ['cc@example.com'], iter([html[:50], html[50:]]), iter([text]),
+            type(self).current_date, smtp_conn=conn))
+        conn.mail.assert_called_once_with('from@example.com')
+        self.assertEquals(conn.rcpt.call_args_list, [
+            mock.call('to@example.com'), mock.call('cc@example.com')])
+        conn.putcmd.assert_called_once_with('data')
+        self.assertEquals(conn.sendmail.call_count, 0)
+        self.assertEquals(conn.quit.call_count, 0)
+
+        data = ''.join(sent_data)
+        self.assertTrue(data.endswith('\r\n.\r\n'))
+        self.assertNotIn('\r\n.\r\n', data[:-5])
+        message = email.message_from_string(
+            re.sub(r'(?m)^\.\.', '.', data[:-3]).replace('\r\n', '\n'))
+        self.assertEquals(message['Cc'], 'cc@example.com')
+        text_part, html_part = message.get_payload()
+        self.assertEquals(text_part.get_content_type(), 'text/plain')
+        self.assertEquals(
+            text_part.get_payload(decode=True).decode('utf-8'), text)
+        self.assertEquals(html_part.get_content_type(), 'text/html')
+        self.assertEquals(
+            html_part.get_payload(decode=True).decode('utf-8'), html)
+
+        # A failed render abandons the connection
+        def failed_render():
+            yield u'start'
+            raise ValueError('render failed')
+        conn.getreply.side_effect = [(354, 'Go ahead')]
+        with self.assertRaises(ValueError):
+            asana_mailer.send_email(
+                project, 'localhost', 'from@example.com', ['to@example.com'],
+                None, failed_render(), iter([text]), type(self).current_date,
+                smtp_conn=conn)
+        conn.close.assert_called_once_with()
+
+        # A refused sender fails the send
+        conn.mail.return_value = (550, 'No')
+        self.assertFalse(asana_mailer.send_email(
+            project, 'localhost', 'from@example.com', ['to@example.com'],
+            None, iter([html]), iter([text]), type(self).current_date,
+            smtp_conn=conn))
+        conn.rset.assert_called_once_with()
+
+
+class FakeSMTPConnection(object):
+    '''An SMTP connection that replies to what's sent as a server would.'''
+
+    def __init__(self, pipelining=False):
+        self.does_esmtp = pipelining
+        self.sock = True
+        self.commands = []
+        self.writes = []
+        self.rcpt_code = 250
+        self.disconnected = False
+        self.in_data = False
+        self.pending = []
+        self.ehlo_or_helo_if_needed = mock.Mock()
+        self.rset = mock.Mock()
+        self.quit = mock.Mock()
+
+    def has_extn(self, name):
+        return self.does_esmtp and name == 'pipelining'
+
+    def reply(self, command):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected()
+        self.commands.append(command)
+        if command.startswith('rcpt'):
+            return (self.rcpt_code, 'Recipient')
+        elif command == 'data':
+            self.in_data = True
+            return (354, 'Go ahead')
+        return (250, 'OK')
+
+    def mail(self, address):
+        return self.reply('mail FROM:<{0}>'.format(address))
+
+    def rcpt(self, address):
+        return self.reply('rcpt TO:<{0}>'.format(address))
+
+    def putcmd(self, command):
+        self.pending.append(self.reply(command))
+
+    def send(self, data):
+        self.writes.append(data)
+        if self.in_data:
+            if data.endswith('.\r\n'):
+                self.in_data = False
+                self.pending.append((250, 'Queued'))
+        else:
+            self.pending.extend(
+                self.reply(command) for command in data.split('\r\n')[:-1])
+
+    def getreply(self):
+        return self.pending.pop(0)
+
+    def close(self):
+        self.sock = None
+
+
+class MailTransportTestCase(unittest.TestCase):
+
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_send(self, mock_connect_smtp):
+        conns = [FakeSMTPConnection(), FakeSMTPConnection()]
+        mock_connect_smtp.side_effect = conns
+        transport = asana_mailer.MailTransport(
+            'mockhost', 'user', 'password', pool_size=2)
+        for _ in xrange(3):
+            self.assertEquals(transport.send(
+                'from@example.com', ['to@example.com'],
+                'Subject: hi\n\n.dot\nbody'), {})
+        # Messages are sent one after another over one connection
+        mock_connect_smtp.assert_called_once_with(
+            'mockhost', 'user', 'password', None)
+        self.assertEquals(transport.connects, 1)
+        self.assertEquals(transport.messages, 3)
+        self.assertEquals(conns[0].commands, [
+            'mail FROM:<from@example.com>', 'rcpt TO:<to@example.com>',
+            'data'] * 3)
+        self.assertEquals(
+            conns[0].writes[0],
+            'Subject: hi\r\n\r\n..dot\r\nbody\r\n.\r\n')
+
+        # A refused recipient leaves the connection pooled
+        conns[0].rcpt_code = 550
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            transport.send('from@example.com', ['to@example.com'], 'x')
+        conns[0].rset.assert_called_once_with()
+        conns[0].rcpt_code = 250
+
+        # A connection the server closed is replaced, and the message resent
+        conns[0].disconnected = True
+        transport.send('from@example.com', ['to@example.com'], 'x')
+        self.assertIsNone(conns[0].sock)
+        self.assertEquals(transport.connects, 2)
+        self.assertEquals(len(conns[1].commands), 3)
+
+        transport.close()
+        conns[1].quit.assert_called_once_with()
+        self.assertEquals(conns[0].quit.call_count, 0)
+
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_send_streamed(self, mock_connect_smtp):
+        conns = [FakeSMTPConnection(), FakeSMTPConnection()]
+        mock_connect_smtp.side_effect = conns
+        transport = asana_mailer.MailTransport('mockhost')
+        transport.send('from@example.com', ['to@example.com'], 'x')
+
+        # A closed connection found before DATA hasn't read any of a
+        # streamed message, so it's still resent over a new connection
+        conns[0].disconnected = True
+        transport.send(
+            'from@example.com', ['to@example.com'],
+            (line for line in ['a\r\n', 'b\r\n']))
+        self.assertEquals(transport.connects, 2)
+        self.assertEquals(conns[1].writes, ['a\r\n', 'b\r\n.\r\n'])
+
+        # But not once some of it was sent
+        def disconnect(data):
+            raise smtplib.SMTPServerDisconnected()
+        conns[1].send = disconnect
+        transport = asana_mailer.MailTransport('mockhost')
+        transport._idle.append(conns[1])
+        transport._open = 1
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            transport.send(
+                'from@example.com', ['to@example.com'],
+                (line for line in ['a\r\n', 'b\r\n']))
+        self.assertEquals(transport.connects, 0)
+        self.assertIsNone(conns[1].sock)
+
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_pipelining(self, mock_connect_smtp):
+        conn = FakeSMTPConnection(pipelining=True)
+        mock_connect_smtp.return_value = conn
+        transport = asana_mailer.MailTransport('mockhost')
+        transport.send(
+            'from@example.com', ['to@example.com', 'cc@example.com'], 'x')
+        self.assertEquals(conn.writes, [
+            'mail FROM:<from@example.com>\r\nrcpt TO:<to@example.com>\r\n'
+            'rcpt TO:<cc@example.com>\r\ndata\r\n', 'x\r\n.\r\n'])
+
+        # Unless it's turned off
+        conn.writes = []
+        transport = asana_mailer.MailTransport('mockhost', pipelining=False)
+        transport.send('from@example.com', ['to@example.com'], 'x')
+        self.assertEquals(conn.writes, ['x\r\n.\r\n'])
+
+        # A refused envelope after pipelined DATA was accepted can't be reset
+        conn.rcpt_code = 550
+        transport = asana_mailer.MailTransport('mockhost')
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            transport.send('from@example.com', ['to@example.com'], 'x')
+        self.assertEquals(conn.rset.call_count, 0)
+        self.assertIsNone(conn.sock)
+
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_pool_size(self, mock_connect_smtp):
+        mock_connect_smtp.side_effect = lambda *args: FakeSMTPConnection()
+        transport = asana_mailer.MailTransport('mockhost', pool_size=2)
+        first, _ = transport._acquire()
+        transport._acquire()
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(transport._acquire()))
+        waiter.start()
+        waiter.join(0.1)
+        # A third send waits for a connection to be free
+        self.assertEquals(acquired, [])
+        transport._release(first)
+        waiter.join(1)
+        self.assertEquals(acquired, [(first, True)])
+        self.assertEquals(mock_connect_smtp.call_count, 2)
 
 if __name__ == '__main__':
     nose.main()